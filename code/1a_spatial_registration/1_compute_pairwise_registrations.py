@@ -1,4 +1,9 @@
+import json
+import os
 import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
 import geopandas as gpd
@@ -7,93 +12,378 @@ import pandas as pd
 from GDRT.raster.register_images import align_two_rasters
 from GDRT.raster.registration_algorithms import sitk_intensity_registration
 from scientific_python_utils.geospatial import ensure_projected_CRS
-import traceback
 
 # Add folder where constants.py is to system search path
 sys.path.append(str(Path(Path(__file__).parent, "..").resolve()))
 from constants import (
+    CHM_CHIPS_FOLDER,
     CHMS_FOLDER,
+    CURRENT_LOCATION_WEIGHT,
+    MAX_PAIRWISE_SHIFT,
     METADATA_FILE,
     MIN_OVERLAP_TO_REGISTER,
+    PAIRWISE_REGISTRATION_CACHE_FOLDER,
     PAIRWISE_SHIFTS_FILE,
     TARGET_GSD,
 )
+from chm_chips import extract_pair_chips, get_chip_file
+from file_fingerprints import get_file_fingerprint
+from global_shift_solver import GlobalShiftSolver
+from phase_correlation import phase_correlation_register
+from registration_pairs import (
+    find_overlapping_pairs,
+    plan_additional_pairs,
+    plan_registration_pairs,
+)
+from shifted_rasters import write_shifted_vrt
+
+# How many processes to register pairs with. If None, pairs are registered sequentially
+N_REGISTRATION_PROCESSES = 8
+# How to compute the shift between a pair of CHMs. One of:
+# "sitk": iterative intensity-based optimization with SimpleITK
+# "phase_correlation": FFT phase correlation, which is much faster but only estimates a translation
+# "phase_correlation+sitk": phase correlation provides the initial shift which is refined by SimpleITK
+REGISTRATION_ENGINE = "sitk"
+# Additional arguments to the aligner. These are part of the cache key, so changing them will
+# cause all the pairs to be recomputed
+ALIGNER_KWARGS = {"align_means": False}
+# Whether to register chips of the CHMs cropped to the overlap region, rather than the full CHMs
+USE_CHM_CHIPS = True
+# How far to expand the overlap region when extracting chips. This should be at least as large as
+# the largest expected shift so content which is shifted into the overlap is not cut off.
+CHIP_BUFFER = MAX_PAIRWISE_SHIFT
+# Register coarse-to-fine at these GSDs, for example [2.0, 1.0, 0.5, TARGET_GSD]. The shift found at
+# each level initializes the next one. If None, registration is only run at TARGET_GSD. If chips
+# are used, they are read at TARGET_GSD so no level should be finer than that.
+PYRAMID_GSDS = None
+# Skip the remaining pyramid levels once a level changes the shift by less than this many meters
+PYRAMID_TOLERANCE = 0.05
+# Whether to only register a well-conditioned subset of the overlapping pairs rather than all of
+# them. The subset is the maximum-overlap spanning forest plus N_REDUNDANT_EDGES pairs per mission.
+PLAN_REGISTRATION_GRAPH = True
+N_REDUNDANT_EDGES = 1
+# After registering the planned pairs, missions with fewer than two usable pairs or a pairwise
+# residual above RESIDUAL_THRESHOLD meters get N_ADDITIONAL_EDGES more pairs, up to
+# N_REFINEMENT_ROUNDS times
+RESIDUAL_THRESHOLD = 1.0
+N_ADDITIONAL_EDGES = 1
+N_REFINEMENT_ROUNDS = 2
+
+
+def get_pair_key(mission_1, mission_2):
+    """
+    Everything that determines the result of registering a pair. A cached result is only reused
+    if the stored key is identical to this one.
+    """
+    return {
+        "mission_id_1": str(mission_1),
+        "mission_id_2": str(mission_2),
+        "chm_fingerprint_1": get_file_fingerprint(
+            Path(CHMS_FOLDER, f"{mission_1}.tif")
+        ),
+        "chm_fingerprint_2": get_file_fingerprint(
+            Path(CHMS_FOLDER, f"{mission_2}.tif")
+        ),
+        "registration_engine": REGISTRATION_ENGINE,
+        "target_GSD": TARGET_GSD,
+        "aligner_kwargs": ALIGNER_KWARGS,
+        "chip_buffer": CHIP_BUFFER if USE_CHM_CHIPS else None,
+        "pyramid_GSDs": PYRAMID_GSDS,
+        "pyramid_tolerance": PYRAMID_TOLERANCE if PYRAMID_GSDS is not None else None,
+    }
+
+
+def get_cache_file(key):
+    # There is one file per pair, which is overwritten if the result becomes stale
+    return Path(
+        PAIRWISE_REGISTRATION_CACHE_FOLDER,
+        f"{key['mission_id_1']}_{key['mission_id_2']}.json",
+    )
+
+
+def is_failed_result(result):
+    """Whether registration failed, in which case the shift is nan"""
+    return np.isnan(result["xshift"]) or np.isnan(result["yshift"])
+
+
+def read_cached_result(key):
+    """Return the cached result for this key or None if it is missing or stale"""
+    cache_file = get_cache_file(key)
+    if not cache_file.is_file():
+        return None
+    try:
+        with open(cache_file, "r") as infile:
+            cached = json.load(infile)
+    except json.JSONDecodeError:
+        # A partially-written file, treat it as missing
+        return None
+    # The inputs or settings have changed since this was computed
+    if cached["key"] != json.loads(json.dumps(key)):
+        return None
+    # A failure cached by an earlier version of this script, which should be retried
+    if is_failed_result(cached["result"]):
+        return None
+    return cached["result"]
+
+
+def write_cached_result(key, result):
+    cache_file = get_cache_file(key)
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    # Write to a temporary file and then rename, so a crash never leaves a corrupted result
+    tmp_file = cache_file.with_suffix(f".tmp{os.getpid()}")
+    with open(tmp_file, "w") as outfile:
+        json.dump({"key": key, "result": result}, outfile, indent=4)
+    os.replace(tmp_file, cache_file)
+
+
+def sitk_register(fixed_chm_filename, moving_chm_filename, target_GSD):
+    # Compute a shift between the two datasets based on minimizing the CHM discrepency
+    transforms = align_two_rasters(
+        fixed_chm_filename,
+        moving_chm_filename,
+        aligner_alg=sitk_intensity_registration,
+        target_GSD=target_GSD,
+        vis_chips=False,
+        vis_kwargs={},
+        aligner_kwargs=ALIGNER_KWARGS,
+    )
+    # Extract the shift component of the predicted transform
+    mv2fx_tr = transforms["geospatial_mv2fx_transform"]
+    return [float(mv2fx_tr[0, 2]), float(mv2fx_tr[1, 2])]
+
+
+def run_registration_engine(
+    fixed_chm_filename, moving_chm_filename, target_GSD, max_shift
+):
+    """
+    Compute the shift from the moving to the fixed CHM with REGISTRATION_ENGINE. The confidence is
+    the phase correlation peak height, and is nan for the "sitk" engine which does not provide one.
+    """
+    if REGISTRATION_ENGINE == "sitk":
+        return (
+            sitk_register(fixed_chm_filename, moving_chm_filename, target_GSD),
+            np.nan,
+        )
+
+    shift, confidence = phase_correlation_register(
+        fixed_chm_filename,
+        moving_chm_filename,
+        target_GSD=target_GSD,
+        max_shift=max_shift,
+    )
+    if REGISTRATION_ENGINE == "phase_correlation":
+        return shift, confidence
+    elif REGISTRATION_ENGINE != "phase_correlation+sitk":
+        raise ValueError(f"Unknown registration engine {REGISTRATION_ENGINE}")
 
+    # Apply the initial shift to the moving CHM without copying the data, so SimpleITK only needs
+    # to find the small remaining shift
+    with tempfile.TemporaryDirectory() as temp_dir:
+        initialized_moving_filename = Path(temp_dir, "moving.vrt")
+        write_shifted_vrt(moving_chm_filename, initialized_moving_filename, shift)
+        residual_shift = sitk_register(
+            fixed_chm_filename, initialized_moving_filename, target_GSD
+        )
+    return [shift[0] + residual_shift[0], shift[1] + residual_shift[1]], confidence
 
-def get_all_registrations(overlay_gdf):
-    all_predicted_shifts = []
 
-    # Iterate over all the pairs of overlapping datasets
-    for _, row in overlay_gdf.iterrows():
-        # Strip leading zeros from mission name
-        mission_1 = row["mission_id_1"]
-        mission_2 = row["mission_id_2"]
-        # Compute the years for each dataset
-        year_1 = row["earliest_year_derived_1"]
-        year_2 = row["earliest_year_derived_2"]
-        # Compute the CHM file path
+def register_pair(mission_1, mission_2):
+    """
+    Compute the shift from the second mission to the first one. If PYRAMID_GSDS is set, the shift
+    is estimated at each GSD in turn, starting from the shift found at the previous level. The
+    shift, time and confidence after each level are included in the result.
+    """
+    # Compute the CHM file path
+    if USE_CHM_CHIPS:
+        fixed_chm_filename = get_chip_file(
+            CHM_CHIPS_FOLDER, mission_1, mission_2, mission_1
+        )
+        moving_chm_filename = get_chip_file(
+            CHM_CHIPS_FOLDER, mission_1, mission_2, mission_2
+        )
+    else:
         fixed_chm_filename = Path(CHMS_FOLDER, f"{mission_1}.tif")
         moving_chm_filename = Path(CHMS_FOLDER, f"{mission_2}.tif")
-        print(f"Running {mission_1} and {mission_2} for year {year_1} and {year_2}")
-        try:
-            # Try to compute a shift between the two datasets based on minimizing the CHM discrepency
-            transforms = align_two_rasters(
-                fixed_chm_filename,
-                moving_chm_filename,
-                aligner_alg=sitk_intensity_registration,
-                target_GSD=TARGET_GSD,
-                vis_chips=False,
-                vis_kwargs={},
-                aligner_kwargs={"align_means": False},
+
+    level_GSDs = [TARGET_GSD] if PYRAMID_GSDS is None else PYRAMID_GSDS
+    result = {}
+    predicted_shift = np.zeros(2)
+    confidence = np.nan
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for level, level_GSD in enumerate(level_GSDs):
+                start_time = time.time()
+                if level == 0:
+                    level_moving_filename = moving_chm_filename
+                    # Search the full range of plausible shifts at the first level
+                    max_shift = MAX_PAIRWISE_SHIFT
+                else:
+                    # Apply the shift from the previous levels to the moving CHM
+                    level_moving_filename = Path(temp_dir, f"moving_{level}.vrt")
+                    write_shifted_vrt(
+                        moving_chm_filename, level_moving_filename, predicted_shift
+                    )
+                    # The remaining error should be on the order of the previous level's pixels
+                    max_shift = 2 * level_GSDs[level - 1]
+
+                update, confidence = run_registration_engine(
+                    fixed_chm_filename,
+                    level_moving_filename,
+                    target_GSD=level_GSD,
+                    max_shift=max_shift,
+                )
+                predicted_shift = predicted_shift + np.array(update)
+
+                result[f"level_{level}_GSD"] = float(level_GSD)
+                result[f"level_{level}_seconds"] = time.time() - start_time
+                result[f"level_{level}_xshift"] = float(predicted_shift[0])
+                result[f"level_{level}_yshift"] = float(predicted_shift[1])
+                result[f"level_{level}_confidence"] = float(confidence)
+
+                # Stop refining once the finer levels no longer change the result much
+                if level > 0 and np.linalg.norm(update) < PYRAMID_TOLERANCE:
+                    break
+        result["n_levels"] = level + 1
+    except Exception as e:
+        print(e)
+        print(f"Failed for missions {mission_1} and {mission_2}")
+        predicted_shift = [np.nan, np.nan]
+
+    result["xshift"] = float(predicted_shift[0])
+    result["yshift"] = float(predicted_shift[1])
+    result["confidence"] = float(confidence)
+    return result
+
+
+def register_and_cache_pair(key):
+    """
+    Register one pair and immediately persist the result so it survives a crash. Failures may be
+    transient, such as I/O errors or running out of memory, so they are not cached and are
+    retried on the next run.
+    """
+    result = register_pair(key["mission_id_1"], key["mission_id_2"])
+    if not is_failed_result(result):
+        write_cached_result(key, result)
+    return result
+
+
+def get_all_registrations(overlay_gdf, n_processes=None):
+    # Compute the key for each pair of overlapping datasets
+    keys = [
+        get_pair_key(row["mission_id_1"], row["mission_id_2"])
+        for _, row in overlay_gdf.iterrows()
+    ]
+    # Start with the results which are already present and up to date
+    all_results = [read_cached_result(key) for key in keys]
+    missing_inds = [i for i, result in enumerate(all_results) if result is None]
+    print(
+        f"Reusing {len(keys) - len(missing_inds)} cached registrations, "
+        f"computing {len(missing_inds)}"
+    )
+
+    if USE_CHM_CHIPS:
+        # Read each CHM once and write the chips for all the pairs that need to be computed
+        extract_pair_chips(
+            overlay_gdf.iloc[missing_inds],
+            chms_folder=CHMS_FOLDER,
+            chips_folder=CHM_CHIPS_FOLDER,
+            target_gsd=TARGET_GSD,
+            buffer=CHIP_BUFFER,
+        )
+
+    if n_processes is None:
+        for i in missing_inds:
+            print(
+                f"Running {keys[i]['mission_id_1']} and {keys[i]['mission_id_2']} for year "
+                f"{overlay_gdf.iloc[i]['earliest_year_derived_1']} and "
+                f"{overlay_gdf.iloc[i]['earliest_year_derived_2']}"
             )
-            # Extract the shift component of the predicted transform
-            mv2fx_tr = transforms["geospatial_mv2fx_transform"]
-            predicted_shift = [mv2fx_tr[0, 2], mv2fx_tr[1, 2]]
-        except Exception as e:
-            print(e)
-            print(f"Failed for missions {mission_1} and {mission_2}")
-            predicted_shift = (np.nan, np.nan)
-        print(f"Predicted shift: {predicted_shift}")
-
-        all_predicted_shifts.append(predicted_shift)
-
-    return all_predicted_shifts
-
-
-metadata = gpd.read_file(METADATA_FILE)
-# Remove extranous columns
-metadata = metadata[["mission_id", "earliest_year_derived", "geometry"]]
-# Make sure it's in a projected CRS
-metadata = ensure_projected_CRS(metadata)
-# Split by year for NRS datasets
-# This is not done solely based on the year since other projects (not NRS) might be included as well
-metadata_2020 = metadata[metadata["earliest_year_derived"].astype(int) == 2020]
-metadata_2023 = metadata[metadata["earliest_year_derived"].astype(int) == 2023]
-metadata_2024 = metadata[metadata["earliest_year_derived"].astype(int) == 2024]
-
-# Determine overlaps between years
-overlay_2020_2023 = metadata_2020.overlay(metadata_2023)
-overlay_2020_2024 = metadata_2020.overlay(metadata_2024)
-overlay_2023_2024 = metadata_2023.overlay(metadata_2024)
-
-# Concatenate all overlays
-all_overlays = gpd.GeoDataFrame(
-    pd.concat(
-        (overlay_2020_2023, overlay_2020_2024, overlay_2023_2024), ignore_index=True
-    ),
-    crs=overlay_2020_2023.crs,
-)
+            all_results[i] = register_and_cache_pair(keys[i])
+            print(f"Predicted shift: {all_results[i]}")
+    else:
+        with ProcessPoolExecutor(max_workers=n_processes) as executor:
+            futures = {
+                executor.submit(register_and_cache_pair, keys[i]): i
+                for i in missing_inds
+            }
+            # Report results as they finish rather than in submission order
+            for n_done, future in enumerate(as_completed(futures), start=1):
+                i = futures[future]
+                all_results[i] = future.result()
+                print(
+                    f"({n_done}/{len(futures)}) Predicted shift for "
+                    f"{keys[i]['mission_id_1']} and {keys[i]['mission_id_2']}: "
+                    f"{all_results[i]}"
+                )
+
+    return all_results
+
+
+# The process pool may re-import this file, so the script must be guarded
+if __name__ == "__main__":
+    metadata = gpd.read_file(METADATA_FILE)
+    # Remove extranous columns
+    metadata = metadata[["mission_id", "earliest_year_derived", "geometry"]]
+    # Make sure it's in a projected CRS
+    metadata = ensure_projected_CRS(metadata)
+    # Determine which pairs of missions from different years overlap substantially
+    all_overlays = find_overlapping_pairs(metadata, min_overlap=MIN_OVERLAP_TO_REGISTER)
+    all_overlays = all_overlays.reset_index(drop=True)
+    print(f"Found {len(all_overlays)} overlapping pairs")
+
+    # Determine which pairs to register first
+    if PLAN_REGISTRATION_GRAPH:
+        to_register = plan_registration_pairs(
+            all_overlays, n_redundant_edges=N_REDUNDANT_EDGES
+        )
+    else:
+        to_register = np.ones(len(all_overlays), dtype=bool)
+
+    registered = np.zeros(len(all_overlays), dtype=bool)
+    # The global solution is updated incrementally as pairs are added
+    solver = GlobalShiftSolver(CURRENT_LOCATION_WEIGHT)
+    all_results = [None] * len(all_overlays)
+    for refinement_round in range(N_REFINEMENT_ROUNDS + 1):
+        # Perform registration
+        new_inds = np.where(to_register & ~registered)[0]
+        print(f"Registering {len(new_inds)} pairs")
+        new_results = get_all_registrations(
+            all_overlays.iloc[new_inds], n_processes=N_REGISTRATION_PROCESSES
+        )
+        for i, result in zip(new_inds, new_results):
+            all_results[i] = result
+        registered[new_inds] = True
 
-# Filter out pairs with limited overlap
-all_overlays = all_overlays[all_overlays.area > MIN_OVERLAP_TO_REGISTER]
+        if not PLAN_REGISTRATION_GRAPH or refinement_round == N_REFINEMENT_ROUNDS:
+            break
 
-# Perform registration
-all_shifts = get_all_registrations(all_overlays)
+        # Add pairs for the missions which are not well supported by the current results
+        shifts = np.array(
+            [
+                [result["xshift"], result["yshift"]] if result else [np.nan, np.nan]
+                for result in all_results
+            ]
+        )
+        to_register = plan_additional_pairs(
+            all_overlays,
+            registered=registered,
+            shifts=shifts,
+            max_shift=MAX_PAIRWISE_SHIFT,
+            residual_threshold=RESIDUAL_THRESHOLD,
+            solver=solver,
+            n_additional_edges=N_ADDITIONAL_EDGES,
+        )
+        if not np.any(to_register):
+            break
 
-# Add shifts to overlay file
-all_shifts = np.array(all_shifts)
-all_overlays["xshift"] = all_shifts[:, 0]
-all_overlays["yshift"] = all_shifts[:, 1]
+    print(f"Registered {registered.sum()} of {len(all_overlays)} overlapping pairs")
+    # Only the registered pairs are retained
+    all_overlays = all_overlays[registered]
+    # Add shifts, their confidence and the per-level results to overlay file
+    all_results = pd.DataFrame(
+        [all_results[i] for i in np.where(registered)[0]], index=all_overlays.index
+    )
+    all_overlays = all_overlays.join(all_results)
 
-# Write shifts to file along with overlapping region
-all_overlays.to_file(PAIRWISE_SHIFTS_FILE)
+    # Write shifts to file along with overlapping region
+    all_overlays.to_file(PAIRWISE_SHIFTS_FILE)
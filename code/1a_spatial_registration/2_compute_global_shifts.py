@@ -12,13 +12,27 @@ from GDRT.harmonizing import compute_global_shifts_from_pairwise
 sys.path.append(str(Path(Path(__file__).parent, "..").resolve()))
 from constants import (
     PAIRWISE_SHIFTS_FILE,
+    ABSOLUTE_SHIFTS_DIAGNOSTICS_FILE,
     ABSOLUTE_SHIFTS_FILE,
+    ABSOLUTE_SHIFTS_SOLVER_STATE_FILE,
     CURRENT_LOCATION_WEIGHT,
     MAX_PAIRWISE_SHIFT,
 )
+from global_shift_solver import GlobalShiftSolver
+
+# Whether to update the solution from the previous run with the pairs that were added, changed or
+# removed, rather than solving from scratch
+INCREMENTAL_UPDATE = True
+# Whether to check the solution against the dense solver from GDRT which was used before. The
+# solutions should match to within COMPARISON_TOLERANCE meters.
+COMPARE_WITH_GDRT = True
+COMPARISON_TOLERANCE = 1e-3
 
 # Read the pairwise shifts
 gdf = gpd.read_file(PAIRWISE_SHIFTS_FILE)
+# Use string IDs so they match the keys of the saved solver and the output json file
+gdf["mission_id_1"] = gdf["mission_id_1"].astype(str)
+gdf["mission_id_2"] = gdf["mission_id_2"].astype(str)
 # Convert into a dictionary mapping from the pair of dataset IDs and the shift between them
 shifts = {
     k: v
@@ -39,28 +53,70 @@ shifts = {
 
 # Get the list of all dataset IDs
 all_dataset_ids = gdf["mission_id_1"].to_list() + gdf["mission_id_2"].to_list()
-# Give each dataset the same weighting for staying in the original location
-dataset_weights = {
-    dataset_id: CURRENT_LOCATION_WEIGHT for dataset_id in all_dataset_ids
-}
 
 # Weight each shift identically. In the future this could be updated to include some metric of
 # confidence in the shift
-shift_weights = np.ones(len(shifts))
+shift_weights = {k: 1.0 for k in shifts.keys()}
+
+# Each dataset is given the same weighting for staying in the original location
+solver = None
+if INCREMENTAL_UPDATE and ABSOLUTE_SHIFTS_SOLVER_STATE_FILE.is_file():
+    solver = GlobalShiftSolver.load(ABSOLUTE_SHIFTS_SOLVER_STATE_FILE)
+    # The previous solution can't be updated if the weighting has changed
+    if solver.current_location_weight != CURRENT_LOCATION_WEIGHT:
+        solver = None
+if solver is None:
+    solver = GlobalShiftSolver(CURRENT_LOCATION_WEIGHT)
+else:
+    print("Updating the previous solution")
+solver.add_missions(all_dataset_ids)
+# Only the pairs which differ from the previous run are added or removed
+solver.update_pairs(shifts, shift_weights)
 
 # Compute the global shift that minimizes all the error terms using least squares.
-global_shifts = compute_global_shifts_from_pairwise(
-    shifts,
-    shift_weights=shift_weights,
-    dataset_weights=dataset_weights,
-)
+global_shifts = solver.solve()
+# Datasets from previous runs that are no longer present are not reported
+global_shifts = {k: global_shifts[k] for k in dict.fromkeys(all_dataset_ids)}
 # Print the results
 pprint.pprint(global_shifts)
 
+if COMPARE_WITH_GDRT:
+    # Solve the same problem from scratch with the same weights
+    reference_shifts = compute_global_shifts_from_pairwise(
+        shifts,
+        shift_weights=np.array([shift_weights[k] for k in shifts.keys()]),
+        dataset_weights={
+            dataset_id: CURRENT_LOCATION_WEIGHT for dataset_id in all_dataset_ids
+        },
+    )
+    compared_ids = [k for k in global_shifts.keys() if k in reference_shifts]
+    differences = np.linalg.norm(
+        np.array([global_shifts[k] for k in compared_ids])
+        - np.array([reference_shifts[k] for k in compared_ids]),
+        axis=1,
+    )
+    print(
+        f"Largest difference from the GDRT solution over {len(compared_ids)} datasets: "
+        f"{differences.max(initial=0):.2e}"
+    )
+    if differences.max(initial=0) > COMPARISON_TOLERANCE:
+        raise ValueError(
+            f"The shift of dataset {compared_ids[np.argmax(differences)]} differs from the "
+            f"GDRT solution by {differences.max():.3f}, which is more than the tolerance of "
+            f"{COMPARISON_TOLERANCE}"
+        )
+
 # Save them to a json file
 with open(ABSOLUTE_SHIFTS_FILE, "w") as output_h:
     json.dump(global_shifts, output_h, ensure_ascii=True, indent=4, sort_keys=True)
 
+# Save the solver so the next run can be an incremental update
+solver.save(ABSOLUTE_SHIFTS_SOLVER_STATE_FILE)
+# Save the per-dataset residuals and uncertainty of the shifts
+diagnostics = solver.get_mission_diagnostics()
+diagnostics = diagnostics[diagnostics["mission_id"].isin(global_shifts.keys())]
+diagnostics.to_csv(ABSOLUTE_SHIFTS_DIAGNOSTICS_FILE, index=False)
+
 # Show the histogram of pairwise shifts that were the inputs to this algorithm
 pairwise_shifts = np.array(list(shifts.values()))
 pairwise_shift_dists = np.linalg.norm(pairwise_shifts, axis=1)
@@ -2,6 +2,7 @@ import geopandas as gpd
 import sys
 from GDRT.raster.utils import update_transform
 import json
+import multiprocessing
 from pathlib import Path
 import numpy as np
 
@@ -13,41 +14,100 @@ from constants import (
     SHIFTS_PER_DATASET,
     METADATA_FILE,
 )
+from file_fingerprints import get_file_fingerprint
+from shifted_rasters import write_shifted_reflink, write_shifted_vrt
 
-# Open the list of shifts for each dataset
-with open(SHIFTS_PER_DATASET, "r") as infile:
-    shifts_per_dataset = json.load(infile)
+# How to produce the shifted orthomosaics. One of:
+# "vrt": a lightweight VRT which references the original pixels with an updated georeference. The
+#     output is a .vrt file which references the original orthomosaic by its relative path.
+# "reflink": a reflinked copy of the GeoTIFF with the georeference patched in place. On filesystems
+#     without reflink support this is a full copy.
+# "copy": a full copy of the GeoTIFF written with an updated transform
+SHIFT_OUTPUT_MODE = "reflink"
+# How many multiprocessing suprocesses to run. If None, no multiprocessing will be used.
+N_MULTIPROCESSING_PROCESSES = 8
 
-metadata = gpd.read_file(METADATA_FILE)
-
-for mission_id in metadata.mission_id:
-    # Determine whether a shift was calculated for this mission
-    if mission_id not in shifts_per_dataset:
-        print(f"Mission ID not in shifts: {mission_id}")
-        shift = (0, 0)
-    else:
-        shift = shifts_per_dataset[mission_id]
 
+def shift_ortho(mission_id, shift):
     # Determine the input and output filenames
     input_filename = Path(ORTHOS_FOLDER, f"{mission_id}.tif")
-    output_filename = Path(SHIFTED_ORTHOS_FOLDER, f"{mission_id}.tif")
-
-    # Build a shift-only relative transform
-    relative_transform = [
-        [
-            1,
-            0,
-            shift[0],
-        ],
-        [0, 1, shift[1]],
-        [0, 0, 1],
-    ]
-    relative_transform = np.array(relative_transform)
-
-    # Create a file with an updated (shifted) transform
-    update_transform(
-        input_filename,
-        output_filename,
-        relative_transform=relative_transform,
-        update_existing=True,
+    suffix = ".vrt" if SHIFT_OUTPUT_MODE == "vrt" else ".tif"
+    output_filename = Path(SHIFTED_ORTHOS_FOLDER, f"{mission_id}{suffix}")
+    # The output of the other modes, which is removed so there is only one version of each ortho
+    other_output_filename = output_filename.with_suffix(
+        ".tif" if suffix == ".vrt" else ".vrt"
     )
+    # Records how the output was created, so it is only recreated if something changed
+    record_filename = Path(SHIFTED_ORTHOS_FOLDER, f"{mission_id}.shift.json")
+    record = {
+        "shift": list(shift),
+        "mode": SHIFT_OUTPUT_MODE,
+        "input_fingerprint": get_file_fingerprint(input_filename),
+    }
+
+    if output_filename.is_file() and record_filename.is_file():
+        with open(record_filename, "r") as infile:
+            if json.load(infile) == record:
+                print(f"Skipping {mission_id} because the shift has not changed")
+                return
+
+    print(f"Shifting {mission_id} by {shift}")
+    other_output_filename.unlink(missing_ok=True)
+    if SHIFT_OUTPUT_MODE == "vrt":
+        write_shifted_vrt(input_filename, output_filename, shift)
+    elif SHIFT_OUTPUT_MODE == "reflink":
+        write_shifted_reflink(input_filename, output_filename, shift)
+    elif SHIFT_OUTPUT_MODE == "copy":
+        # Build a shift-only relative transform
+        relative_transform = [
+            [
+                1,
+                0,
+                shift[0],
+            ],
+            [0, 1, shift[1]],
+            [0, 0, 1],
+        ]
+        relative_transform = np.array(relative_transform)
+
+        # Create a file with an updated (shifted) transform
+        update_transform(
+            input_filename,
+            output_filename,
+            relative_transform=relative_transform,
+            update_existing=True,
+        )
+    else:
+        raise ValueError(f"Unknown shift output mode {SHIFT_OUTPUT_MODE}")
+
+    # Only record the shift once the output is complete
+    with open(record_filename, "w") as outfile:
+        json.dump(record, outfile, indent=4)
+
+
+# The process pool may re-import this file, so the script must be guarded
+if __name__ == "__main__":
+    # Open the list of shifts for each dataset
+    with open(SHIFTS_PER_DATASET, "r") as infile:
+        shifts_per_dataset = json.load(infile)
+
+    metadata = gpd.read_file(METADATA_FILE)
+    SHIFTED_ORTHOS_FOLDER.mkdir(parents=True, exist_ok=True)
+
+    args_list = []
+    for mission_id in metadata.mission_id:
+        # Determine whether a shift was calculated for this mission
+        if mission_id not in shifts_per_dataset:
+            print(f"Mission ID not in shifts: {mission_id}")
+            shift = (0, 0)
+        else:
+            shift = shifts_per_dataset[mission_id]
+        args_list.append((mission_id, shift))
+
+    # Run shifting, either multiprocessing or sequentially
+    if N_MULTIPROCESSING_PROCESSES is not None:
+        with multiprocessing.Pool(processes=N_MULTIPROCESSING_PROCESSES) as pool:
+            pool.starmap(shift_ortho, args_list)
+    else:
+        for args in args_list:
+            shift_ortho(*args)
@@ -0,0 +1,187 @@
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+import shapely
+from file_fingerprints import get_file_fingerprint
+from rasterio.enums import Resampling
+from rasterio.transform import Affine
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, from_bounds
+from rasterio.windows import transform as window_transform
+
+# Decimation factors for the overviews which are built if the CHM does not have any
+OVERVIEW_FACTORS = [2, 4, 8, 16, 32]
+
+
+def get_chip_file(chips_folder, mission_1, mission_2, mission):
+    """The chip of `mission` for the overlap between `mission_1` and `mission_2`"""
+    return Path(chips_folder, f"{mission_1}_{mission_2}", f"{mission}.tif")
+
+
+def ensure_overviews(chm_file, factors=OVERVIEW_FACTORS):
+    """
+    Build overviews for the CHM if it does not have any. They are written to an external .ovr
+    file so the CHM itself (and therefore its fingerprint) is not modified.
+    """
+    with rasterio.open(chm_file) as src:
+        if len(src.overviews(1)) > 0:
+            return
+    print(f"Building overviews for {chm_file}")
+    with rasterio.Env(TIFF_USE_OVR=True):
+        with rasterio.open(chm_file, "r+") as src:
+            src.build_overviews(factors, Resampling.average)
+
+
+def read_chm_window(chm_file, bounds, bounds_crs, target_gsd):
+    """
+    Read the region of the CHM within `bounds` at a resolution of approximately `target_gsd`.
+    The read is decimated by GDAL, which uses the closest overview if one is present.
+
+    Returns:
+        np.ndarray: float32 heights, with nan for nodata
+        affine.Affine: the transform of the returned array
+        rasterio.crs.CRS: the CRS of the returned array
+    """
+    with rasterio.open(chm_file) as src:
+        # Express the bounds in the CHM's CRS
+        bounds = transform_bounds(bounds_crs, src.crs, *bounds)
+        # Restrict the window to the raster
+        window = from_bounds(*bounds, transform=src.transform)
+        window = window.intersection(Window(0, 0, src.width, src.height))
+        window = window.round_offsets().round_lengths()
+
+        # Only decimate if the resolution is in meters. Never upsample.
+        if src.crs.is_projected:
+            scale = max(target_gsd / src.res[0], 1)
+        else:
+            scale = 1
+        out_shape = (
+            max(int(round(window.height / scale)), 1),
+            max(int(round(window.width / scale)), 1),
+        )
+
+        data = src.read(
+            1,
+            window=window,
+            out_shape=out_shape,
+            resampling=Resampling.average,
+            masked=True,
+        )
+        # Account for the decimation when computing the transform of the data
+        transform = src.window_transform(window) * Affine.scale(
+            window.width / out_shape[1], window.height / out_shape[0]
+        )
+        crs = src.crs
+
+    return data.astype(np.float32).filled(np.nan), transform, crs
+
+
+def write_chip(data, transform, crs, output_file, tags):
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    with rasterio.open(
+        output_file,
+        "w",
+        driver="GTiff",
+        width=data.shape[1],
+        height=data.shape[0],
+        count=1,
+        dtype=np.float32,
+        crs=crs,
+        transform=transform,
+        nodata=np.nan,
+        compress="deflate",
+        tiled=True,
+    ) as dst:
+        dst.write(data, 1)
+        dst.update_tags(**tags)
+
+
+def is_chip_current(chip_file, tags):
+    """Check whether the chip exists and was created from the same inputs and settings"""
+    if not chip_file.is_file():
+        return False
+    with rasterio.open(chip_file) as src:
+        existing_tags = src.tags()
+    return all(existing_tags.get(k) == v for k, v in tags.items())
+
+
+def extract_pair_chips(
+    overlay_gdf: gpd.GeoDataFrame,
+    chms_folder: Path,
+    chips_folder: Path,
+    target_gsd: float,
+    buffer: float,
+):
+    """
+    Write a CHM chip for each mission of each overlapping pair, limited to the overlap buffered by
+    `buffer`. Each CHM is read once at `target_gsd` for the union of all the chips it takes part
+    in, and then all of its chips are cut from that in-memory array.
+    """
+    overlay_gdf = overlay_gdf.reset_index(drop=True)
+    buffered_overlaps = overlay_gdf.buffer(buffer)
+    missions = np.unique(
+        np.concatenate(
+            (overlay_gdf["mission_id_1"].values, overlay_gdf["mission_id_2"].values)
+        )
+    )
+
+    for mission in missions:
+        chm_file = Path(chms_folder, f"{mission}.tif")
+        if not chm_file.is_file():
+            print(f"Missing CHM for {mission}, not extracting chips")
+            continue
+
+        # These describe the inputs and settings used to create the chip
+        tags = {
+            "source_fingerprint": get_file_fingerprint(chm_file),
+            "target_gsd": str(target_gsd),
+            "buffer": str(buffer),
+        }
+        # The pairs which involve this mission and are not up to date
+        in_pair = (overlay_gdf["mission_id_1"] == mission) | (
+            overlay_gdf["mission_id_2"] == mission
+        )
+        chip_files = {
+            i: get_chip_file(
+                chips_folder,
+                overlay_gdf.loc[i, "mission_id_1"],
+                overlay_gdf.loc[i, "mission_id_2"],
+                mission,
+            )
+            for i in np.where(in_pair)[0]
+        }
+        chip_files = {
+            i: f for i, f in chip_files.items() if not is_chip_current(f, tags)
+        }
+        if len(chip_files) == 0:
+            continue
+
+        # Read the whole region required by this mission once
+        ensure_overviews(chm_file)
+        union_bounds = shapely.total_bounds(buffered_overlaps.values[list(chip_files)])
+        data, transform, crs = read_chm_window(
+            chm_file,
+            bounds=union_bounds,
+            bounds_crs=overlay_gdf.crs,
+            target_gsd=target_gsd,
+        )
+
+        for i, chip_file in chip_files.items():
+            # Cut the chip for this pair out of the data that was read
+            chip_bounds = transform_bounds(
+                overlay_gdf.crs, crs, *buffered_overlaps.values[i].bounds
+            )
+            window = from_bounds(*chip_bounds, transform=transform)
+            window = window.intersection(Window(0, 0, data.shape[1], data.shape[0]))
+            window = window.round_offsets().round_lengths()
+            chip = data[window.toslices()]
+
+            write_chip(
+                chip,
+                transform=window_transform(window, transform),
+                crs=crs,
+                output_file=chip_file,
+                tags=tags,
+            )
@@ -0,0 +1,270 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import scipy.sparse.linalg
+
+# Iterative updates which take more iterations than this fall back to a new factorization
+MAX_INCREMENTAL_ITERATIONS = 100
+
+
+class GlobalShiftSolver:
+    """
+    Solve for one shift per mission from a set of pairwise shifts using weighted least squares.
+
+    The problem minimizes the sum over pairs of (w_ij * ||s_j - s_i - d_ij||)^2 plus the sum over
+    missions of (w_i * ||s_i||)^2, where d_ij is the shift that maps mission j onto mission i and
+    w_i keeps each mission close to its current location. The normal equations are stored as a
+    sparse matrix which is shared by the x and y components.
+
+    Missions and pairs can be added, changed or removed after solving. The next solve then starts
+    from the previous solution and uses the previous factorization as a preconditioner, so only a
+    few iterations are needed instead of solving from scratch.
+    """
+
+    def __init__(self, current_location_weight: float):
+        self.current_location_weight = current_location_weight
+        self.mission_ids = []
+        self.mission_inds = {}
+        # Accumulated normal equations, as a dict of keys matrix so it's cheap to update
+        self.normal = scipy.sparse.dok_matrix((0, 0))
+        self.rhs = np.zeros((0, 2))
+        # Maps from (mission_id_1, mission_id_2) to (shift, weight)
+        self.pairs = {}
+        self.solution = np.zeros((0, 2))
+        # Whether the solution can be used as the starting point for the next solve
+        self.has_solution = False
+        # Factorization of the normal matrix from the last full solve
+        self.factor = None
+        self.factor_size = 0
+        # Whether the normal matrix has changed since it was factorized
+        self.factor_is_stale = True
+
+    def add_missions(self, mission_ids):
+        new_ids = [m for m in dict.fromkeys(mission_ids) if m not in self.mission_inds]
+        if len(new_ids) == 0:
+            return
+        n_old = len(self.mission_ids)
+        n_new = n_old + len(new_ids)
+        for i, mission_id in enumerate(new_ids, start=n_old):
+            self.mission_inds[mission_id] = i
+        self.mission_ids.extend(new_ids)
+
+        self.normal.resize((n_new, n_new))
+        self.factor_is_stale = True
+        for i in range(n_old, n_new):
+            self.normal[i, i] += self.current_location_weight**2
+        self.rhs = np.concatenate((self.rhs, np.zeros((len(new_ids), 2))))
+        # New missions start at their current location
+        self.solution = np.concatenate((self.solution, np.zeros((len(new_ids), 2))))
+
+    def _apply_pair(self, pair, shift, weight, sign):
+        i = self.mission_inds[pair[0]]
+        j = self.mission_inds[pair[1]]
+        w2 = sign * weight**2
+        self.factor_is_stale = True
+        self.normal[i, i] += w2
+        self.normal[j, j] += w2
+        self.normal[i, j] -= w2
+        self.normal[j, i] -= w2
+        self.rhs[j] += w2 * np.asarray(shift)
+        self.rhs[i] -= w2 * np.asarray(shift)
+
+    def add_pairs(self, shifts: dict, weights: dict = None):
+        """
+        Add or update pairwise shifts.
+
+        Args:
+            shifts (dict): Maps (mission_id_1, mission_id_2) to the (x, y) shift from mission 2 to
+                mission 1
+            weights (dict, optional): Maps the same keys to a weight. Defaults to 1.
+        """
+        self.add_missions([m for pair in shifts for m in pair])
+        for pair, shift in shifts.items():
+            weight = 1.0 if weights is None else weights[pair]
+            # Replace the existing contribution if this pair is being updated
+            if pair in self.pairs:
+                self._apply_pair(pair, *self.pairs[pair], sign=-1)
+            self._apply_pair(pair, shift, weight, sign=1)
+            self.pairs[pair] = (tuple(float(s) for s in shift), weight)
+
+    def remove_pairs(self, pairs):
+        for pair in pairs:
+            self._apply_pair(pair, *self.pairs.pop(pair), sign=-1)
+
+    def update_pairs(self, shifts: dict, weights: dict = None):
+        """Make the pairs match `shifts`, only touching the ones which differ"""
+        self.remove_pairs([pair for pair in self.pairs if pair not in shifts])
+        changed = {
+            pair: shift
+            for pair, shift in shifts.items()
+            if pair not in self.pairs
+            or self.pairs[pair]
+            != (
+                tuple(float(s) for s in shift),
+                1.0 if weights is None else weights[pair],
+            )
+        }
+        self.add_pairs(changed, weights)
+
+    def _factorize(self, normal):
+        self.factor = scipy.sparse.linalg.splu(normal)
+        self.factor_size = normal.shape[0]
+        self.factor_is_stale = False
+
+    def _preconditioner(self, normal):
+        """
+        Use the last factorization for the missions it covers and the diagonal for the rest. The
+        factorization may be stale, which only slows down the convergence.
+        """
+        n_factored = self.factor_size
+        diagonal = normal.diagonal()
+
+        def apply(x):
+            y = x / diagonal
+            if n_factored > 0:
+                y[:n_factored] = self.factor.solve(x[:n_factored])
+            return y
+
+        return scipy.sparse.linalg.LinearOperator(normal.shape, matvec=apply)
+
+    def solve(self):
+        """
+        Solve for the shift of every mission.
+
+        Returns:
+            dict: Maps mission ID to the [x, y] shift
+        """
+        normal = self.normal.tocsc()
+        if not self.has_solution:
+            self._factorize(normal)
+            self.solution = self.factor.solve(self.rhs)
+        else:
+            # Start from the previous solution. Only the part of the problem that changed needs
+            # to be corrected, which the preconditioned conjugate gradient does quickly.
+            preconditioner = self._preconditioner(normal)
+            solution = np.empty_like(self.rhs)
+            for axis in range(2):
+                solution[:, axis], info = scipy.sparse.linalg.cg(
+                    normal,
+                    self.rhs[:, axis],
+                    x0=self.solution[:, axis],
+                    M=preconditioner,
+                    rtol=1e-10,
+                    maxiter=MAX_INCREMENTAL_ITERATIONS,
+                )
+                if info != 0:
+                    break
+            if info == 0:
+                self.solution = solution
+            else:
+                print("Incremental update did not converge, refactorizing")
+                self._factorize(normal)
+                self.solution = self.factor.solve(self.rhs)
+        self.has_solution = True
+
+        return {
+            mission_id: self.solution[i].tolist()
+            for i, mission_id in enumerate(self.mission_ids)
+        }
+
+    def get_pair_residuals(self, pairs=None) -> np.ndarray:
+        """The (n_pairs, 2) discrepency between each pairwise shift and the solved shifts"""
+        pairs = list(self.pairs) if pairs is None else pairs
+        if len(pairs) == 0:
+            return np.zeros((0, 2))
+        inds_1 = np.array([self.mission_inds[p[0]] for p in pairs])
+        inds_2 = np.array([self.mission_inds[p[1]] for p in pairs])
+        shifts = np.array([self.pairs[p][0] for p in pairs])
+        return self.solution[inds_2] - self.solution[inds_1] - shifts
+
+    def get_mission_diagnostics(self) -> pd.DataFrame:
+        """
+        Summarize how well each mission's shift is supported. The variance is the diagonal of the
+        inverse normal matrix scaled by the residual variance, and is the same for x and y.
+        """
+        n_missions = len(self.mission_ids)
+        pairs = list(self.pairs)
+        residuals = self.get_pair_residuals(pairs)
+        weights = np.array([self.pairs[p][1] for p in pairs])
+
+        # Estimate the variance of a unit-weight observation. The current location terms add as
+        # many observations as there are unknowns, so the pairs make up the degrees of freedom.
+        weighted_ssr = np.sum(weights[:, None] ** 2 * residuals**2)
+        unit_variance = weighted_ssr / max(2 * len(pairs), 1)
+
+        # Compute the diagonal of the inverse normal matrix in blocks to limit memory
+        normal = self.normal.tocsc()
+        # The exact inverse is needed, so any change since the last factorization requires a new one
+        if self.factor is None or self.factor_is_stale:
+            self._factorize(normal)
+        inverse_diagonal = np.empty(n_missions)
+        block_size = 256
+        for start in range(0, n_missions, block_size):
+            end = min(start + block_size, n_missions)
+            identity_block = np.zeros((n_missions, end - start))
+            identity_block[np.arange(start, end), np.arange(end - start)] = 1
+            inverse_diagonal[start:end] = self.factor.solve(identity_block)[
+                np.arange(start, end), np.arange(end - start)
+            ]
+
+        # Aggregate the pair residuals for each mission
+        residual_norms = np.linalg.norm(residuals, axis=1)
+        n_pairs = np.zeros(n_missions, dtype=int)
+        sum_squared_residual = np.zeros(n_missions)
+        max_residual = np.zeros(n_missions)
+        for pair, residual_norm in zip(pairs, residual_norms):
+            for mission_id in pair:
+                i = self.mission_inds[mission_id]
+                n_pairs[i] += 1
+                sum_squared_residual[i] += residual_norm**2
+                max_residual[i] = max(max_residual[i], residual_norm)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rms_residual = np.sqrt(sum_squared_residual / n_pairs)
+
+        return pd.DataFrame(
+            {
+                "mission_id": self.mission_ids,
+                "xshift": self.solution[:, 0],
+                "yshift": self.solution[:, 1],
+                "n_pairs": n_pairs,
+                "rms_pair_residual": rms_residual,
+                "max_pair_residual": max_residual,
+                "shift_variance": unit_variance * inverse_diagonal,
+                "shift_std": np.sqrt(unit_variance * inverse_diagonal),
+            }
+        )
+
+    def save(self, filename):
+        """Save the missions, pairs and solution so a later run can be updated incrementally"""
+        pairs = list(self.pairs)
+        Path(filename).parent.mkdir(parents=True, exist_ok=True)
+        np.savez(
+            filename,
+            current_location_weight=self.current_location_weight,
+            mission_ids=np.array(self.mission_ids, dtype=str),
+            pair_ids=np.array(pairs, dtype=str).reshape(-1, 2),
+            pair_shifts=np.array([self.pairs[p][0] for p in pairs]).reshape(-1, 2),
+            pair_weights=np.array([self.pairs[p][1] for p in pairs]),
+            solution=self.solution,
+        )
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Restore a saved solver. The factorization is not saved, so the first solve after loading
+        starts from the saved solution with a diagonal preconditioner.
+        """
+        data = np.load(filename)
+        solver = cls(float(data["current_location_weight"]))
+        solver.add_missions(data["mission_ids"].tolist())
+        pairs = [tuple(p) for p in data["pair_ids"].tolist()]
+        solver.add_pairs(
+            dict(zip(pairs, data["pair_shifts"].tolist())),
+            dict(zip(pairs, data["pair_weights"].tolist())),
+        )
+        solver.solution = data["solution"]
+        solver.has_solution = True
+        return solver
@@ -0,0 +1,150 @@
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import Affine
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+
+
+def prepare_for_fft(image):
+    """Fill nodata, remove the mean, and taper the edges to limit wraparound artifacts"""
+    image = np.asarray(image, dtype=np.float64)
+    valid = np.isfinite(image)
+    if not np.any(valid):
+        raise ValueError("No valid data to correlate")
+    # Fill missing data with the mean so it contributes nothing after the mean is removed
+    image = np.where(valid, image, np.mean(image[valid]))
+    image = image - np.mean(image)
+    window = np.outer(np.hanning(image.shape[0]), np.hanning(image.shape[1]))
+    return image * window
+
+
+def upsampled_dft(data, region_size, upsample_factor, offsets):
+    """
+    Evaluate the inverse DFT of `data` on a `region_size` square grid, sampled `upsample_factor`
+    times more finely than the original pixels and starting at `offsets`. This is done with two
+    matrix products, which is much cheaper than zero-padding the full spectrum.
+    """
+    for n_items, offset in zip(data.shape[::-1], offsets[::-1]):
+        kernel = (np.arange(region_size) - offset)[:, None] * np.fft.fftfreq(
+            n_items, upsample_factor
+        )
+        data = np.tensordot(np.exp(2j * np.pi * kernel), data, axes=(1, -1))
+    return data
+
+
+def phase_correlation(fixed, moving, max_shift=None, upsample_factor=20):
+    """
+    Estimate the translation which maps `moving` onto `fixed` using phase correlation.
+
+    Args:
+        fixed (np.ndarray): 2D image, nan for missing data
+        moving (np.ndarray): 2D image of the same shape, nan for missing data
+        max_shift (float, optional): Only consider shifts up to this many pixels in each axis
+        upsample_factor (int, optional): The shift is refined to 1/upsample_factor pixels
+
+    Returns:
+        float: shift in the row direction, in pixels
+        float: shift in the column direction, in pixels
+        float: height of the correlation peak. This is 1 for a perfect translation and close to 0
+            when there is no consistent translation, so it can be used as a confidence.
+    """
+    if fixed.shape != moving.shape:
+        raise ValueError(f"Shapes do not match: {fixed.shape} and {moving.shape}")
+
+    fixed_fft = np.fft.fft2(prepare_for_fft(fixed))
+    moving_fft = np.fft.fft2(prepare_for_fft(moving))
+    # Normalized cross power spectrum. Only the phase difference is retained.
+    cross_power = fixed_fft * np.conj(moving_fft)
+    cross_power /= np.abs(cross_power) + np.finfo(np.float64).eps
+    surface = np.real(np.fft.ifft2(cross_power))
+
+    # The signed shift represented by each row and column of the periodic surface
+    row_shifts = np.fft.fftfreq(fixed.shape[0], d=1 / fixed.shape[0])
+    col_shifts = np.fft.fftfreq(fixed.shape[1], d=1 / fixed.shape[1])
+    if max_shift is not None:
+        # Exclude peaks corresponding to implausibly large shifts
+        too_far = (np.abs(row_shifts)[:, None] > max_shift) | (
+            np.abs(col_shifts)[None, :] > max_shift
+        )
+        surface = np.where(too_far, -np.inf, surface)
+
+    peak_row, peak_col = np.unravel_index(np.argmax(surface), surface.shape)
+    shift = np.array([row_shifts[peak_row], col_shifts[peak_col]])
+    peak = float(surface[peak_row, peak_col])
+
+    if upsample_factor > 1:
+        # Refine the shift by evaluating the correlation on a fine grid spanning +/- 0.75 pixels
+        # around the integer peak
+        region_size = int(np.ceil(upsample_factor * 1.5))
+        region_center = np.fix(region_size / 2)
+        refined = np.real(
+            upsampled_dft(
+                cross_power,
+                region_size,
+                upsample_factor,
+                offsets=region_center - shift * upsample_factor,
+            )
+        )
+        refined_peak = np.unravel_index(np.argmax(refined), refined.shape)
+        shift = shift + (np.array(refined_peak) - region_center) / upsample_factor
+        # Normalize the same way as the inverse FFT
+        peak = float(np.max(refined) / cross_power.size)
+
+    return float(shift[0]), float(shift[1]), peak
+
+
+def read_on_grid(src, crs, transform, width, height):
+    """
+    Resample a raster onto the given grid, with nan for nodata. Averaging avoids aliasing when the
+    grid is coarser than the raster, such as for the coarse levels of a pyramid.
+    """
+    with WarpedVRT(
+        src,
+        crs=crs,
+        transform=transform,
+        width=width,
+        height=height,
+        resampling=Resampling.average,
+    ) as vrt:
+        data = vrt.read(1, masked=True)
+    return data.astype(np.float64).filled(np.nan)
+
+
+def phase_correlation_register(fixed_file, moving_file, target_GSD, max_shift=None):
+    """
+    Register two rasters using phase correlation over their shared extent, resampled to
+    `target_GSD` in the CRS of the fixed raster.
+
+    Returns:
+        tuple[float, float]: (x, y) translation which maps the moving raster onto the fixed one,
+            in the units of the fixed raster's CRS
+        float: the correlation peak height, as a confidence in the shift
+    """
+    with rasterio.open(fixed_file) as fixed_src, rasterio.open(
+        moving_file
+    ) as moving_src:
+        crs = fixed_src.crs
+        fixed_bounds = fixed_src.bounds
+        moving_bounds = transform_bounds(moving_src.crs, crs, *moving_src.bounds)
+        # Build a common grid over the intersection of the two rasters
+        left = max(fixed_bounds[0], moving_bounds[0])
+        bottom = max(fixed_bounds[1], moving_bounds[1])
+        right = min(fixed_bounds[2], moving_bounds[2])
+        top = min(fixed_bounds[3], moving_bounds[3])
+        width = int((right - left) // target_GSD)
+        height = int((top - bottom) // target_GSD)
+        if width < 2 or height < 2:
+            raise ValueError("Rasters do not overlap")
+        transform = Affine(target_GSD, 0, left, 0, -target_GSD, top)
+
+        fixed = read_on_grid(fixed_src, crs, transform, width, height)
+        moving = read_on_grid(moving_src, crs, transform, width, height)
+
+    row_shift, col_shift, peak = phase_correlation(
+        fixed,
+        moving,
+        max_shift=None if max_shift is None else max_shift / target_GSD,
+    )
+    # Rows increase downward, while y increases upward
+    return (col_shift * target_GSD, -row_shift * target_GSD), peak
@@ -0,0 +1,176 @@
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from global_shift_solver import GlobalShiftSolver
+
+
+def find_overlapping_pairs(
+    metadata: gpd.GeoDataFrame,
+    min_overlap: float,
+    year_column: str = "earliest_year_derived",
+) -> gpd.GeoDataFrame:
+    """
+    Find all pairs of missions from different years whose footprints overlap by more than
+    `min_overlap` (in the units of the CRS, squared).
+
+    An STRtree is used so that only pairs with intersecting bounding boxes are considered, and the
+    exact intersection is only computed for those candidates. The output has the same layout as
+    `GeoDataFrame.overlay`: every non-geometry column of the input with a `_1` suffix for the
+    earlier mission and a `_2` suffix for the later one, and the intersection as the geometry.
+    """
+    geometries = np.asarray(metadata.geometry.values)
+    years = metadata[year_column].astype(int).to_numpy()
+
+    # Query without a predicate so only the bounding boxes are tested
+    tree = shapely.STRtree(geometries)
+    inds_1, inds_2 = tree.query(geometries)
+
+    # Only register across years. Requiring the first one to be earlier also removes the self
+    # matches and the duplicate (j, i) ordering of each pair
+    is_candidate = years[inds_1] < years[inds_2]
+    inds_1 = inds_1[is_candidate]
+    inds_2 = inds_2[is_candidate]
+
+    # Compute the exact overlap only for the candidates that survived the bounding box test
+    intersections = shapely.intersection(geometries[inds_1], geometries[inds_2])
+    has_overlap = shapely.area(intersections) > min_overlap
+    inds_1 = inds_1[has_overlap]
+    inds_2 = inds_2[has_overlap]
+    intersections = intersections[has_overlap]
+
+    # Make the output order deterministic
+    order = np.lexsort((inds_2, inds_1))
+    inds_1 = inds_1[order]
+    inds_2 = inds_2[order]
+    intersections = intersections[order]
+
+    # Build the attributes for each side of the pair
+    attributes = metadata.drop(columns=metadata.geometry.name).reset_index(drop=True)
+    attributes_1 = attributes.iloc[inds_1].add_suffix("_1").reset_index(drop=True)
+    attributes_2 = attributes.iloc[inds_2].add_suffix("_2").reset_index(drop=True)
+
+    return gpd.GeoDataFrame(
+        attributes_1.join(attributes_2),
+        geometry=intersections,
+        crs=metadata.crs,
+    )
+
+
+def get_pair_mission_indices(pairs: gpd.GeoDataFrame):
+    """Map the two missions of each pair to integer indices into the sorted unique missions"""
+    missions, inverse = np.unique(
+        np.concatenate(
+            (pairs["mission_id_1"].to_numpy(), pairs["mission_id_2"].to_numpy())
+        ),
+        return_inverse=True,
+    )
+    return missions, inverse[: len(pairs)], inverse[len(pairs) :]
+
+
+def plan_registration_pairs(
+    pairs: gpd.GeoDataFrame, n_redundant_edges: int = 1
+) -> np.ndarray:
+    """
+    Choose a subset of the overlapping pairs which is sufficient to compute the global shifts.
+    This is the maximum-overlap spanning forest of the overlap graph, plus the `n_redundant_edges`
+    largest remaining overlaps of each mission so that every mission has some redundancy.
+
+    Returns:
+        np.ndarray: boolean mask of the pairs to register
+    """
+    missions, inds_1, inds_2 = get_pair_mission_indices(pairs)
+    areas = pairs.area.to_numpy()
+    # Consider the largest overlaps first
+    order = np.argsort(-areas, kind="stable")
+
+    # Kruskal's algorithm using a union-find structure
+    parents = np.arange(len(missions))
+
+    def find_root(i):
+        while parents[i] != i:
+            # Path halving keeps the trees shallow
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    selected = np.zeros(len(pairs), dtype=bool)
+    for pair_ind in order:
+        root_1 = find_root(inds_1[pair_ind])
+        root_2 = find_root(inds_2[pair_ind])
+        if root_1 != root_2:
+            parents[root_1] = root_2
+            selected[pair_ind] = True
+
+    # Add the best remaining edges for each mission
+    spanning = selected.copy()
+    for mission_ind in range(len(missions)):
+        incident = (inds_1[order] == mission_ind) | (inds_2[order] == mission_ind)
+        candidates = order[incident & ~spanning[order]]
+        selected[candidates[:n_redundant_edges]] = True
+
+    return selected
+
+
+def plan_additional_pairs(
+    pairs: gpd.GeoDataFrame,
+    registered: np.ndarray,
+    shifts: np.ndarray,
+    max_shift: float,
+    residual_threshold: float,
+    solver: GlobalShiftSolver,
+    n_additional_edges: int = 1,
+) -> np.ndarray:
+    """
+    Choose more pairs to register for the missions which are poorly supported by the pairs which
+    have been registered so far. A mission is poorly supported if it has fewer than two usable
+    pairwise shifts or if any of its pairwise shifts disagree with the least squares solution by
+    more than `residual_threshold`.
+
+    Args:
+        pairs (gpd.GeoDataFrame): All candidate pairs
+        registered (np.ndarray): Boolean mask of the pairs which have been registered
+        shifts (np.ndarray): (n_pairs, 2) shifts, only used where `registered` is True
+        max_shift (float): Shifts larger than this are outliers and are not used
+        residual_threshold (float): Largest acceptable residual for a well supported mission
+        solver (GlobalShiftSolver): Solver which is updated with the usable shifts. Reusing the
+            same solver between calls allows it to be updated incrementally.
+        n_additional_edges (int, optional): How many pairs to add per poorly supported mission
+
+    Returns:
+        np.ndarray: boolean mask of the pairs which should be registered next
+    """
+    missions, inds_1, inds_2 = get_pair_mission_indices(pairs)
+    # Only use the registered pairs which were successful and not outliers
+    usable = (
+        registered
+        & np.all(np.isfinite(shifts), axis=1)
+        & (np.linalg.norm(np.nan_to_num(shifts, nan=np.inf), axis=1) < max_shift)
+    )
+    pair_ids = list(zip(pairs["mission_id_1"], pairs["mission_id_2"]))
+    usable_ids = [pair_ids[i] for i in np.where(usable)[0]]
+    solver.update_pairs({pair_ids[i]: shifts[i] for i in np.where(usable)[0]})
+    solver.solve()
+    residuals = np.full(len(pairs), np.nan)
+    residuals[usable] = np.linalg.norm(solver.get_pair_residuals(usable_ids), axis=1)
+
+    # Count the usable pairs and the worst residual for each mission
+    n_usable = np.bincount(inds_1[usable], minlength=len(missions)) + np.bincount(
+        inds_2[usable], minlength=len(missions)
+    )
+    worst_residual = np.zeros(len(missions))
+    np.maximum.at(worst_residual, inds_1[usable], residuals[usable])
+    np.maximum.at(worst_residual, inds_2[usable], residuals[usable])
+    poorly_supported = np.where((n_usable < 2) | (worst_residual > residual_threshold))[
+        0
+    ]
+
+    # For each poorly supported mission, add the unregistered pairs with the largest overlap
+    order = np.argsort(-pairs.area.to_numpy(), kind="stable")
+    additional = np.zeros(len(pairs), dtype=bool)
+    for mission_ind in poorly_supported:
+        incident = (inds_1[order] == mission_ind) | (inds_2[order] == mission_ind)
+        candidates = order[incident & ~registered[order]]
+        additional[candidates[:n_additional_edges]] = True
+
+    return additional
@@ -0,0 +1,108 @@
+import os
+import subprocess
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import rasterio
+from rasterio.dtypes import dtype_rev, typename_fwd
+from rasterio.enums import MaskFlags
+from rasterio.transform import Affine
+
+
+def get_shifted_transform(transform, shift):
+    """Translate a geotransform by (xshift, yshift) in the units of the CRS"""
+    return Affine.translation(shift[0], shift[1]) * transform
+
+
+def write_shifted_vrt(input_file, output_file, shift):
+    """
+    Write a VRT which exposes the pixels of `input_file` unchanged, but with the geotransform
+    translated by `shift`. No pixel data is copied, so this is cheap regardless of the raster size.
+    Overviews of the input are used transparently when the VRT is read at lower resolution. The
+    input is referenced relative to the VRT, so the VRT keeps working if the folder containing
+    both of them is moved.
+    """
+    input_file = Path(input_file).resolve()
+    source_filename = os.path.relpath(input_file, Path(output_file).resolve().parent)
+    with rasterio.open(input_file) as src:
+        transform = get_shifted_transform(src.transform, shift)
+        block_shapes = src.block_shapes
+
+        dataset = ET.Element(
+            "VRTDataset", rasterXSize=str(src.width), rasterYSize=str(src.height)
+        )
+        if src.crs is not None:
+            ET.SubElement(dataset, "SRS").text = src.crs.to_wkt()
+        ET.SubElement(dataset, "GeoTransform").text = ", ".join(
+            repr(float(x)) for x in transform.to_gdal()
+        )
+
+        for band_ind, (dtype, nodata, colorinterp) in enumerate(
+            zip(src.dtypes, src.nodatavals, src.colorinterp), start=1
+        ):
+            band = ET.SubElement(
+                dataset,
+                "VRTRasterBand",
+                dataType=typename_fwd[dtype_rev[dtype]],
+                band=str(band_ind),
+            )
+            if nodata is not None:
+                ET.SubElement(band, "NoDataValue").text = repr(float(nodata))
+            ET.SubElement(band, "ColorInterp").text = colorinterp.name.capitalize()
+
+            source = ET.SubElement(band, "SimpleSource")
+            ET.SubElement(source, "SourceFilename", relativeToVRT="1").text = (
+                source_filename
+            )
+            ET.SubElement(source, "SourceBand").text = str(band_ind)
+            ET.SubElement(
+                source,
+                "SourceProperties",
+                RasterXSize=str(src.width),
+                RasterYSize=str(src.height),
+                DataType=typename_fwd[dtype_rev[dtype]],
+                BlockXSize=str(block_shapes[band_ind - 1][1]),
+                BlockYSize=str(block_shapes[band_ind - 1][0]),
+            )
+            rect = {
+                "xOff": "0",
+                "yOff": "0",
+                "xSize": str(src.width),
+                "ySize": str(src.height),
+            }
+            ET.SubElement(source, "SrcRect", **rect)
+            ET.SubElement(source, "DstRect", **rect)
+
+        # Carry over a per-dataset mask, such as the internal mask of an orthomosaic
+        if MaskFlags.per_dataset in src.mask_flag_enums[0] and not any(
+            flag in src.mask_flag_enums[0]
+            for flag in (MaskFlags.alpha, MaskFlags.nodata)
+        ):
+            mask_band = ET.SubElement(
+                ET.SubElement(dataset, "MaskBand"), "VRTRasterBand", dataType="Byte"
+            )
+            source = ET.SubElement(mask_band, "SimpleSource")
+            ET.SubElement(source, "SourceFilename", relativeToVRT="1").text = (
+                source_filename
+            )
+            ET.SubElement(source, "SourceBand").text = "mask,1"
+            ET.SubElement(source, "SrcRect", **rect)
+            ET.SubElement(source, "DstRect", **rect)
+
+    Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+    ET.ElementTree(dataset).write(output_file)
+
+
+def write_shifted_reflink(input_file, output_file, shift):
+    """
+    Copy `input_file` and translate the geotransform of the copy by `shift`. The copy is a reflink
+    on filesystems which support it, so the pixel data is shared with the input. The geotransform
+    is then updated in place, which only rewrites the GeoTIFF header.
+    """
+    Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+    # Falls back to a regular copy if reflinks are not supported
+    subprocess.run(
+        ["cp", "--reflink=auto", str(input_file), str(output_file)], check=True
+    )
+    with rasterio.open(output_file, "r+") as dst:
+        dst.transform = get_shifted_transform(dst.transform, shift)
@@ -1,6 +1,5 @@
 import sys
 from pathlib import Path
-from mmseg_utils.dataset_creation.folder_to_cityscapes import folder_to_cityscapes
 
 # Add folder where constants.py is to system search path
 sys.path.append(str(Path(Path(__file__).parent, "..").resolve()))
@@ -10,6 +9,7 @@ from constants import (
     TRAINING_LABELS_FOLDER,
     CITYSCAPES_FORMATTED_TRAINING_DATA,
 )
+from dataset_builder import build_dataset
 
 # The file extensions to include
 IMAGE_EXT = ["jpg", "JPG", "jpeg"]
@@ -17,14 +17,29 @@ IMAGE_EXT = ["jpg", "JPG", "jpeg"]
 TRAIN_FRAC = 0.8
 # What fraction of the data should be included in the validation set
 VAL_FRAC = 0.2
+# Maps from the class ID in the annotations to the class ID used for training. IDs which are not
+# included are ignored during training. If None, the IDs are used as they are.
+CLASS_REMAP = None
+# How PNG images are placed in the dataset. "hardlink" falls back to "symlink" if the dataset is on
+# a different filesystem than the images. "copy" always makes a full copy. Other images, such as
+# JPEGs, are always converted to PNG.
+LINK_MODE = "hardlink"
+# How many multiprocessing suprocesses to run. If None, no multiprocessing will be used.
+N_MULTIPROCESSING_PROCESSES = 8
 
-# Run the conversion
-folder_to_cityscapes(
-    images_folder=TRAINING_IMAGES_FOLDER,
-    labels_folder=TRAINING_LABELS_FOLDER,
-    output_folder=CITYSCAPES_FORMATTED_TRAINING_DATA,
-    classes=CLASS_NAMES,
-    image_ext=IMAGE_EXT,
-    train_frac=TRAIN_FRAC,
-    val_frac=VAL_FRAC,
-)
+if __name__ == "__main__":
+    # Bring the images and labels up to date, only processing the samples which changed. The
+    # split of each sample is determined by its path, so it is the same across runs. The model
+    # config is created by folder_to_cityscapes if there is no config yet.
+    build_dataset(
+        images_folder=TRAINING_IMAGES_FOLDER,
+        labels_folder=TRAINING_LABELS_FOLDER,
+        output_folder=CITYSCAPES_FORMATTED_TRAINING_DATA,
+        classes=CLASS_NAMES,
+        image_exts=IMAGE_EXT,
+        train_frac=TRAIN_FRAC,
+        val_frac=VAL_FRAC,
+        class_remap=CLASS_REMAP,
+        link_mode=LINK_MODE,
+        n_processes=N_MULTIPROCESSING_PROCESSES,
+    )
@@ -1,6 +1,6 @@
 from pathlib import Path
 import sys
-import mmseg
+import torch
 
 # Add folder where constants.py is to system search path
 sys.path.append(str(Path(Path(__file__).parent, "..").resolve()))
@@ -9,16 +9,28 @@ from constants import (
     PER_IMAGE_PREDICTIONS_FOLDER,
     WORK_DIR,
 )
+from inference_runner import run_streaming_inference
 
-# The MMSegmentation "tools" cannot be directly imported because they are not part of the module.
-# To get around this, we must determine the folder they are in and add it to the search path.
-mmseg_search_path = str(Path(Path(mmseg.__file__).parent, "..", "tools").resolve())
-sys.path.append(mmseg_search_path)
-# Import the main function from the inference script
-from inference import main as inference_main
-
-# If you run out of memory, try setting this value to 1
-INFERENCE_BATCH_SIZE = 2
+# If None, the batch size is chosen based on the available memory. If you run out of memory, try
+# setting this value to 1
+INFERENCE_BATCH_SIZE = None
+# Inference can also be run on the CPU, it's just slower
+INFERENCE_DEVICE = "cuda:0" if torch.cuda.is_available() else "cpu"
+# How many threads to use for decoding images while the model is running
+N_DECODE_THREADS = 4
+# The scale to write the predictions at. Full resolution predictions (1) are what geograypher's
+# projection expects. Setting this to AGGREGATION_IMAGE_SCALE writes much smaller predictions,
+# averaging the class probabilities over each output pixel, but they can only be projected with
+# PROJECTION_ENGINE = "visibility_cache" in 1_project_labels.py.
+PREDICTION_OUTPUT_SCALE = 1
+# How to store the predictions. "files" writes one .png per image. "hdf5" packs all the predictions
+# for a mission into one file, which is much faster to read on network filesystems, but requires
+# h5py and can only be projected with PROJECTION_ENGINE = "visibility_cache" in 1_project_labels.py.
+PREDICTION_STORAGE = "files"
+# Compression for "hdf5" storage. If None, the files are larger but can be memory mapped.
+PREDICTION_COMPRESSION = "gzip"
+# Also store the class probabilities, quantized to 8 bits. Only supported by "hdf5" storage.
+SAVE_PROBABILITIES = False
 
 # Determine the path to the single config file in the formatted training directory
 config_files = list(WORK_DIR.glob("*.py"))
@@ -28,11 +40,17 @@ config_file = config_files[0]
 # Compute the path to the checkpoint
 checkpoint_file = Path(WORK_DIR, "iter_10000.pth")
 
-# Run inference
-inference_main(
-    config_path=str(config_file),
-    checkpoint_path=str(checkpoint_file),
+# Run inference, skipping images that have already been predicted with this checkpoint
+run_streaming_inference(
+    config_file=config_file,
+    checkpoint_file=checkpoint_file,
     image_folder=ALL_IMAGES_FOLDER,
     output_folder=PER_IMAGE_PREDICTIONS_FOLDER,
+    device=INFERENCE_DEVICE,
     batch_size=INFERENCE_BATCH_SIZE,
+    n_decode_threads=N_DECODE_THREADS,
+    output_scale=PREDICTION_OUTPUT_SCALE,
+    storage=PREDICTION_STORAGE,
+    compression=PREDICTION_COMPRESSION,
+    save_probabilities=SAVE_PROBABILITIES,
 )
@@ -0,0 +1,414 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+from file_fingerprints import get_file_fingerprint
+from mmseg_utils.dataset_creation.folder_to_cityscapes import folder_to_cityscapes
+from PIL import Image
+
+# Written to the output folder to record which sources each output was built from
+MANIFEST_FILENAME = "dataset_manifest.json"
+# The Cityscapes folders for the images and labels of each split
+IMAGES_SUBFOLDER = "leftImg8bit"
+LABELS_SUBFOLDER = "gtFine"
+# The suffixes which MMSegmentation's Cityscapes dataset uses if the config does not set them
+DEFAULT_IMAGE_SUFFIX = "_leftImg8bit.png"
+DEFAULT_LABEL_SUFFIX = "_gtFine_labelTrainIds.png"
+# How many samples are converted by folder_to_cityscapes to create the config
+N_CONFIG_SAMPLES = 10
+# The class ID for pixels which should not be used for training
+IGNORE_INDEX = 255
+
+
+def hash_file(filename, block_size=2**20):
+    hasher = hashlib.sha1()
+    with open(filename, "rb") as infile:
+        while block := infile.read(block_size):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def get_split(relative_path, train_frac, val_frac):
+    """
+    Assign a sample to "train", "val" or "test" based on a hash of its path. This is deterministic
+    and does not depend on which other samples are present, so adding annotations never moves an
+    existing sample to a different split.
+    """
+    fraction = int(hashlib.sha1(relative_path.encode()).hexdigest()[:8], 16) / 16**8
+    if fraction < train_frac:
+        return "train"
+    if fraction < train_frac + val_frac:
+        return "val"
+    return "test"
+
+
+def get_output_files(output_folder, relative_path, split, image_suffix, label_suffix):
+    """The image and label files for a sample, with the folder structure flattened into the name"""
+    name = Path(relative_path).with_suffix("").as_posix().replace("/", "_")
+    return (
+        Path(output_folder, IMAGES_SUBFOLDER, split, name + image_suffix),
+        Path(output_folder, LABELS_SUBFOLDER, split, name + label_suffix),
+    )
+
+
+def get_config_suffixes(config_file):
+    """
+    The image and label suffixes set in a model config, or the defaults of the Cityscapes dataset
+    if they are not set
+    """
+    config = Path(config_file).read_text()
+    suffixes = []
+    for key, default in (
+        ("img_suffix", DEFAULT_IMAGE_SUFFIX),
+        ("seg_map_suffix", DEFAULT_LABEL_SUFFIX),
+    ):
+        match = re.search(rf"{key}\s*=\s*['\"]([^'\"]+)['\"]", config)
+        suffixes.append(default if match is None else match.group(1))
+    return suffixes
+
+
+def create_config(samples, output_folder, classes, image_exts, train_frac, val_frac):
+    """
+    Create the model config with `folder_to_cityscapes`, without running the full conversion. A
+    few of the samples are converted into a temporary folder, and the data root of the resulting
+    config is pointed at `output_folder`. The temporary folder is then removed, so none of the
+    files written by `folder_to_cityscapes` are left in the dataset.
+
+    Returns:
+        Path: The config file in `output_folder`
+    """
+    with tempfile.TemporaryDirectory(dir=output_folder) as tmp_folder:
+        tmp_images_folder = Path(tmp_folder, "images")
+        tmp_labels_folder = Path(tmp_folder, "labels")
+        tmp_output_folder = Path(tmp_folder, "formatted")
+        for relative_path, (image_file, label_file) in list(samples.items())[
+            :N_CONFIG_SAMPLES
+        ]:
+            for source, folder in (
+                (image_file, tmp_images_folder),
+                (label_file, tmp_labels_folder),
+            ):
+                link = Path(folder, relative_path).with_suffix(source.suffix)
+                link.parent.mkdir(parents=True, exist_ok=True)
+                os.symlink(Path(source).resolve(), link)
+
+        folder_to_cityscapes(
+            images_folder=tmp_images_folder,
+            labels_folder=tmp_labels_folder,
+            output_folder=tmp_output_folder,
+            classes=classes,
+            image_ext=image_exts,
+            train_frac=train_frac,
+            val_frac=val_frac,
+        )
+        tmp_config_files = list(tmp_output_folder.glob("*.py"))
+        if len(tmp_config_files) != 1:
+            raise ValueError("folder_to_cityscapes did not create a single config file")
+        config = tmp_config_files[0].read_text()
+        if str(tmp_output_folder) not in config:
+            raise ValueError("Could not find the data root in the created config")
+        config_file = Path(output_folder, tmp_config_files[0].name)
+        config_file.write_text(
+            config.replace(str(tmp_output_folder), str(output_folder))
+        )
+    return config_file
+
+
+def link_file(source, destination, link_mode):
+    """
+    Make `destination` refer to `source` without copying if possible. Hardlinks fall back to
+    symlinks when the two are on different filesystems.
+    """
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    destination.unlink(missing_ok=True)
+    if link_mode == "hardlink":
+        try:
+            os.link(source, destination)
+            return
+        except OSError:
+            link_mode = "symlink"
+    if link_mode == "symlink":
+        os.symlink(Path(source).resolve(), destination)
+    elif link_mode == "copy":
+        shutil.copy2(source, destination)
+    else:
+        raise ValueError(f"Unknown link mode {link_mode}")
+
+
+def save_png(image, output_file):
+    """Save as a PNG, to a temporary file first so an interrupted run never leaves a partial file"""
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = output_file.with_name(output_file.name + ".tmp")
+    image.save(tmp_file, format="PNG")
+    os.replace(tmp_file, output_file)
+
+
+def write_image(image_file, output_file, link_mode):
+    """
+    PNG images are placed in the dataset with `link_file`. Other formats, such as JPEG, are
+    converted to PNG so the content matches the suffix.
+    """
+    if Path(image_file).suffix.lower() == ".png":
+        link_file(image_file, output_file, link_mode)
+    else:
+        with Image.open(image_file) as image:
+            save_png(image, output_file)
+
+
+def read_label(label_file):
+    """
+    Read the class IDs of a label. Palette images give the palette index of each pixel, and RGB
+    labels must have the class ID in every channel.
+    """
+    with Image.open(label_file) as image:
+        label = np.asarray(image)
+    if label.ndim == 3:
+        # Any alpha channel is ignored
+        channels = label[..., :3]
+        if not np.all(channels == channels[..., :1]):
+            raise ValueError(
+                f"RGB labels must have the same class ID in each channel: {label_file}"
+            )
+        label = channels[..., 0]
+    return label
+
+
+def remap_label(label_file, output_file, remap_lut):
+    """Write the label as a single-channel PNG, with the class IDs remapped through `remap_lut`"""
+    label = read_label(label_file)
+    if remap_lut is not None:
+        label = remap_lut[label]
+    save_png(Image.fromarray(label.astype(np.uint8)), output_file)
+
+
+def build_remap_lut(class_remap):
+    """Lookup table from the original to the new class ID. Unmapped IDs become IGNORE_INDEX."""
+    if class_remap is None:
+        return None
+    lut = np.full(256, IGNORE_INDEX, dtype=np.uint8)
+    for original_id, new_id in class_remap.items():
+        lut[original_id] = new_id
+    return lut
+
+
+def process_sample(
+    image_file,
+    label_file,
+    image_output,
+    label_output,
+    previous_entry,
+    remap_lut,
+    link_mode,
+):
+    """
+    Bring the outputs of one sample up to date. The sources are hashed, and the outputs are only
+    rebuilt if the hashes differ from `previous_entry`.
+
+    Returns:
+        dict: The manifest entry for this sample
+    """
+    entry = {
+        "image_hash": hash_file(image_file),
+        "label_hash": hash_file(label_file),
+        "image_fingerprint": get_file_fingerprint(image_file),
+        "label_fingerprint": get_file_fingerprint(label_file),
+        "image_output": str(image_output),
+        "label_output": str(label_output),
+    }
+    previous_entry = previous_entry or {}
+    outputs_exist = image_output.exists() and label_output.is_file()
+
+    if not (
+        outputs_exist
+        and previous_entry.get("image_hash") == entry["image_hash"]
+        and previous_entry.get("image_output") == entry["image_output"]
+    ):
+        write_image(image_file, image_output, link_mode)
+    if not (
+        outputs_exist
+        and previous_entry.get("label_hash") == entry["label_hash"]
+        and previous_entry.get("label_output") == entry["label_output"]
+    ):
+        remap_label(label_file, label_output, remap_lut)
+    return entry
+
+
+def find_samples(images_folder, labels_folder, image_exts, label_ext=".png"):
+    """
+    Find the images which have a label at the same relative path.
+
+    Returns:
+        dict: Maps the relative path of the image to the (image_file, label_file)
+    """
+    samples = {}
+    n_unlabeled = 0
+    for image_file in sorted(Path(images_folder).rglob("*")):
+        if image_file.suffix.lstrip(".") not in image_exts:
+            continue
+        relative_path = image_file.relative_to(images_folder)
+        label_file = Path(labels_folder, relative_path).with_suffix(label_ext)
+        if not label_file.is_file():
+            n_unlabeled += 1
+            continue
+        samples[relative_path.as_posix()] = (image_file, label_file)
+    if n_unlabeled > 0:
+        print(f"Skipping {n_unlabeled} images without a label")
+    return samples
+
+
+def read_manifest(output_folder):
+    manifest_file = Path(output_folder, MANIFEST_FILENAME)
+    if not manifest_file.is_file():
+        return {}
+    with open(manifest_file, "r") as infile:
+        return json.load(infile)
+
+
+def write_manifest(output_folder, manifest):
+    manifest_file = Path(output_folder, MANIFEST_FILENAME)
+    tmp_file = manifest_file.with_suffix(".json.tmp")
+    with open(tmp_file, "w") as outfile:
+        json.dump(manifest, outfile, indent=1, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+
+def build_dataset(
+    images_folder,
+    labels_folder,
+    output_folder,
+    classes,
+    image_exts,
+    train_frac=0.8,
+    val_frac=0.2,
+    class_remap=None,
+    link_mode="hardlink",
+    n_processes=None,
+):
+    """
+    Create or update a Cityscapes-formatted dataset from a folder of images and a folder of labels
+    with matching relative paths. Only samples whose sources changed since the last build are
+    processed. Outputs of earlier builds which no longer correspond to a sample are removed, but
+    no other files in the output folder are touched.
+
+    Args:
+        images_folder (PathLike): Searched recursively for images
+        labels_folder (PathLike): .png labels at the same relative paths. These can be single
+            channel, palette, or RGB with the class ID in every channel.
+        output_folder (PathLike): Where to write the formatted dataset
+        classes (list[str]): Names of the classes, used to create the model config if the output
+            folder does not have one yet
+        image_exts (list[str]): Image extensions to include, without the leading "."
+        train_frac (float, optional): Fraction of the samples in the training split
+        val_frac (float, optional): Fraction of the samples in the validation split. The rest are
+            in the test split.
+        class_remap (dict, optional): Maps from the class ID in the labels to the class ID used
+            for training. IDs which are not present are ignored. Defaults to None, which is no
+            remapping.
+        link_mode (str, optional): How PNG images are placed in the dataset, "hardlink",
+            "symlink", or "copy". Other images are always converted to PNG. Defaults to
+            "hardlink".
+        n_processes (int, optional): Number of processes. If None, no multiprocessing is used.
+    """
+    output_folder = Path(output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+    samples = find_samples(images_folder, labels_folder, image_exts)
+
+    config_files = list(output_folder.glob("*.py"))
+    if len(config_files) == 0:
+        config_files = [
+            create_config(
+                samples, output_folder, classes, image_exts, train_frac, val_frac
+            )
+        ]
+    elif len(config_files) > 1:
+        raise ValueError("Config file is not unambiguous")
+    # The outputs are named so the dataset in the config finds them
+    image_suffix, label_suffix = get_config_suffixes(config_files[0])
+
+    previous_manifest = read_manifest(output_folder)
+    previous_samples = previous_manifest.get("samples", {})
+    # Changing the remapping or the link mode means every sample must be rebuilt, as do builds
+    # from before non-PNG images were converted. Round trip through JSON so the settings compare
+    # equal to the ones read from the manifest.
+    settings = json.loads(
+        json.dumps(
+            {
+                "class_remap": class_remap,
+                "link_mode": link_mode,
+                "image_format": "png",
+            }
+        )
+    )
+    reusable_samples = (
+        previous_samples if previous_manifest.get("settings") == settings else {}
+    )
+    remap_lut = build_remap_lut(class_remap)
+
+    new_samples = {}
+    tasks = {}
+    for relative_path, (image_file, label_file) in samples.items():
+        image_output, label_output = get_output_files(
+            output_folder,
+            relative_path,
+            get_split(relative_path, train_frac, val_frac),
+            image_suffix,
+            label_suffix,
+        )
+        previous_entry = reusable_samples.get(relative_path)
+        # Skip samples where neither the sources nor the outputs appear to have changed, without
+        # reading the sources
+        if (
+            previous_entry is not None
+            and previous_entry["image_fingerprint"] == get_file_fingerprint(image_file)
+            and previous_entry["label_fingerprint"] == get_file_fingerprint(label_file)
+            and previous_entry["image_output"] == str(image_output)
+            and previous_entry["label_output"] == str(label_output)
+            and image_output.exists()
+            and label_output.is_file()
+        ):
+            new_samples[relative_path] = previous_entry
+            continue
+        tasks[relative_path] = (
+            image_file,
+            label_file,
+            image_output,
+            label_output,
+            previous_entry,
+            remap_lut,
+            link_mode,
+        )
+    print(
+        f"{len(tasks)} of {len(samples)} samples are new or changed and will be processed"
+    )
+
+    if n_processes is None:
+        entries = [process_sample(*task) for task in tasks.values()]
+    else:
+        with multiprocessing.Pool(processes=n_processes) as pool:
+            entries = pool.starmap(process_sample, tasks.values(), chunksize=16)
+    new_samples.update(zip(tasks.keys(), entries))
+
+    # Remove the outputs of earlier builds which no longer correspond to a sample, such as samples
+    # which were removed from the sources or moved to a different name. Only files recorded in
+    # the manifest are removed, since those are the only ones this builder wrote.
+    current_outputs = set(
+        output
+        for entry in new_samples.values()
+        for output in (entry["image_output"], entry["label_output"])
+    )
+    n_removed = 0
+    for entry in previous_samples.values():
+        for output in (entry["image_output"], entry["label_output"]):
+            if output not in current_outputs and Path(output).is_file():
+                Path(output).unlink()
+                n_removed += 1
+    if n_removed > 0:
+        print(f"Removed {n_removed} outdated files")
+
+    write_manifest(output_folder, {"settings": settings, "samples": new_samples})
@@ -0,0 +1,364 @@
+import hashlib
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import mmcv
+import numpy as np
+import psutil
+import torch
+import torch.nn.functional as F
+from mmseg.apis import inference_model, init_model
+from file_fingerprints import get_file_fingerprint
+from PIL import Image
+from prediction_storage import (
+    PredictionStoreReader,
+    PredictionStoreWriter,
+    get_store_file,
+    write_prediction_manifest,
+)
+
+# The file extensions of the images to run inference on
+IMAGE_EXTENSIONS = (".jpg", ".JPG", ".jpeg", ".JPEG", ".png", ".PNG")
+# Rough estimate of the memory used during inference per input pixel, including activations
+BYTES_PER_PIXEL_ESTIMATE = 2000
+# Only plan to use this fraction of the available memory
+MEMORY_FRACTION = 0.5
+# The largest batch size that will be automatically chosen
+MAX_AUTO_BATCH_SIZE = 16
+
+
+def get_checkpoint_key(config_file, checkpoint_file, output_scale=1.0):
+    """
+    Short identifier for a model and output scale, based on the size and modification time of the
+    model files
+    """
+    fingerprint = "".join(
+        f"{Path(f).resolve()}-{get_file_fingerprint(f)}"
+        for f in (config_file, checkpoint_file)
+    )
+    # Keep the keys of full resolution predictions unchanged
+    if output_scale != 1:
+        fingerprint += f"-scale{output_scale}"
+    return hashlib.sha1(fingerprint.encode()).hexdigest()[:12]
+
+
+def get_output_file(output_folder, relative_image_path):
+    return Path(output_folder, relative_image_path).with_suffix(".png")
+
+
+def split_mission_path(relative_path):
+    """Split a path relative to the images folder into the mission ID and the path within it"""
+    parts = Path(relative_path).parts
+    return parts[0], Path(*parts[1:]).as_posix()
+
+
+def get_stored_paths(output_folder):
+    """
+    The relative paths of all images in the prediction stores of `output_folder`. A store which
+    cannot be read, for example because a crash interrupted a write, is renamed with a .corrupt
+    suffix so its images are predicted again.
+    """
+    stored = set()
+    for store_file in Path(output_folder).glob("*.h5"):
+        try:
+            with PredictionStoreReader(store_file) as reader:
+                stored.update(
+                    f"{store_file.stem}/{name}" for name in reader.image_names
+                )
+        except (OSError, KeyError) as e:
+            print(f"Could not read {store_file}, predicting its images again: {e}")
+            os.replace(store_file, store_file.with_suffix(".h5.corrupt"))
+    return stored
+
+
+def get_completed_log_file(output_folder, checkpoint_key):
+    """File listing the images which have been predicted with this checkpoint"""
+    return Path(output_folder, f"completed_{checkpoint_key}.txt")
+
+
+def read_completed(log_file):
+    if not log_file.is_file():
+        return set()
+    with open(log_file, "r") as infile:
+        return set(line.strip() for line in infile if line.strip())
+
+
+def choose_batch_size(device, image_shape):
+    """Choose the batch size based on the memory available to the device"""
+    if str(device).startswith("cuda"):
+        available_memory, _ = torch.cuda.mem_get_info(torch.device(device))
+    else:
+        available_memory = psutil.virtual_memory().available
+    per_image_memory = image_shape[0] * image_shape[1] * BYTES_PER_PIXEL_ESTIMATE
+    batch_size = int(available_memory * MEMORY_FRACTION // per_image_memory)
+    return int(np.clip(batch_size, 1, MAX_AUTO_BATCH_SIZE))
+
+
+def get_prediction(result, output_scale=1.0, return_probabilities=False):
+    """
+    Get the predicted class of each pixel from an mmseg result. If `output_scale` is less than one,
+    the class probabilities are averaged over the area of each output pixel and then the most
+    probable class is chosen, which is more accurate than subsampling the full resolution labels.
+
+    Returns:
+        np.ndarray: (height, width) uint8 class IDs
+        np.ndarray | None: (n_classes, height, width) class probabilities if requested
+    """
+    if output_scale == 1 and not return_probabilities:
+        return result.pred_sem_seg.data[0].cpu().numpy().astype(np.uint8), None
+
+    # The logits have already been resized to the input image
+    probabilities = torch.softmax(result.seg_logits.data.float(), dim=0)
+    if output_scale != 1:
+        output_shape = tuple(
+            max(int(round(dim * output_scale)), 1) for dim in probabilities.shape[1:]
+        )
+        probabilities = F.interpolate(
+            probabilities[None], size=output_shape, mode="area"
+        )[0]
+    labels = probabilities.argmax(dim=0).cpu().numpy().astype(np.uint8)
+    if not return_probabilities:
+        return labels, None
+    return labels, probabilities.cpu().numpy()
+
+
+def decode_batches(image_folder, relative_paths, batch_size, n_decode_threads, output):
+    """
+    Decode the images in parallel threads and put batches on the `output` queue. None is put on
+    the queue at the end, or the exception if decoding failed.
+    """
+    try:
+        with ThreadPoolExecutor(n_decode_threads) as executor:
+            for start in range(0, len(relative_paths), batch_size):
+                batch_paths = relative_paths[start : start + batch_size]
+                # BGR, which is what the mmseg pipeline expects for arrays
+                images = list(
+                    executor.map(
+                        lambda p: mmcv.imread(str(Path(image_folder, p))), batch_paths
+                    )
+                )
+                # Blocks if the model has fallen behind, which bounds the memory used
+                output.put((batch_paths, images))
+    except Exception as e:
+        output.put(e)
+        return
+    output.put(None)
+
+
+def put_while_alive(output, item, consumer, timeout=1.0):
+    """
+    Put `item` on the `output` queue, unless the `consumer` thread stops before there is space
+
+    Returns:
+        bool: Whether the item was put on the queue
+    """
+    while consumer.is_alive():
+        try:
+            output.put(item, timeout=timeout)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def write_predictions(output_folder, log_file, input, errors, storage, compression):
+    """
+    Write the predictions from the `input` queue and record each completed image. Failures are
+    appended to `errors`. After a failure writing one image the queue is still drained so the
+    model is never blocked, and if the writer cannot continue at all, such as when the log cannot
+    be written, it stops and the model stops putting predictions on the queue.
+    """
+    # Open prediction stores, by mission ID
+    stores = {}
+    try:
+        with open(log_file, "a") as log:
+            while (item := input.get()) is not None:
+                if len(errors) > 0:
+                    continue
+                relative_path, labels, probabilities = item
+                try:
+                    if storage == "hdf5":
+                        mission_id, name = split_mission_path(relative_path)
+                        if mission_id not in stores:
+                            stores[mission_id] = PredictionStoreWriter(
+                                get_store_file(output_folder, mission_id),
+                                compression=compression,
+                            )
+                        stores[mission_id].write(name, labels, probabilities)
+                    else:
+                        output_file = get_output_file(output_folder, relative_path)
+                        output_file.parent.mkdir(parents=True, exist_ok=True)
+                        Image.fromarray(labels).save(output_file)
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                # Only record the image once the prediction is fully written
+                log.write(f"{relative_path}\n")
+                log.flush()
+    except Exception as e:
+        errors.append(e)
+    finally:
+        for store in stores.values():
+            try:
+                store.close()
+            except Exception as e:
+                errors.append(e)
+
+
+def run_streaming_inference(
+    config_file,
+    checkpoint_file,
+    image_folder,
+    output_folder,
+    device="cuda:0",
+    batch_size=None,
+    n_decode_threads=4,
+    n_prefetch_batches=2,
+    output_scale=1.0,
+    storage="files",
+    compression="gzip",
+    save_probabilities=False,
+):
+    """
+    Run inference on every image in `image_folder` and write the predicted labels to
+    `output_folder`, either as one label image per input at the same relative path or packed into
+    one container per mission. Decoding, model execution and writing run concurrently
+    with bounded queues between them. Images which already have a prediction from the same
+    checkpoint are skipped, so an interrupted run can be resumed.
+
+    Args:
+        config_file (PathLike): mmseg config
+        checkpoint_file (PathLike): model weights
+        image_folder (PathLike): Folder which is searched recursively for images
+        output_folder (PathLike): Where to write the predictions
+        device (str, optional): Torch device, which can be "cpu". Defaults to "cuda:0".
+        batch_size (int, optional): If None, chosen from the available memory. Defaults to None.
+        n_decode_threads (int, optional): Threads used to decode images. Defaults to 4.
+        n_prefetch_batches (int, optional): How many decoded batches can wait for the model.
+            Defaults to 2.
+        output_scale (float, optional): Write the predictions at this fraction of the input
+            resolution. The scale is recorded in the manifest of `output_folder`. Defaults to 1.
+        storage (str, optional): "files" to write one .png per image, or "hdf5" to write one
+            container per mission, named <mission_id>.h5, where the mission ID is the top level
+            folder of the image. Defaults to "files".
+        compression (str, optional): Compression of the "hdf5" containers. If None, the
+            predictions can be memory mapped when they are read. Defaults to "gzip".
+        save_probabilities (bool, optional): Also store the class probabilities, quantized to
+            uint8. Only supported by "hdf5" storage. Defaults to False.
+    """
+    if storage not in ("files", "hdf5"):
+        raise ValueError(f"Unknown prediction storage {storage}")
+    if save_probabilities and storage != "hdf5":
+        raise ValueError("Probabilities can only be saved with hdf5 storage")
+
+    image_folder = Path(image_folder)
+    output_folder = Path(output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+
+    # Determine which images still need to be predicted with this checkpoint
+    checkpoint_key = get_checkpoint_key(config_file, checkpoint_file, output_scale)
+    log_file = get_completed_log_file(output_folder, checkpoint_key)
+    manifest = {
+        "output_scale": output_scale,
+        "checkpoint_key": checkpoint_key,
+        "storage": storage,
+    }
+    # Predictions from an earlier run, possibly at another scale, are overwritten as this run
+    # progresses. Until every image has been predicted the folder is marked as incomplete, so
+    # the projection does not read a mix of scales.
+    write_prediction_manifest(output_folder, **manifest, complete=False)
+    completed = read_completed(log_file)
+    all_relative_paths = sorted(
+        str(p.relative_to(image_folder))
+        for p in image_folder.rglob("*")
+        if p.suffix in IMAGE_EXTENSIONS
+    )
+    relative_paths = all_relative_paths
+    if storage == "hdf5":
+        stored = get_stored_paths(output_folder)
+        relative_paths = [
+            p for p in relative_paths if not (p in completed and p in stored)
+        ]
+    else:
+        relative_paths = [
+            p
+            for p in relative_paths
+            if not (p in completed and get_output_file(output_folder, p).is_file())
+        ]
+    print(f"{len(relative_paths)} images need predictions")
+    if len(relative_paths) == 0:
+        write_prediction_manifest(output_folder, **manifest, complete=True)
+        return
+
+    model = init_model(str(config_file), str(checkpoint_file), device=device)
+    if batch_size is None:
+        first_image = mmcv.imread(str(Path(image_folder, relative_paths[0])))
+        batch_size = choose_batch_size(device, first_image.shape)
+        print(f"Using a batch size of {batch_size}")
+
+    decoded_queue = queue.Queue(maxsize=n_prefetch_batches)
+    prediction_queue = queue.Queue(maxsize=n_prefetch_batches * batch_size)
+    decoder = threading.Thread(
+        target=decode_batches,
+        args=(
+            image_folder,
+            relative_paths,
+            batch_size,
+            n_decode_threads,
+            decoded_queue,
+        ),
+        daemon=True,
+    )
+    writer_errors = []
+    writer = threading.Thread(
+        target=write_predictions,
+        args=(
+            output_folder,
+            log_file,
+            prediction_queue,
+            writer_errors,
+            storage,
+            compression,
+        ),
+        daemon=True,
+    )
+    decoder.start()
+    writer.start()
+
+    n_done = 0
+    try:
+        while (batch := decoded_queue.get()) is not None:
+            if isinstance(batch, Exception):
+                raise batch
+            if len(writer_errors) > 0:
+                raise writer_errors[0]
+            batch_paths, images = batch
+            with torch.no_grad():
+                results = inference_model(model, images)
+            for relative_path, result in zip(batch_paths, results):
+                labels, probabilities = get_prediction(
+                    result, output_scale, return_probabilities=save_probabilities
+                )
+                if not put_while_alive(
+                    prediction_queue, (relative_path, labels, probabilities), writer
+                ):
+                    raise (
+                        writer_errors[0]
+                        if len(writer_errors) > 0
+                        else RuntimeError("The prediction writer stopped")
+                    )
+            n_done += len(batch_paths)
+            print(f"Predicted {n_done}/{len(relative_paths)} images")
+    finally:
+        # Let the writer finish what has been predicted so far
+        put_while_alive(prediction_queue, None, writer)
+        writer.join()
+    if len(writer_errors) > 0:
+        raise writer_errors[0]
+
+    completed = read_completed(log_file)
+    if all(p in completed for p in all_relative_paths):
+        write_prediction_manifest(output_folder, **manifest, complete=True)
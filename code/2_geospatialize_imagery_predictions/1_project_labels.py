@@ -1,8 +1,9 @@
+import json
+import os
 import sys
 from pathlib import Path
 
 import geopandas as gpd
-from geograypher.entrypoints.aggregate_images import aggregate_images
 
 # Add folder where constants.py is to system search path
 sys.path.append(str(Path(Path(__file__).parent, "..").resolve()))
@@ -10,18 +11,107 @@ from constants import (
     AGGREGATION_IMAGE_SCALE,
     ALL_IMAGES_FOLDER,
     CAMERAS_FOLDER,
+    CONFIDENCE_THRESHOLD,
     IDS_TO_LABELS,
+    MESH_CACHE_FOLDER,
     MESH_DOWNSAMPLE,
     MESHES_FOLDER,
     METADATA_FILE,
     N_CAMERAS_PER_CHUNK,
     PER_IMAGE_PREDICTIONS_FOLDER,
+    PROJECTION_ENGINE_COMPARISON_FOLDER,
+    PROJECTION_LOGS_FOLDER,
     PROJECTIONS_TO_FACES_FOLDER,
     SKIP_EXISTING,
+    VISIBILITY_CACHE_FOLDER,
 )
+from face_projection import (
+    estimate_projection_memory,
+    project_labels,
+    project_labels_with_geograypher,
+)
+from face_votes import SparseFaceVotes, compare_face_classes
+from job_scheduler import get_physical_memory, run_budgeted_jobs
+from prediction_storage import (
+    PredictionStoreReader,
+    get_store_file,
+    read_prediction_manifest,
+)
+from visibility_cache import get_visibility_index, has_visibility_cache
+
+# How to project the predictions onto the mesh. One of:
+# "geograypher": geograypher's aggregate_images, which renders the mesh on every run. This needs full
+#     resolution predictions stored as files.
+# "visibility_cache": render the face that each pixel lands on once and cache it in
+#     VISIBILITY_CACHE_FOLDER, then count the pixels of each class on each face. This is much faster
+#     when projecting new predictions and supports every prediction scale and storage, but the
+#     confidence of a face is pooled over the pixels of all the images rather than computed by
+#     geograypher, so CONFIDENCE_THRESHOLD may keep different faces. Check the agreement with
+#     COMPARISON_DATASET_IDS before switching.
+PROJECTION_ENGINE = "geograypher"
+# Missions to also project with the other engine. The agreement between the face classes of the
+# two engines at CONFIDENCE_THRESHOLD is written to PROJECTION_ENGINE_COMPARISON_FOLDER.
+COMPARISON_DATASET_IDS = []
+
+# The total memory that the projections running at once can use, in GB. If None, 80% of the
+# physical memory is used.
+PROJECTION_MEMORY_BUDGET_GB = None
+# How many cores can be used in total. If None, all the cores are used.
+N_CORES = None
+# How many cores each projection is expected to keep busy
+CORES_PER_PROJECTION = 2
+
+
+def project_with_engine(
+    engine,
+    dataset_id,
+    mesh_file,
+    cameras_file,
+    images_folder,
+    original_image_folder,
+    labels_folder,
+    prediction_store=None,
+):
+    """Project the predictions of a dataset onto its mesh with one of the PROJECTION_ENGINE options"""
+    if engine == "geograypher":
+        return project_labels_with_geograypher(
+            mesh_file,
+            cameras_file,
+            images_folder,
+            labels_folder,
+            original_image_folder=original_image_folder,
+            IDs_to_labels=IDS_TO_LABELS,
+            mesh_downsample=MESH_DOWNSAMPLE,
+            image_scale=AGGREGATION_IMAGE_SCALE,
+            n_cameras_per_chunk=N_CAMERAS_PER_CHUNK,
+        )
+    elif engine != "visibility_cache":
+        raise ValueError(f"Unknown projection engine {engine}")
+
+    # Load the face that each pixel of each camera lands on. This is only computed the first time,
+    # since it does not depend on the predictions.
+    visibility_index = get_visibility_index(
+        VISIBILITY_CACHE_FOLDER,
+        MESH_CACHE_FOLDER,
+        dataset_id,
+        mesh_file,
+        cameras_file,
+        images_folder,
+        original_image_folder,
+        image_scale=AGGREGATION_IMAGE_SCALE,
+        mesh_downsample=MESH_DOWNSAMPLE,
+    )
+    # Predictions written at the aggregation scale are used directly, and others are resampled
+    # to it
+    return project_labels(
+        visibility_index,
+        n_classes=max(IDS_TO_LABELS.keys()) + 1,
+        labels_folder=labels_folder,
+        prediction_store=prediction_store,
+    )
 
 
-def project_dataset(dataset_id, skip_existings=False):
+def project_dataset(dataset_id, prediction_storage="files", skip_existings=False):
     # Compute relavent paths based on dataset
     # Path to the raw images
     images_folder = Path(ALL_IMAGES_FOLDER, dataset_id)
@@ -30,45 +120,157 @@ def project_dataset(dataset_id, skip_existings=False):
     original_image_folder = Path("/data/03_input-images", dataset_id)
     # Path to the predictions from the model
     labels_folder = Path(PER_IMAGE_PREDICTIONS_FOLDER, dataset_id)
+    # Or the container of predictions for this dataset
+    store_file = get_store_file(PER_IMAGE_PREDICTIONS_FOLDER, dataset_id)
 
     # Path to input photogrammetry products
     mesh_file = Path(MESHES_FOLDER, f"{dataset_id}.ply")
     cameras_file = Path(CAMERAS_FOLDER, f"{dataset_id}.xml")
     # Output files for the per-face result
-    predicted_face_values_file = Path(PROJECTIONS_TO_FACES_FOLDER, f"{dataset_id}.npy")
+    predicted_face_votes_folder = Path(PROJECTIONS_TO_FACES_FOLDER, dataset_id)
 
     # Check if labels are present
-    if not Path(labels_folder).is_dir():
+    if prediction_storage == "hdf5":
+        if not store_file.is_file():
+            print(f"Skipping {dataset_id} due to missing predictions {store_file}")
+            return
+    elif not Path(labels_folder).is_dir():
         print(f"Skipping {dataset_id} due to missing folder of labels {labels_folder}")
         return
 
     # If we're going to skip existing results, check if they have already been computed
-    if skip_existings and predicted_face_values_file.is_file():
+    if skip_existings and SparseFaceVotes.exists(predicted_face_votes_folder):
         print(f"Dataset {dataset_id} exists already. Skipping")
         return
 
-    # Actually run the aggregation step
     print(f"Running {dataset_id}")
-    aggregate_images(
-        mesh_file,
-        cameras_file,
-        images_folder,
-        labels_folder,
-        original_image_folder=original_image_folder,
-        IDs_to_labels=IDS_TO_LABELS,
-        aggregated_face_values_savefile=predicted_face_values_file,
-        mesh_downsample=MESH_DOWNSAMPLE,
-        aggregate_image_scale=AGGREGATION_IMAGE_SCALE,
-        take_every_nth_camera=1,
-        n_cameras_per_aggregation_cluster=N_CAMERAS_PER_CHUNK,
+    prediction_store = (
+        PredictionStoreReader(store_file) if prediction_storage == "hdf5" else None
     )
+    try:
+        face_votes = project_with_engine(
+            PROJECTION_ENGINE,
+            dataset_id,
+            mesh_file,
+            cameras_file,
+            images_folder,
+            original_image_folder,
+            labels_folder,
+            prediction_store,
+        )
+        face_votes.save(predicted_face_votes_folder)
 
+        if dataset_id in COMPARISON_DATASET_IDS:
+            other_engine = (
+                "visibility_cache"
+                if PROJECTION_ENGINE == "geograypher"
+                else "geograypher"
+            )
+            print(f"Comparing {dataset_id} with the {other_engine} engine")
+            other_face_votes = project_with_engine(
+                other_engine,
+                dataset_id,
+                mesh_file,
+                cameras_file,
+                images_folder,
+                original_image_folder,
+                labels_folder,
+                prediction_store,
+            )
+            other_face_votes.save(
+                Path(PROJECTION_ENGINE_COMPARISON_FOLDER, other_engine, dataset_id)
+            )
+            comparison = {
+                "engine_1": PROJECTION_ENGINE,
+                "engine_2": other_engine,
+                **compare_face_classes(
+                    face_votes, other_face_votes, CONFIDENCE_THRESHOLD
+                ),
+            }
+            print(comparison)
+            with open(
+                Path(PROJECTION_ENGINE_COMPARISON_FOLDER, f"{dataset_id}.json"), "w"
+            ) as outfile:
+                json.dump(comparison, outfile, indent=4)
+    finally:
+        if prediction_store is not None:
+            prediction_store.close()
 
-metadata = gpd.read_file(METADATA_FILE)
 
-# Loop over datasets
-for dataset_id in metadata.mission_id.values:
-    project_dataset(
-        dataset_id=dataset_id,
-        skip_existings=SKIP_EXISTING,
+if __name__ == "__main__":
+    metadata = gpd.read_file(METADATA_FILE)
+
+    # Determine how the predictions were written
+    prediction_manifest = read_prediction_manifest(PER_IMAGE_PREDICTIONS_FOLDER)
+    # Manifests written before this was recorded are assumed to be complete
+    if not prediction_manifest.get("complete", True):
+        raise ValueError(
+            "Inference did not finish for every image, so the predictions may be a mix of "
+            "output scales. Rerun 3_run_inference.py before projecting them."
+        )
+    prediction_scale = prediction_manifest["output_scale"]
+    prediction_storage = prediction_manifest.get("storage", "files")
+    if (PROJECTION_ENGINE == "geograypher" or len(COMPARISON_DATASET_IDS) > 0) and (
+        prediction_scale != 1 or prediction_storage != "files"
+    ):
+        raise ValueError(
+            "The geograypher projection engine needs full resolution predictions stored as "
+            'files. Use PROJECTION_ENGINE = "visibility_cache" for these predictions.'
+        )
+    if prediction_scale not in (1, AGGREGATION_IMAGE_SCALE):
+        print(
+            f"Predictions were written at a scale of {prediction_scale} and will be resampled "
+            f"to the aggregation scale of {AGGREGATION_IMAGE_SCALE}"
+        )
+
+    # Estimate the memory required by each dataset which needs to be projected
+    jobs = {}
+    for dataset_id in metadata.mission_id.values:
+        # The missions which are compared are always projected
+        skip_existing = SKIP_EXISTING and dataset_id not in COMPARISON_DATASET_IDS
+        if skip_existing and SparseFaceVotes.exists(
+            Path(PROJECTIONS_TO_FACES_FOLDER, dataset_id)
+        ):
+            print(f"Dataset {dataset_id} exists already. Skipping")
+            continue
+        mesh_file = Path(MESHES_FOLDER, f"{dataset_id}.ply")
+        cameras_file = Path(CAMERAS_FOLDER, f"{dataset_id}.xml")
+        if not (mesh_file.is_file() and cameras_file.is_file()):
+            print(f"Skipping {dataset_id} due to missing mesh or cameras")
+            continue
+        # Only the visibility cache avoids rendering the mesh
+        cached = (
+            PROJECTION_ENGINE == "visibility_cache"
+            and dataset_id not in COMPARISON_DATASET_IDS
+            and has_visibility_cache(
+                VISIBILITY_CACHE_FOLDER,
+                dataset_id,
+                mesh_file,
+                cameras_file,
+                image_scale=AGGREGATION_IMAGE_SCALE,
+                mesh_downsample=MESH_DOWNSAMPLE,
+            )
+        )
+        jobs[dataset_id] = (
+            estimate_projection_memory(mesh_file, cameras_file, cached=cached),
+            (dataset_id, prediction_storage, skip_existing),
+        )
+
+    memory_budget = (
+        get_physical_memory() * 0.8
+        if PROJECTION_MEMORY_BUDGET_GB is None
+        else PROJECTION_MEMORY_BUDGET_GB * 1e9
     )
+    n_cores = os.cpu_count() if N_CORES is None else N_CORES
+    exit_codes = run_budgeted_jobs(
+        project_dataset,
+        jobs,
+        memory_budget=memory_budget,
+        max_concurrent=max(n_cores // CORES_PER_PROJECTION, 1),
+        log_folder=PROJECTION_LOGS_FOLDER,
+    )
+
+    failed = [dataset_id for dataset_id, code in exit_codes.items() if code != 0]
+    print(f"Projected {len(exit_codes) - len(failed)} of {len(exit_codes)} datasets")
+    if len(failed) > 0:
+        print(f"Failed datasets: {failed}")
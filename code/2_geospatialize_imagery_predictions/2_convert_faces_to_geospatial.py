@@ -3,63 +3,137 @@ from pathlib import Path
 
 import geopandas as gpd
 import numpy as np
-from geograypher.meshes import TexturedPhotogrammetryMesh
-from geograypher.utils.indexing import find_argmax_nonzero_value
 
 # Add folder where constants.py is to system search path
 sys.path.append(str(Path(Path(__file__).parent, "..").resolve()))
 from constants import (
     CAMERAS_FOLDER,
     CONFIDENCE_THRESHOLD,
+    CONFIDENCE_THRESHOLD_SWEEP_FOLDER,
     IDS_TO_LABELS,
+    MESH_CACHE_FOLDER,
     MESH_DOWNSAMPLE,
     MESHES_FOLDER,
     METADATA_FILE,
     PROJECTIONS_TO_FACES_FOLDER,
     PROJECTIONS_TO_GEOSPATIAL_FOLDER,
+    PROJECTIONS_TO_GEOSPATIAL_RASTERS_FOLDER,
     SKIP_EXISTING,
 )
+from face_rasterization import export_face_labels_rasters
+from face_votes import NO_CLASS, SparseFaceVotes, classify_faces_at_thresholds
+from mesh_cache import load_cached_mesh
 
+# How the faces are converted to a top down map. "vector" unions the triangles of the faces into
+# polygons. "raster" draws the highest labeled face at each pixel, which is much faster and uses
+# less memory for dense meshes.
+EXPORT_ENGINE = "vector"
+# The size of a pixel in meters for the "raster" engine
+RASTER_EXPORT_GSD = 0.1
+# Whether the "raster" engine also polygonizes the raster for the post-processing step
+POLYGONIZE_RASTER = True
+# To compare confidence thresholds, set this to a list of thresholds. Each mission is loaded once
+# and a map for each threshold is written to CONFIDENCE_THRESHOLD_SWEEP_FOLDER/threshold_<value>.
+# If None, only CONFIDENCE_THRESHOLD is used and the maps are written for the next step.
+CONFIDENCE_THRESHOLD_SWEEP = None
 
-def project_dataset(dataset_id, skip_existings=False):
+
+def get_output_files(dataset_id, confidence_threshold=None):
+    """
+    The vector and raster output files for a mission. If `confidence_threshold` is provided, they
+    are in the folder for that threshold of the sweep.
+    """
+    if confidence_threshold is None:
+        vector_folder = PROJECTIONS_TO_GEOSPATIAL_FOLDER
+        raster_folder = PROJECTIONS_TO_GEOSPATIAL_RASTERS_FOLDER
+    else:
+        vector_folder = raster_folder = Path(
+            CONFIDENCE_THRESHOLD_SWEEP_FOLDER, f"threshold_{confidence_threshold:g}"
+        )
+    return (
+        Path(vector_folder, f"{dataset_id}.gpkg"),
+        Path(raster_folder, f"{dataset_id}.tif"),
+    )
+
+
+def project_dataset(dataset_id, confidence_thresholds=None, skip_existings=False):
+    """
+    Convert the per-face votes of a mission to a top down map. If `confidence_thresholds` is
+    provided, a map is written for each threshold of the sweep, otherwise CONFIDENCE_THRESHOLD is
+    used.
+    """
     # Path to input photogrammetry products
     mesh_file = Path(MESHES_FOLDER, f"{dataset_id}.ply")
     cameras_file = Path(CAMERAS_FOLDER, f"{dataset_id}.xml")
-    # Input file for the per-face result
-    predicted_face_values_file = Path(PROJECTIONS_TO_FACES_FOLDER, f"{dataset_id}.npy")
-    # Output file for the data converted to geospatial
-    top_down_vector_projection_file = Path(
-        PROJECTIONS_TO_GEOSPATIAL_FOLDER, f"{dataset_id}.gpkg"
-    )
+    # Input folder for the per-face result
+    predicted_face_votes_folder = Path(PROJECTIONS_TO_FACES_FOLDER, dataset_id)
+    # Output files for the data converted to geospatial, for each threshold
+    if confidence_thresholds is None:
+        output_files = {CONFIDENCE_THRESHOLD: get_output_files(dataset_id)}
+    else:
+        output_files = {
+            threshold: get_output_files(dataset_id, threshold)
+            for threshold in confidence_thresholds
+        }
 
-    if skip_existings and top_down_vector_projection_file.is_file():
-        print(f"Skipping existing geospatial file {dataset_id}")
-        return
+    if skip_existings:
+        for threshold, (vector_file, raster_file) in list(output_files.items()):
+            if EXPORT_ENGINE == "raster" and not POLYGONIZE_RASTER:
+                output_file = raster_file
+            else:
+                output_file = vector_file
+            if output_file.is_file():
+                print(
+                    f"Skipping existing geospatial file {dataset_id} at threshold {threshold}"
+                )
+                output_files.pop(threshold)
+        if len(output_files) == 0:
+            return
 
-    # Load the projected face values
-    face_values = np.load(predicted_face_values_file)
+    # Memory map the projected face votes
+    face_votes = SparseFaceVotes.load(predicted_face_votes_folder)
 
-    # Determine the max class
-    max_class = find_argmax_nonzero_value(face_values, keepdims=False)
-    max_value = np.max(face_values, axis=1)
-    # Remove low confidence faces
-    max_class[max_value < CONFIDENCE_THRESHOLD] = np.nan
+    # Determine the max class once, in chunks of faces, and derive the classes at each threshold
+    # from it. Low confidence faces, including faces without any votes, are set to NO_CLASS.
+    thresholds = list(output_files.keys())
+    face_classes = classify_faces_at_thresholds(face_votes, thresholds)
 
-    # Load a mesh
-    mesh = TexturedPhotogrammetryMesh(
+    # Load a mesh, from the cache shared with the projection step if possible
+    mesh = load_cached_mesh(
+        MESH_CACHE_FOLDER,
+        dataset_id,
         mesh_file,
-        transform_filename=cameras_file,
-        texture=max_class,
-        downsample_target=MESH_DOWNSAMPLE,
+        cameras_file,
+        mesh_downsample=MESH_DOWNSAMPLE,
         IDs_to_labels=IDS_TO_LABELS,
     )
-    # Convert the faces to top down vector file
-    mesh.export_face_labels_vector(
-        face_labels=max_class,
-        export_file=top_down_vector_projection_file,
-        label_names=IDS_TO_LABELS,
-        vis=False,
-    )
+
+    if EXPORT_ENGINE == "raster":
+        # The mesh is georeferenced and rasterized once for all the thresholds
+        export_face_labels_rasters(
+            mesh,
+            face_classes,
+            gsd=RASTER_EXPORT_GSD,
+            raster_files=[output_files[t][1] for t in thresholds],
+            vector_files=(
+                [output_files[t][0] for t in thresholds] if POLYGONIZE_RASTER else None
+            ),
+            IDs_to_labels=IDS_TO_LABELS,
+        )
+        return
+
+    for threshold, classes in zip(thresholds, face_classes):
+        vector_file = output_files[threshold][0]
+        vector_file.parent.mkdir(parents=True, exist_ok=True)
+        # The mesh expects float labels with nan for missing values
+        max_class = np.where(classes == NO_CLASS, np.nan, classes)
+        # Convert the faces to top down vector file
+        mesh.export_face_labels_vector(
+            face_labels=max_class,
+            export_file=vector_file,
+            label_names=IDS_TO_LABELS,
+            vis=False,
+        )
 
 
 # Load the list of dataset IDs
@@ -69,5 +143,6 @@ metadata = gpd.read_file(METADATA_FILE)
 for dataset_id in metadata.mission_id.values:
     project_dataset(
         dataset_id=dataset_id,
+        confidence_thresholds=CONFIDENCE_THRESHOLD_SWEEP,
         skip_existings=SKIP_EXISTING,
     )
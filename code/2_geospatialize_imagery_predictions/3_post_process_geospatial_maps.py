@@ -1,8 +1,10 @@
 import json
 import logging
+import multiprocessing
+import os
 import sys
+import time
 from pathlib import Path
-import multiprocessing
 
 import geopandas as gpd
 from spatial_utils.geofileops_wrappers import (
@@ -10,8 +12,6 @@ from spatial_utils.geofileops_wrappers import (
     geofileops_clip,
     geofileops_simplify,
 )
-from spatial_utils.geometric import ensure_non_overlapping_polygons
-from spatial_utils.geospatial import ensure_projected_CRS
 
 # Add folder where constants.py is to system search path
 sys.path.append(str(Path(Path(__file__).parent, "..").resolve()))
@@ -19,26 +19,68 @@ from constants import (
     BUFFER_AMOUNT,
     METADATA_FILE,
     POST_PROCESSED_MAPS_FOLDER,
+    POST_PROCESSING_DEBUG_FOLDER,
+    POST_PROCESSING_LOGS_FOLDER,
+    POST_PROCESSING_SWEEP_FOLDER,
     PROJECTIONS_TO_GEOSPATIAL_FOLDER,
     SHIFTED_MAPS_FOLDER,
+    SHIFTED_MAPS_RECORDS_FOLDER,
     SHIFTS_PER_DATASET,
     SIMPLIFY_TOL,
     SKIP_EXISTING,
 )
+from job_scheduler import get_physical_memory, run_budgeted_jobs
+from map_shifting import shift_map
+from overlap_resolution import resolve_class_overlaps
+from parameter_sweep import combine_summaries, sweep_mission
+from post_processing import (
+    estimate_post_processing_memory,
+    footprint_from_wkb,
+    footprint_to_wkb,
+    fused_post_process,
+)
+from tiled_post_processing import run_tiled_post_processing
 
 # Whether to perform morphological and simplification operations
 RUN_POST_PROCESSING = True
-# How many multiprocessing suprocesses to run. If None, no multiprocessing will be used.
-# Postprocessing only takes one core and usually only a few GB of RAM at maximum.
+# How to post process. "fused" projects each map once and runs all the operations in memory.
+# "geofileops" runs each operation with geofileops, through temporary files.
+POST_PROCESSING_ENGINE = "fused"
+# Write the result of each step of the "fused" engine to POST_PROCESSING_DEBUG_FOLDER
+WRITE_INTERMEDIATE_FILES = False
+# If set, each map is split into tiles of this size in meters which are processed in parallel and
+# stitched back together, so large maps are spread across all of the processes. This uses the
+# "fused" engine.
+POST_PROCESSING_TILE_SIZE = None
+# How many cores can be used in total. Postprocessing a map only takes one core. If None, all the
+# cores are used.
+N_CORES = None
+# Run each map in this process, one after another, instead of in subprocesses. This is useful for
+# debugging since errors are raised directly. The maps are not split into tiles in this case.
+RUN_SEQUENTIALLY = False
+# The total memory that the maps being processed at once can use, in GB. The memory of each map is
+# estimated from the size of its file. If None, 80% of the physical memory is used.
+POST_PROCESSING_MEMORY_BUDGET_GB = None
 
-N_MULTIPROCESSING_PROCESSES = 16
+# Whether to post process every map with each combination of the parameters below, to help choose
+# SIMPLIFY_TOL and BUFFER_AMOUNT. The outputs are written to one folder per combination in
+# POST_PROCESSING_SWEEP_FOLDER, along with a summary of the vertex counts, area changes and
+# runtimes. This uses the "fused" engine and does not change the outputs of the other steps.
+RUN_PARAMETER_SWEEP = False
+# The simplification tolerances to try, in meters
+SWEEP_SIMPLIFY_TOLS = [0.05, 0.1, 0.2]
+# The buffer distances of the opening to try, in meters
+SWEEP_BUFFER_AMOUNTS = [0.1, 0.2, 0.4]
+# The buffer distances of the closing to try with each opening, in meters. If None, the closing
+# uses the same distance as the opening, like the regular post processing.
+SWEEP_CLOSING_AMOUNTS = None
 
 # Whether to shift the files. RUN_POST_PROCESSING must have been run in the past but this step may
 # be re-run with an updated shift
 RUN_SHIFTS = True
 
 
-def post_process_gfo(dataset_id, input_path, output_path, metadata):
+def post_process_gfo(dataset_id, input_path, output_path, footprint_wkb, footprint_crs):
     logging.basicConfig(level=logging.INFO)
     input_data = gpd.read_file(input_path)
     # Perform a series of spatial operations to decrease the number of vertices, remove holes,
@@ -59,99 +101,218 @@ def post_process_gfo(dataset_id, input_path, output_path, metadata):
         buffered3, tolerence=SIMPLIFY_TOL, convert_to_projected_CRS=True
     )
 
-    # Ensure that no classes overlap by prioritizing the classes with less area in the dataset
-    nonoverlapping = ensure_non_overlapping_polygons(simplified2)
-    # The geofileops implementation of clip has errors if there are geometry collections
-    # Turn everything into polygons or multipolygons
-    nonoverlapping = nonoverlapping.explode()
-    nonoverlapping = nonoverlapping[nonoverlapping.geometry.type == "Polygon"]
-    nonoverlapping = nonoverlapping.dissolve(
-        by=["class_ID", "class_names"], as_index=False
-    )
+    # Ensure that no classes overlap by prioritizing the classes with less area in the dataset.
+    # The geofileops implementation of clip has errors if there are geometry collections, so this
+    # also turns everything into one polygon or multipolygon per class.
+    nonoverlapping = resolve_class_overlaps(simplified2)
 
     # TODO determine if it's cheaper to do this operation up front before simplifcation. The one
     # downside is the boundary might not be as precise. So it might be important to do it both
     # before and after.
-    # Extract the metadata for this mission
-    metadata_for_mission = metadata.query("@dataset_id == mission_id")
+    # Extract the footprint of this mission
+    metadata_for_mission = footprint_from_wkb(footprint_wkb, footprint_crs)
 
     # Clip to the bounds of the flight polygon
     clipped = geofileops_clip(nonoverlapping, metadata_for_mission)
     clipped.to_file(output_path)
 
 
-if RUN_POST_PROCESSING:
-    metadata_for_missions = gpd.read_file(METADATA_FILE)
-    map_files = sorted(PROJECTIONS_TO_GEOSPATIAL_FOLDER.glob("*"))
+def post_process_fused(
+    dataset_id, input_path, output_path, footprint_wkb, footprint_crs
+):
+    input_data = gpd.read_file(input_path)
+    metadata_for_mission = footprint_from_wkb(footprint_wkb, footprint_crs)
+    debug_folder = (
+        Path(POST_PROCESSING_DEBUG_FOLDER, dataset_id)
+        if WRITE_INTERMEDIATE_FILES
+        else None
+    )
+    processed = fused_post_process(
+        input_data,
+        metadata_for_mission,
+        simplify_tol=SIMPLIFY_TOL,
+        buffer_amount=BUFFER_AMOUNT,
+        debug_folder=debug_folder,
+    )
+    processed.to_file(output_path)
+
+
+def shift_dataset(job):
+    map_file, shift = job
+    output_file = Path(
+        SHIFTED_MAPS_FOLDER, map_file.relative_to(POST_PROCESSED_MAPS_FOLDER)
+    )
+    record_file = Path(SHIFTED_MAPS_RECORDS_FOLDER, f"{map_file.stem}.shift.json")
+    start = time.time()
+    shifted = shift_map(map_file, output_file, record_file, shift)
+    return map_file.stem, shifted, time.time() - start
+
+
+if __name__ == "__main__":
+    n_cores = os.cpu_count() if N_CORES is None else N_CORES
+    memory_budget = (
+        get_physical_memory() * 0.8
+        if POST_PROCESSING_MEMORY_BUDGET_GB is None
+        else POST_PROCESSING_MEMORY_BUDGET_GB * 1e9
+    )
+    # The IDs of the maps which failed to be post processed, which are not shifted
+    failed_post_processing = []
+
+    if RUN_POST_PROCESSING:
+        metadata_for_missions = gpd.read_file(METADATA_FILE)
+        map_files = sorted(PROJECTIONS_TO_GEOSPATIAL_FOLDER.glob("*"))
+
+        POST_PROCESSED_MAPS_FOLDER.mkdir(exist_ok=True, parents=True)
 
-    POST_PROCESSED_MAPS_FOLDER.mkdir(exist_ok=True, parents=True)
+        # Build a list of tuples, each containing the arguments for one dataset
+        args_list = []
+        for map_file in map_files:
+            dataset_id = map_file.stem
 
-    # Build a list of tuples, each containing the arguments for one dataset
-    args_list = []
-    for map_file in map_files:
-        dataset_id = map_file.stem
+            output_file = Path(
+                POST_PROCESSED_MAPS_FOLDER,
+                map_file.relative_to(PROJECTIONS_TO_GEOSPATIAL_FOLDER),
+            )
+            if SKIP_EXISTING and output_file.is_file():
+                print(f"Skipping {dataset_id} because it exists already")
+                continue
+            # Only the footprint of the mission is sent to the worker
+            footprint = footprint_to_wkb(metadata_for_missions, dataset_id)
+            if footprint is None:
+                print(f"Skipping {dataset_id} because it is not in the metadata")
+                continue
 
-        output_file = Path(
-            POST_PROCESSED_MAPS_FOLDER,
-            map_file.relative_to(PROJECTIONS_TO_GEOSPATIAL_FOLDER),
+            # Add the arguments tuple to list to be processed later
+            args_list.append((dataset_id, map_file, output_file, *footprint))
+
+        post_process = (
+            post_process_fused
+            if POST_PROCESSING_ENGINE == "fused"
+            else post_process_gfo
         )
-        if SKIP_EXISTING and output_file.is_file():
-            print(f"Skipping {dataset_id} because it exists already")
-            continue
-
-        # Add the arguments tuple to list to be processed later
-        args_list.append((dataset_id, map_file, output_file, metadata_for_missions))
-
-    # Run postprocessing, either multiprocessing or sequentially
-    if N_MULTIPROCESSING_PROCESSES is not None:
-        # Multiprocess with a pool of workers each running in different subproceses
-        with multiprocessing.Pool(processes=N_MULTIPROCESSING_PROCESSES) as pool:
-            pool.starmap(post_process_gfo, args_list)
-    else:
-        for args in args_list:
-            print(f"Running dataset {args[0]}")
-            # Run the processes sequentially by unpacking the arguments
-            post_process_gfo(*args)
-
-
-if RUN_SHIFTS:
-    # Determine the filenames output by the last step
-    map_files = sorted(POST_PROCESSED_MAPS_FOLDER.glob("*"))
-    # Read the shifts from the registration step
-    with open(SHIFTS_PER_DATASET, "r") as infile:
-        shifts_per_dataset = json.load(infile)
-
-    # Ensure the output folder exists
-    SHIFTED_MAPS_FOLDER.mkdir(exist_ok=True, parents=True)
-
-    # Iterate over maps
-    for map_file in map_files:
-        print(f"shifting {map_file}")
-
-        # Read the file
-        pred = gpd.read_file(map_file)
-        # Record the original CRS
-        original_crs = pred.crs
-        # Convert to a projected CRS. The shift is assumed to be with respect to this projected CRS.
-        pred = ensure_projected_CRS(pred)
-
-        # Get the shift
-        name = map_file.stem
-        # Check if there was a shift computed for this dataset
-        if name in shifts_per_dataset:
-            shift = shifts_per_dataset[name]
+
+        # Run postprocessing, either sequentially, on tiles or with a process per map
+        if RUN_SEQUENTIALLY:
+            for args in args_list:
+                print(f"Running dataset {args[0]}")
+                post_process(*args)
+        elif POST_PROCESSING_TILE_SIZE is not None:
+            failed_post_processing = run_tiled_post_processing(
+                [
+                    (dataset_id, map_file, footprint_from_wkb(*footprint), output_file)
+                    for dataset_id, map_file, output_file, *footprint in args_list
+                ],
+                tile_size=POST_PROCESSING_TILE_SIZE,
+                simplify_tol=SIMPLIFY_TOL,
+                buffer_amount=BUFFER_AMOUNT,
+                n_processes=n_cores,
+            )
+        else:
+            # The largest maps are started first, and the number running at once is limited by the
+            # cores and by the memory each map is expected to need
+            jobs = {
+                args[0]: (estimate_post_processing_memory(args[1]), args)
+                for args in args_list
+            }
+            exit_codes = run_budgeted_jobs(
+                post_process,
+                jobs,
+                memory_budget=memory_budget,
+                max_concurrent=n_cores,
+                log_folder=POST_PROCESSING_LOGS_FOLDER,
+            )
+            failed_post_processing = [
+                dataset_id for dataset_id, code in exit_codes.items() if code != 0
+            ]
+
+        n_succeeded = len(args_list) - len(failed_post_processing)
+        print(f"Post processed {n_succeeded} of {len(args_list)} maps")
+        if len(failed_post_processing) > 0:
+            print(f"Failed maps: {failed_post_processing}")
+
+    if RUN_PARAMETER_SWEEP:
+        metadata_for_missions = gpd.read_file(METADATA_FILE)
+        map_files = sorted(PROJECTIONS_TO_GEOSPATIAL_FOLDER.glob("*"))
+
+        jobs = {}
+        for map_file in map_files:
+            dataset_id = map_file.stem
+            footprint = footprint_to_wkb(metadata_for_missions, dataset_id)
+            if footprint is None:
+                print(f"Skipping {dataset_id} because it is not in the metadata")
+                continue
+            jobs[dataset_id] = (
+                estimate_post_processing_memory(map_file),
+                (
+                    dataset_id,
+                    map_file,
+                    *footprint,
+                    SWEEP_SIMPLIFY_TOLS,
+                    SWEEP_BUFFER_AMOUNTS,
+                    SWEEP_CLOSING_AMOUNTS,
+                    POST_PROCESSING_SWEEP_FOLDER,
+                ),
+            )
+
+        # Each map is swept by one process, and the cached steps are reused in later sweeps
+        if RUN_SEQUENTIALLY:
+            for _, args in jobs.values():
+                sweep_mission(*args)
         else:
-            # If not, set it to zero
-            shift = (0, 0)
+            exit_codes = run_budgeted_jobs(
+                sweep_mission,
+                jobs,
+                memory_budget=memory_budget,
+                max_concurrent=n_cores,
+                log_folder=Path(POST_PROCESSING_SWEEP_FOLDER, "logs"),
+            )
+            failed = [
+                dataset_id for dataset_id, code in exit_codes.items() if code != 0
+            ]
+            if len(failed) > 0:
+                print(f"Failed maps: {failed}")
+
+        totals = combine_summaries(POST_PROCESSING_SWEEP_FOLDER, list(jobs))
+        if totals is not None:
+            print(totals.to_string(index=False))
 
-        # Apply the shift
-        pred.geometry = pred.translate(xoff=shift[0], yoff=shift[1])
+    if RUN_SHIFTS:
+        # Determine the filenames output by the last step
+        map_files = sorted(POST_PROCESSED_MAPS_FOLDER.glob("*"))
+        # Read the shifts from the registration step
+        with open(SHIFTS_PER_DATASET, "r") as infile:
+            shifts_per_dataset = json.load(infile)
 
-        # Convert back to the original CRS
-        pred.to_crs(original_crs, inplace=True)
+        # Build a list of tuples, each containing the map and shift for one dataset. If there was
+        # no shift computed for a dataset, it is set to zero. Maps which failed to be post
+        # processed are not shifted, since the post processed file is left over from an earlier
+        # run.
+        args_list = []
+        for map_file in map_files:
+            if map_file.stem in failed_post_processing:
+                print(f"Skipping {map_file.stem} because post processing failed")
+                continue
+            args_list.append((map_file, shifts_per_dataset.get(map_file.stem, (0, 0))))
 
-        output_file = Path(
-            SHIFTED_MAPS_FOLDER, map_file.relative_to(POST_PROCESSED_MAPS_FOLDER)
+        # The maps are shifted in parallel, and maps whose input and shift have not changed since
+        # the last run are skipped
+        pool = None if RUN_SEQUENTIALLY else multiprocessing.Pool(processes=n_cores)
+        results = (
+            map(shift_dataset, args_list)
+            if pool is None
+            else pool.imap_unordered(shift_dataset, args_list)
         )
-        # Save the file
-        pred.to_file(output_file)
+        for i, (dataset_id, shifted, duration) in enumerate(results, start=1):
+            if shifted:
+                print(f"Shifted {dataset_id} in {duration:.1f}s ({i}/{len(args_list)})")
+            else:
+                print(
+                    f"Skipped {dataset_id} because the shift has not changed "
+                    f"({i}/{len(args_list)})"
+                )
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if len(failed_post_processing) > 0:
+        sys.exit(f"Post processing failed for {failed_post_processing}")
@@ -0,0 +1,159 @@
+import tempfile
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import numpy as np
+from geograypher.entrypoints.aggregate_images import aggregate_images
+from PIL import Image
+
+from face_votes import SparseFaceVotes
+
+# Rough model of the peak memory used to project one mission, used for scheduling. The per-job
+# logs record the actual peak memory, which can be used to refine these values.
+# Memory used regardless of the mission size, such as the libraries and the renderer
+BASE_PROJECTION_MEMORY = 2e9
+# Memory per mesh face, including the mesh, the rendering buffers and the accumulated votes
+PROJECTION_MEMORY_PER_FACE = 1000
+# Memory per camera, for the camera parameters and any per-camera results that are retained
+PROJECTION_MEMORY_PER_CAMERA = 1e6
+# Memory per mesh face when the visibility is cached, so the mesh does not need to be rendered
+CACHED_PROJECTION_MEMORY_PER_FACE = 100
+
+
+def count_mesh_faces(mesh_file):
+    """Read the number of faces from the header of a PLY file, without loading the mesh"""
+    with open(mesh_file, "rb") as infile:
+        for line in infile:
+            line = line.strip()
+            if line.startswith(b"element face"):
+                return int(line.split()[2])
+            if line == b"end_header":
+                break
+    raise ValueError(f"No faces found in the header of {mesh_file}")
+
+
+def count_cameras(cameras_file):
+    """Count the cameras in a Metashape cameras file, without keeping the whole tree in memory"""
+    n_cameras = 0
+    for _, element in ET.iterparse(cameras_file):
+        if element.tag == "camera":
+            n_cameras += 1
+        element.clear()
+    return n_cameras
+
+
+def estimate_projection_memory(mesh_file, cameras_file, cached=False):
+    """
+    Estimate the peak memory in bytes of projecting labels from these cameras to this mesh. If
+    `cached`, the visibility index is already cached so the mesh is not loaded or rendered.
+    """
+    memory_per_face = (
+        CACHED_PROJECTION_MEMORY_PER_FACE if cached else PROJECTION_MEMORY_PER_FACE
+    )
+    return (
+        BASE_PROJECTION_MEMORY
+        + count_mesh_faces(mesh_file) * memory_per_face
+        + count_cameras(cameras_file) * PROJECTION_MEMORY_PER_CAMERA
+    )
+
+
+def resize_labels(labels, shape):
+    """Resize labels to the (height, width) `shape` with nearest neighbor, if they don't match"""
+    if labels.shape == tuple(shape):
+        return labels
+    return np.asarray(
+        Image.fromarray(np.asarray(labels)).resize((shape[1], shape[0]), Image.NEAREST)
+    )
+
+
+def accumulate_face_votes(votes, pix2face, labels):
+    """
+    Add one vote for each pixel to the face it lands on, for the class predicted at that pixel.
+    Pixels that do not land on the mesh or that have an invalid class are ignored.
+    """
+    n_classes = votes.shape[1]
+    valid = (pix2face >= 0) & (labels < n_classes)
+    flat_inds = pix2face[valid].astype(np.int64) * n_classes + labels[valid]
+    # Many pixels land on the same face, so only update each (face, class) pair once
+    unique_inds, counts = np.unique(flat_inds, return_counts=True)
+    votes.reshape(-1)[unique_inds] += counts.astype(votes.dtype)
+
+
+def project_labels(
+    visibility_index, n_classes, labels_folder=None, prediction_store=None
+):
+    """
+    Project per-image labels onto the faces of the mesh using a precomputed index of the face that
+    each pixel lands on. Labels that are at the same scale as the index are used as they are.
+
+    Args:
+        visibility_index (VisibilityIndex): Pixel-to-face index for each camera
+        n_classes (int): Number of classes. Labels with a greater value are ignored.
+        labels_folder (PathLike, optional): One label image per image, at the same relative path
+            with a .png suffix. Not used if `prediction_store` is provided.
+        prediction_store (PredictionStoreReader, optional): Read the labels from this container,
+            by the path of the image relative to the images folder. Defaults to None.
+
+    Returns:
+        SparseFaceVotes: The number of pixels of each class which landed on each face
+    """
+    votes = np.zeros((visibility_index.n_faces, n_classes), dtype=np.uint32)
+    n_missing = 0
+    for i, image_name in enumerate(visibility_index.image_names):
+        if prediction_store is not None:
+            if image_name not in prediction_store:
+                n_missing += 1
+                continue
+            labels = prediction_store.read_labels(image_name)
+        else:
+            label_file = Path(labels_folder, image_name).with_suffix(".png")
+            if not label_file.is_file():
+                n_missing += 1
+                continue
+            labels = np.asarray(Image.open(label_file))
+
+        pix2face = visibility_index.get_pix2face(i)
+        accumulate_face_votes(votes, pix2face, resize_labels(labels, pix2face.shape))
+
+    if n_missing > 0:
+        print(f"{n_missing} cameras had no label image and were skipped")
+
+    return SparseFaceVotes.from_dense(votes)
+
+
+def project_labels_with_geograypher(
+    mesh_file,
+    cameras_file,
+    images_folder,
+    labels_folder,
+    original_image_folder,
+    IDs_to_labels,
+    mesh_downsample,
+    image_scale,
+    n_cameras_per_chunk,
+):
+    """
+    Project full resolution label images onto the faces of the mesh with geograypher's
+    `aggregate_images`, which renders the mesh from every camera. The per-face class fractions it
+    computes are stored as they are, so the confidence of each face is the same as geograypher's.
+
+    Returns:
+        SparseFaceVotes: The normalized fraction of each class on each face
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        face_values_file = Path(temp_dir, "face_values.npy")
+        aggregate_images(
+            mesh_file,
+            cameras_file,
+            images_folder,
+            labels_folder,
+            original_image_folder=original_image_folder,
+            IDs_to_labels=IDs_to_labels,
+            aggregated_face_values_savefile=face_values_file,
+            mesh_downsample=mesh_downsample,
+            aggregate_image_scale=image_scale,
+            take_every_nth_camera=1,
+            n_cameras_per_aggregation_cluster=n_cameras_per_chunk,
+        )
+        face_values = np.load(face_values_file)
+    return SparseFaceVotes.from_dense(face_values, normalized=True)
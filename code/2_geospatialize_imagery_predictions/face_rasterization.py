@@ -0,0 +1,298 @@
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pyproj
+import rasterio
+import rasterio.features
+from pyproj.aoi import AreaOfInterest
+from pyproj.database import query_utm_crs_info
+from rasterio.transform import from_origin
+from shapely.geometry import shape
+
+from face_votes import NO_CLASS
+
+# The raster value of pixels which are not covered by a labeled face
+RASTER_NODATA = 255
+# How many candidate pixels are tested at once, which bounds the memory used. Testing each
+# candidate takes about 200 bytes of temporary arrays, so this is about 400MB per batch.
+MAX_CANDIDATE_PIXELS = 2_000_000
+# Size of the blocks in the GeoTIFF
+RASTER_BLOCK_SIZE = 512
+
+
+def get_utm_crs(mesh):
+    """The UTM CRS of the zone containing the center of the mesh"""
+    center = np.asarray(mesh.pyvista_mesh.points).mean(axis=0)
+    lon, lat = pyproj.Transformer.from_crs(
+        mesh.CRS, "EPSG:4326", always_xy=True
+    ).transform(*center[:2], center[2])[:2]
+    utm_info = query_utm_crs_info(
+        datum_name="WGS 84",
+        area_of_interest=AreaOfInterest(lon, lat, lon, lat),
+    )[0]
+    return pyproj.CRS.from_epsg(utm_info.code)
+
+
+def get_triangle_pixels(triangles, x_min, y_max, gsd):
+    """
+    Find the pixels whose centers are inside each triangle, and the height of the triangle there.
+
+    Args:
+        triangles (np.ndarray): (n_triangles, 3, 3) vertices of each triangle
+        x_min (float): Left edge of the raster
+        y_max (float): Top edge of the raster
+        gsd (float): Size of a pixel
+
+    Returns:
+        np.ndarray: (n_pixels,) index of the triangle
+        np.ndarray: (n_pixels,) row of the pixel
+        np.ndarray: (n_pixels,) column of the pixel
+        np.ndarray: (n_pixels,) height of the triangle at the pixel center
+    """
+    # Continuous pixel coordinates, where pixel centers are at integer + 0.5
+    cols = (triangles[..., 0] - x_min) / gsd
+    rows = (y_max - triangles[..., 1]) / gsd
+    # The range of pixel centers inside the bounding box of each triangle
+    col_start = np.ceil(cols.min(axis=1) - 0.5).astype(np.int64)
+    col_end = np.floor(cols.max(axis=1) - 0.5).astype(np.int64)
+    row_start = np.ceil(rows.min(axis=1) - 0.5).astype(np.int64)
+    row_end = np.floor(rows.max(axis=1) - 0.5).astype(np.int64)
+    widths = np.maximum(col_end - col_start + 1, 0)
+    n_candidates = widths * np.maximum(row_end - row_start + 1, 0)
+
+    # Enumerate the candidate pixels of every triangle
+    triangle_inds = np.repeat(np.arange(len(triangles)), n_candidates)
+    local_inds = np.arange(len(triangle_inds)) - np.repeat(
+        np.cumsum(n_candidates) - n_candidates, n_candidates
+    )
+    candidate_widths = widths[triangle_inds]
+    candidate_cols = col_start[triangle_inds] + local_inds % np.maximum(
+        candidate_widths, 1
+    )
+    candidate_rows = row_start[triangle_inds] + local_inds // np.maximum(
+        candidate_widths, 1
+    )
+
+    # Barycentric coordinates of the pixel centers
+    c = cols[triangle_inds]
+    r = rows[triangle_inds]
+    pc = candidate_cols + 0.5
+    pr = candidate_rows + 0.5
+    denominator = (r[:, 1] - r[:, 2]) * (c[:, 0] - c[:, 2]) + (c[:, 2] - c[:, 1]) * (
+        r[:, 0] - r[:, 2]
+    )
+    # Degenerate triangles never contain a pixel center
+    valid = denominator != 0
+    denominator = np.where(valid, denominator, 1)
+    w0 = (
+        (r[:, 1] - r[:, 2]) * (pc - c[:, 2]) + (c[:, 2] - c[:, 1]) * (pr - r[:, 2])
+    ) / (denominator)
+    w1 = (
+        (r[:, 2] - r[:, 0]) * (pc - c[:, 2]) + (c[:, 0] - c[:, 2]) * (pr - r[:, 2])
+    ) / (denominator)
+    w2 = 1 - w0 - w1
+    inside = valid & (w0 >= 0) & (w1 >= 0) & (w2 >= 0)
+
+    z = triangles[triangle_inds, :, 2]
+    heights = w0 * z[:, 0] + w1 * z[:, 1] + w2 * z[:, 2]
+    return (
+        triangle_inds[inside],
+        candidate_rows[inside],
+        candidate_cols[inside],
+        heights[inside],
+    )
+
+
+def update_z_buffer(class_raster, height_raster, flat_inds, heights, classes):
+    """Write the classes into the raster wherever they are higher than what is there already"""
+    # Keep only the highest sample for each pixel, so each pixel is assigned once
+    order = np.lexsort((heights, flat_inds))
+    flat_inds, heights, classes = flat_inds[order], heights[order], classes[order]
+    is_last = np.ones(len(flat_inds), dtype=bool)
+    is_last[:-1] = flat_inds[1:] != flat_inds[:-1]
+    flat_inds, heights, classes = flat_inds[is_last], heights[is_last], classes[is_last]
+
+    higher = heights > height_raster.ravel()[flat_inds]
+    class_raster.ravel()[flat_inds[higher]] = classes[higher]
+    height_raster.ravel()[flat_inds[higher]] = heights[higher]
+
+
+def rasterize_face_classes(vertices, faces, face_classes, gsd):
+    """
+    Rasterize the labeled faces of a mesh from above. Where several faces cover a pixel, the class
+    of the highest one is used. Faces which are smaller than a pixel are also drawn at the pixel
+    containing their center, so thin or finely tessellated surfaces do not leave gaps.
+
+    Several labelings of the same mesh, such as the classes at different confidence thresholds,
+    can be rasterized at once. The pixels covered by each face are only computed once and shared
+    between them, and all the rasters have the same extent.
+
+    Args:
+        vertices (np.ndarray): (n_vertices, 3) vertices in a projected CRS
+        faces (np.ndarray): (n_faces, 3) vertex indices of each triangle
+        face_classes (list[np.ndarray]): (n_faces,) class of each face, or NO_CLASS, for each
+            labeling
+        gsd (float): Size of a pixel in the units of the CRS
+
+    Returns:
+        list[np.ndarray]: (height, width) uint8 class raster for each labeling, RASTER_NODATA
+            where there are no faces
+        affine.Affine: transform from pixel to CRS coordinates
+    """
+    labeled = np.flatnonzero(
+        np.any([classes != NO_CLASS for classes in face_classes], axis=0)
+    )
+    if len(labeled) == 0:
+        raise ValueError("There are no labeled faces to rasterize")
+
+    # Only the labeled faces determine the extent
+    used_vertices = vertices[np.unique(faces[labeled])]
+    x_min, y_min = used_vertices[:, :2].min(axis=0)
+    x_max, y_max = used_vertices[:, :2].max(axis=0)
+    # Snap the origin to the grid so rasters of different missions align
+    x_min = np.floor(x_min / gsd) * gsd
+    y_max = np.ceil(y_max / gsd) * gsd
+    width = max(int(np.ceil((x_max - x_min) / gsd)), 1)
+    height = max(int(np.ceil((y_max - y_min) / gsd)), 1)
+
+    class_rasters = [
+        np.full((height, width), RASTER_NODATA, dtype=np.uint8) for _ in face_classes
+    ]
+    height_rasters = [
+        np.full((height, width), -np.inf, dtype=np.float32) for _ in face_classes
+    ]
+
+    # Split the faces into batches with a bounded number of candidate pixels
+    triangles = vertices[faces[labeled]]
+    spans = (np.ptp(triangles[..., 0], axis=1) / gsd + 1) * (
+        np.ptp(triangles[..., 1], axis=1) / gsd + 1
+    )
+    batch_ids = (np.cumsum(spans) // MAX_CANDIDATE_PIXELS).astype(np.int64)
+    batch_starts = np.flatnonzero(np.diff(batch_ids, prepend=-1))
+    batch_ends = np.append(batch_starts[1:], len(labeled))
+
+    for start, end in zip(batch_starts, batch_ends):
+        batch_triangles = triangles[start:end]
+        triangle_inds, rows, cols, heights = get_triangle_pixels(
+            batch_triangles, x_min, y_max, gsd
+        )
+
+        # The pixel containing the center of each face
+        centers = batch_triangles.mean(axis=1)
+        center_rows = np.floor((y_max - centers[:, 1]) / gsd).astype(np.int64)
+        center_cols = np.floor((centers[:, 0] - x_min) / gsd).astype(np.int64)
+
+        rows = np.concatenate((rows, center_rows))
+        cols = np.concatenate((cols, center_cols))
+        heights = np.concatenate((heights, centers[:, 2])).astype(np.float32)
+        sample_faces = labeled[start:end][
+            np.concatenate((triangle_inds, np.arange(end - start)))
+        ]
+        in_bounds = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+        flat_inds = rows * width + cols
+
+        for classes, class_raster, height_raster in zip(
+            face_classes, class_rasters, height_rasters
+        ):
+            sample_classes = classes[sample_faces]
+            used = in_bounds & (sample_classes != NO_CLASS)
+            update_z_buffer(
+                class_raster,
+                height_raster,
+                flat_inds[used],
+                heights[used],
+                sample_classes[used].astype(np.uint8),
+            )
+
+    return class_rasters, from_origin(x_min, y_max, gsd, gsd)
+
+
+def write_class_raster(class_raster, transform, crs, output_file):
+    """Write the class raster as a tiled and compressed GeoTIFF"""
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    height, width = class_raster.shape
+    with rasterio.open(
+        output_file,
+        "w",
+        driver="GTiff",
+        height=height,
+        width=width,
+        count=1,
+        dtype="uint8",
+        crs=crs,
+        transform=transform,
+        nodata=RASTER_NODATA,
+        tiled=True,
+        blockxsize=RASTER_BLOCK_SIZE,
+        blockysize=RASTER_BLOCK_SIZE,
+        compress="deflate",
+        BIGTIFF="IF_SAFER",
+    ) as dst:
+        dst.write(class_raster, 1)
+
+
+def polygonize_class_raster(class_raster, transform, crs, IDs_to_labels):
+    """
+    Convert the class raster to one (multi)polygon per class
+
+    Returns:
+        gpd.GeoDataFrame: with "class_ID" and "class_names" columns
+    """
+    shapes = rasterio.features.shapes(
+        class_raster,
+        mask=class_raster != RASTER_NODATA,
+        transform=transform,
+        connectivity=4,
+    )
+    geometries, class_IDs = [], []
+    for geometry, class_ID in shapes:
+        geometries.append(shape(geometry))
+        class_IDs.append(int(class_ID))
+
+    polygons = gpd.GeoDataFrame({"class_ID": class_IDs}, geometry=geometries, crs=crs)
+    polygons = polygons.dissolve(by="class_ID", as_index=False)
+    polygons["class_names"] = [IDs_to_labels[i] for i in polygons["class_ID"]]
+    return polygons[["class_ID", "class_names", "geometry"]]
+
+
+def export_face_labels_rasters(
+    mesh,
+    face_classes,
+    gsd,
+    raster_files,
+    vector_files=None,
+    IDs_to_labels=None,
+):
+    """
+    Rasterize the per-face classes of a mesh from above in the UTM zone of the mesh, and write
+    them as a GeoTIFF. This avoids unioning the triangles of every face into polygons. Several
+    labelings of the mesh can be exported at once, sharing the georeferencing and rasterization.
+
+    Args:
+        mesh (TexturedPhotogrammetryMesh): Georeferenced mesh
+        face_classes (list[np.ndarray]): (n_faces,) class of each face, or NO_CLASS, for each
+            labeling
+        gsd (float): Size of a pixel in meters
+        raster_files (list[PathLike]): Output GeoTIFF for each labeling
+        vector_files (list[PathLike], optional): If provided, the rasters are also polygonized
+            per class and written here. Defaults to None.
+        IDs_to_labels (dict, optional): Names of the classes, required for `vector_files`.
+    """
+    crs = get_utm_crs(mesh)
+    vertices = np.asarray(mesh.get_vertices_in_CRS(crs))
+    faces = mesh.pyvista_mesh.faces.reshape(-1, 4)[:, 1:]
+
+    class_rasters, transform = rasterize_face_classes(
+        vertices, faces, face_classes, gsd
+    )
+    for i, class_raster in enumerate(class_rasters):
+        write_class_raster(class_raster, transform, crs, Path(raster_files[i]))
+
+        if vector_files is not None:
+            polygons = polygonize_class_raster(
+                class_raster, transform, crs, IDs_to_labels
+            )
+            vector_file = Path(vector_files[i])
+            vector_file.parent.mkdir(parents=True, exist_ok=True)
+            polygons.to_file(vector_file)
@@ -0,0 +1,242 @@
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+# How many faces to classify at once, which bounds the memory used
+CLASSIFICATION_CHUNK_SIZE = 1_000_000
+# The class of faces which are unobserved or below the confidence threshold
+NO_CLASS = -1
+
+
+class SparseFaceVotes:
+    """
+    The number of votes for each class on each face of a mesh, stored in compressed sparse row
+    format. Only the classes which received votes are stored for each face, so unobserved and
+    single-class faces take little space. The counts are stored as uint16, unless a count is too
+    large for it.
+
+    On disk this is a folder of .npy files which can be memory mapped, so the votes never need to
+    be fully loaded into memory.
+
+    The votes can also be per-face fractions which are already normalized, such as the output of
+    geograypher's aggregation. These are stored as float32 and used as they are.
+    """
+
+    def __init__(self, indptr, classes, counts, n_classes, normalized=False):
+        """
+        Args:
+            indptr (np.ndarray): (n_faces + 1,) the votes for face i are in [indptr[i], indptr[i+1])
+            classes (np.ndarray): (n_votes,) the class of each stored count, increasing per face
+            counts (np.ndarray): (n_votes,) the number of votes
+            n_classes (int): The total number of classes
+            normalized (bool, optional): Whether the counts are already the fraction of the votes
+                for each class. Defaults to False.
+        """
+        self.indptr = indptr
+        self.classes = classes
+        self.counts = counts
+        self.n_classes = n_classes
+        self.normalized = normalized
+
+    @property
+    def n_faces(self):
+        return len(self.indptr) - 1
+
+    @classmethod
+    def from_dense(cls, votes, normalized=False):
+        """
+        Create from a (n_faces, n_classes) array of vote counts, or of fractions if `normalized`.
+        Entries which are zero or nan are not stored.
+        """
+        nonzero = votes > 0
+        indptr = np.zeros(votes.shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.count_nonzero(nonzero, axis=1), out=indptr[1:])
+        # Row-major order keeps the classes of each face increasing
+        _, classes = np.nonzero(nonzero)
+        counts = votes[nonzero]
+        if normalized:
+            count_dtype = np.float32
+        elif counts.max(initial=0) <= np.iinfo(np.uint16).max:
+            count_dtype = np.uint16
+        else:
+            count_dtype = np.uint32
+        return cls(
+            indptr,
+            classes.astype(np.uint8),
+            counts.astype(count_dtype),
+            votes.shape[1],
+            normalized=normalized,
+        )
+
+    @staticmethod
+    def exists(folder):
+        """Whether `folder` contains a complete set of votes"""
+        return Path(folder, "metadata.json").is_file()
+
+    def save(self, folder):
+        """Save to `folder`, which is only replaced once all the files have been written"""
+        folder = Path(folder)
+        tmp_folder = folder.with_name(folder.name + ".tmp")
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        tmp_folder.mkdir(parents=True)
+        for name in ("indptr", "classes", "counts"):
+            np.save(Path(tmp_folder, f"{name}.npy"), getattr(self, name))
+        # Written last, since it marks the votes as complete
+        with open(Path(tmp_folder, "metadata.json"), "w") as outfile:
+            json.dump(
+                {
+                    "n_faces": self.n_faces,
+                    "n_classes": self.n_classes,
+                    "normalized": self.normalized,
+                },
+                outfile,
+            )
+        shutil.rmtree(folder, ignore_errors=True)
+        os.replace(tmp_folder, folder)
+
+    @classmethod
+    def load(cls, folder, mmap=True):
+        with open(Path(folder, "metadata.json"), "r") as infile:
+            metadata = json.load(infile)
+        mmap_mode = "r" if mmap else None
+        return cls(
+            *(
+                np.load(Path(folder, f"{name}.npy"), mmap_mode=mmap_mode)
+                for name in ("indptr", "classes", "counts")
+            ),
+            n_classes=metadata["n_classes"],
+            normalized=metadata.get("normalized", False),
+        )
+
+    def _get_range(self, start, end):
+        """The votes for the faces in [start, end), with offsets relative to the first face"""
+        end = self.n_faces if end is None else end
+        indptr = np.asarray(self.indptr[start : end + 1])
+        first, last = int(indptr[0]), int(indptr[-1])
+        return (
+            end - start,
+            indptr - first,
+            np.asarray(self.classes[first:last]),
+            np.asarray(self.counts[first:last]),
+        )
+
+    def get_fractions(self, start=0, end=None):
+        """
+        The dense (n_faces, n_classes) fraction of the votes for each class, for the faces in
+        [start, end). Faces without votes are all zeros.
+        """
+        n_faces, indptr, classes, counts = self._get_range(start, end)
+        face_inds = np.repeat(np.arange(n_faces), np.diff(indptr))
+        fractions = np.zeros((n_faces, self.n_classes), dtype=np.float32)
+        if self.normalized:
+            fractions[face_inds, classes] = counts
+            return fractions
+        totals = np.bincount(face_inds, weights=counts, minlength=n_faces)
+        fractions[face_inds, classes] = counts / totals[face_inds]
+        return fractions
+
+    def get_max_class(self, start=0, end=None):
+        """
+        The most voted class of each face in [start, end) and the fraction of the votes for it,
+        without creating the dense votes. Ties are resolved in favor of the lower class ID.
+
+        Returns:
+            np.ndarray: (n_faces,) int class ID, or -1 if the face has no votes
+            np.ndarray: (n_faces,) float32 fraction of the votes for that class, 0 if no votes
+        """
+        n_faces, indptr, classes, counts = self._get_range(start, end)
+        max_class = np.full(n_faces, -1, dtype=np.int64)
+        max_fraction = np.zeros(n_faces, dtype=np.float32)
+        observed = np.diff(indptr) > 0
+        if not np.any(observed):
+            return max_class, max_fraction
+
+        # Reduce over the contiguous votes of each observed face
+        starts = indptr[:-1][observed]
+        max_counts = np.maximum.reduceat(counts, starts)
+        # Among the entries with the maximum count, take the lowest class. The classes are
+        # increasing within each face, so this is the first such entry.
+        n_per_face = np.diff(indptr)[observed]
+        is_max = counts == np.repeat(max_counts, n_per_face)
+        masked_classes = np.where(is_max, classes, np.iinfo(np.uint8).max)
+        max_class[observed] = np.minimum.reduceat(masked_classes, starts)
+        if self.normalized:
+            max_fraction[observed] = max_counts
+        else:
+            totals = np.add.reduceat(counts.astype(np.int64), starts)
+            max_fraction[observed] = max_counts / totals
+        return max_class, max_fraction
+
+
+def classify_faces_at_thresholds(
+    face_votes, confidence_thresholds, chunk_size=CLASSIFICATION_CHUNK_SIZE
+):
+    """
+    Determine the most voted class of each face once, and keep the faces where at least each of
+    `confidence_thresholds` of the votes agree. The faces are processed in chunks of `chunk_size`,
+    so the memory used beyond the outputs does not depend on the size of the mesh.
+
+    Returns:
+        list[np.ndarray]: for each threshold, the (n_faces,) int8 class ID, or NO_CLASS for
+            unobserved or low confidence faces
+    """
+    face_classes = [
+        np.full(face_votes.n_faces, NO_CLASS, dtype=np.int8)
+        for _ in confidence_thresholds
+    ]
+    for start in range(0, face_votes.n_faces, chunk_size):
+        end = min(start + chunk_size, face_votes.n_faces)
+        max_class, max_fraction = face_votes.get_max_class(start, end)
+        for threshold, classes in zip(confidence_thresholds, face_classes):
+            confident = max_fraction >= threshold
+            classes[start:end][confident] = max_class[confident]
+    return face_classes
+
+
+def classify_faces(
+    face_votes, confidence_threshold, chunk_size=CLASSIFICATION_CHUNK_SIZE
+):
+    """
+    Determine the most voted class of each face, keeping only the faces where at least
+    `confidence_threshold` of the votes agree. The faces are processed in chunks of `chunk_size`,
+    so the memory used beyond the output does not depend on the size of the mesh.
+
+    Returns:
+        np.ndarray: (n_faces,) int8 class ID, or NO_CLASS for unobserved or low confidence faces
+    """
+    (face_classes,) = classify_faces_at_thresholds(
+        face_votes, [confidence_threshold], chunk_size
+    )
+    return face_classes
+
+
+def compare_face_classes(face_votes_1, face_votes_2, confidence_threshold):
+    """
+    Compare the classes that two projections of the same mesh give each face at
+    `confidence_threshold`, such as the projections of two engines
+
+    Returns:
+        dict: The number of faces classified by each projection, the number classified by either,
+            and the number and fraction of those which have the same class in both
+    """
+    if face_votes_1.n_faces != face_votes_2.n_faces:
+        raise ValueError(
+            f"The projections have {face_votes_1.n_faces} and {face_votes_2.n_faces} faces"
+        )
+    classes_1 = classify_faces(face_votes_1, confidence_threshold)
+    classes_2 = classify_faces(face_votes_2, confidence_threshold)
+    classified = (classes_1 != NO_CLASS) | (classes_2 != NO_CLASS)
+    n_agree = int(np.count_nonzero(classified & (classes_1 == classes_2)))
+    n_classified = int(np.count_nonzero(classified))
+    return {
+        "confidence_threshold": confidence_threshold,
+        "n_faces": face_votes_1.n_faces,
+        "n_classified_1": int(np.count_nonzero(classes_1 != NO_CLASS)),
+        "n_classified_2": int(np.count_nonzero(classes_2 != NO_CLASS)),
+        "n_classified_either": n_classified,
+        "n_agree": n_agree,
+        "agreement": n_agree / n_classified if n_classified > 0 else 1.0,
+    }
@@ -0,0 +1,106 @@
+import multiprocessing
+import multiprocessing.connection
+import os
+import resource
+import sys
+import time
+import traceback
+from pathlib import Path
+
+
+def get_physical_memory():
+    """Total physical memory in bytes"""
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def run_logged_job(target, args, log_file):
+    """
+    Run `target(*args)` with everything written to stdout and stderr, including from compiled
+    libraries, sent to `log_file`. The peak memory of the job is recorded at the end of the log so
+    the memory estimates can be checked. Exits with a nonzero status if the job fails.
+    """
+    log_fd = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(log_fd, 1)
+    os.dup2(log_fd, 2)
+    exit_code = 0
+    start = time.time()
+    try:
+        target(*args)
+    except Exception:
+        traceback.print_exc()
+        exit_code = 1
+    # ru_maxrss is in kilobytes on Linux
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    print(
+        f"Finished in {time.time() - start:.1f}s with a peak memory of "
+        f"{peak_memory / 1e9:.2f}GB"
+    )
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(exit_code)
+
+
+def run_budgeted_jobs(target, jobs, memory_budget, max_concurrent, log_folder):
+    """
+    Run `target` for each job, each in its own process, keeping the total estimated memory of the
+    running jobs under `memory_budget`. The largest jobs are started first, and smaller jobs fill
+    in the remaining budget. A job that is larger than the whole budget runs by itself. Since
+    each job is a separate process, a job which fails or is killed does not affect the others.
+
+    Args:
+        target (callable): Function to run for each job
+        jobs (dict): Maps from a job ID to (estimated memory in bytes, tuple of args for `target`)
+        memory_budget (float): Total memory in bytes that the running jobs can use
+        max_concurrent (int): Maximum number of jobs to run at once
+        log_folder (PathLike): The output of each job is written to <job_id>.log in this folder
+
+    Returns:
+        dict: Maps from job ID to the exit code of the job, which is 0 if it succeeded
+    """
+    log_folder = Path(log_folder)
+    log_folder.mkdir(parents=True, exist_ok=True)
+    # Largest first
+    pending = sorted(jobs, key=lambda job_id: jobs[job_id][0], reverse=True)
+    # Maps from the process sentinel to the job ID and process
+    running = {}
+    used_memory = 0
+    exit_codes = {}
+    start_times = {}
+    start = time.time()
+
+    while len(pending) > 0 or len(running) > 0:
+        for job_id in list(pending):
+            if len(running) >= max_concurrent:
+                break
+            estimated_memory, args = jobs[job_id]
+            if len(running) > 0 and used_memory + estimated_memory > memory_budget:
+                continue
+            log_file = Path(log_folder, f"{job_id}.log")
+            process = multiprocessing.Process(
+                target=run_logged_job, args=(target, args, log_file)
+            )
+            process.start()
+            start_times[job_id] = time.time()
+            running[process.sentinel] = (job_id, process)
+            used_memory += estimated_memory
+            pending.remove(job_id)
+            print(
+                f"Started {job_id} with an estimated {estimated_memory / 1e9:.2f}GB, "
+                f"{len(running)} running, {len(pending)} pending"
+            )
+
+        for sentinel in multiprocessing.connection.wait(list(running)):
+            job_id, process = running.pop(sentinel)
+            process.join()
+            used_memory -= jobs[job_id][0]
+            exit_codes[job_id] = process.exitcode
+            status = "Finished" if process.exitcode == 0 else "Failed"
+            print(
+                f"{status} {job_id} in {time.time() - start_times[job_id]:.1f}s with exit code "
+                f"{process.exitcode}, see {Path(log_folder, f'{job_id}.log')}. "
+                f"{len(exit_codes)} of {len(jobs)} done after {time.time() - start:.1f}s"
+            )
+
+    return exit_codes
@@ -0,0 +1,130 @@
+import json
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pyproj
+import shapely
+from file_fingerprints import get_file_fingerprint
+from spatial_utils.geospatial import ensure_projected_CRS
+
+# How far in meters the shift of any part of a map can be from the requested shift when it is
+# applied as a single translation in the CRS of the map. If the error would be larger, every
+# vertex is transformed to the projected CRS and back instead.
+SHIFT_TOLERANCE = 0.001
+
+
+def get_shift_record(map_file, shift):
+    """Everything the shifted map depends on, so it is only recreated if something changed"""
+    return {"shift": list(shift), "input_fingerprint": get_file_fingerprint(map_file)}
+
+
+def is_shift_current(output_file, record_file, record):
+    """Whether `output_file` was created from the same input and shift as `record`"""
+    if not (Path(output_file).is_file() and Path(record_file).is_file()):
+        return False
+    with open(record_file, "r") as infile:
+        return json.load(infile) == record
+
+
+def get_native_shift(data, shift):
+    """
+    Express a shift in the projected CRS used for registration in the CRS of the map.
+
+    The shift is a translation in the projected CRS. In the CRS of the map it is a translation as
+    well if that CRS is the projected one, and very nearly one otherwise, since the maps are small
+    relative to the distortion of a CRS. The translation is computed at the center of the map and
+    checked at the corners.
+
+    Args:
+        data (gpd.GeoDataFrame): The map
+        shift (tuple): (xshift, yshift) in the projected CRS
+
+    Returns:
+        np.ndarray | None: The (xshift, yshift) in the CRS of the map, or None if the shift is not
+            a translation within SHIFT_TOLERANCE
+        pyproj.Transformer: From the CRS of the map to the projected CRS
+    """
+    bounds = data.total_bounds
+    # The projected CRS is determined from the extent of the map, without projecting the map
+    projected_crs = ensure_projected_CRS(
+        gpd.GeoDataFrame(geometry=[shapely.box(*bounds)], crs=data.crs)
+    ).crs
+    to_projected = pyproj.Transformer.from_crs(data.crs, projected_crs, always_xy=True)
+    if pyproj.CRS(data.crs) == pyproj.CRS(projected_crs):
+        return np.asarray(shift, dtype=float), to_projected
+
+    # The center and corners of the map
+    x = np.array(
+        [(bounds[0] + bounds[2]) / 2, bounds[0], bounds[0], bounds[2], bounds[2]]
+    )
+    y = np.array(
+        [(bounds[1] + bounds[3]) / 2, bounds[1], bounds[3], bounds[1], bounds[3]]
+    )
+    projected_x, projected_y = to_projected.transform(x, y)
+    shifted_x, shifted_y = to_projected.transform(
+        projected_x + shift[0], projected_y + shift[1], direction="INVERSE"
+    )
+    native_shift = np.array([shifted_x[0] - x[0], shifted_y[0] - y[0]])
+
+    # How far each point would be from where it should be, in meters
+    approximate_x, approximate_y = to_projected.transform(
+        x + native_shift[0], y + native_shift[1]
+    )
+    error = np.hypot(
+        approximate_x - (projected_x + shift[0]),
+        approximate_y - (projected_y + shift[1]),
+    )
+    if np.max(error) > SHIFT_TOLERANCE:
+        return None, to_projected
+    return native_shift, to_projected
+
+
+def shift_map(map_file, output_file, record_file, shift):
+    """
+    Translate a map by `shift` in the projected CRS used for registration, keeping it in its own
+    CRS. Where possible the shift is applied as a single translation of the coordinates, otherwise
+    each vertex is projected, shifted and unprojected in one pass. The applied shift is recorded
+    in `record_file` once the output is written.
+
+    Args:
+        map_file (PathLike): Post processed map
+        output_file (PathLike): Where to write the shifted map
+        record_file (PathLike): Where to record the shift and input
+        shift (tuple): (xshift, yshift) in meters
+
+    Returns:
+        bool: Whether the map was shifted, False if the output was already current
+    """
+    record = get_shift_record(map_file, shift)
+    if is_shift_current(output_file, record_file, record):
+        return False
+
+    pred = gpd.read_file(map_file)
+    geometries = np.asarray(pred.geometry.values)
+    if len(pred) > 0 and tuple(shift) != (0, 0):
+        native_shift, to_projected = get_native_shift(pred, shift)
+        if native_shift is not None:
+            geometries = shapely.transform(
+                geometries, lambda coords: coords + native_shift
+            )
+        else:
+
+            def shift_coords(coords):
+                x, y = to_projected.transform(coords[:, 0], coords[:, 1])
+                x, y = to_projected.transform(
+                    x + shift[0], y + shift[1], direction="INVERSE"
+                )
+                return np.stack([x, y], axis=1)
+
+            geometries = shapely.transform(geometries, shift_coords)
+
+    pred = pred.set_geometry(geometries, crs=pred.crs)
+    Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+    pred.to_file(output_file)
+
+    # Only record the shift once the output is complete
+    Path(record_file).parent.mkdir(parents=True, exist_ok=True)
+    with open(record_file, "w") as outfile:
+        json.dump(record, outfile, indent=4)
+    return True
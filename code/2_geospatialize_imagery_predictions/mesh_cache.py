@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import shutil
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import numpy as np
+import pyvista as pv
+from file_fingerprints import get_file_fingerprint
+from geograypher.meshes import TexturedPhotogrammetryMesh
+
+# Incremented if the format of the cache changes, so old caches are not used
+CACHE_VERSION = 2
+
+
+def get_mesh_key(mesh_file, cameras_file, mesh_downsample):
+    """
+    Identifier for the mesh and cameras files, based on their size and modification time, and the
+    downsampling
+    """
+    description = json.dumps(
+        {
+            "version": CACHE_VERSION,
+            "mesh": get_file_fingerprint(mesh_file),
+            "cameras": get_file_fingerprint(cameras_file),
+            "mesh_downsample": mesh_downsample,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha1(description.encode()).hexdigest()[:16]
+
+
+def write_transform_file(cameras_file, output_file):
+    """
+    Write a copy of the Metashape cameras file which only contains the georeferencing transform
+    of the chunk. This can be passed to TexturedPhotogrammetryMesh in place of the full file, so
+    the cameras do not need to be parsed each time the mesh is loaded.
+    """
+    root = ET.parse(cameras_file).getroot()
+    chunk = root.find("chunk")
+    transform = None if chunk is None else chunk.find("transform")
+    if transform is None:
+        raise ValueError(f"No chunk transform in the cameras file: {cameras_file}")
+    transform_root = ET.Element(root.tag, root.attrib)
+    ET.SubElement(transform_root, chunk.tag, chunk.attrib).append(transform)
+    ET.ElementTree(transform_root).write(output_file)
+
+
+def build_mesh_cache(cache_folder, mesh_file, cameras_file, mesh_downsample):
+    """
+    Parse and downsample the mesh, and write the vertices and triangular faces as .npy files,
+    along with the georeferencing transform from the cameras file. The vertices are saved in the
+    mesh's own coordinates, since the transform is cheap to apply when the mesh is loaded.
+    """
+    cache_folder = Path(cache_folder)
+    tmp_folder = cache_folder.with_name(cache_folder.name + ".tmp")
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    tmp_folder.mkdir(parents=True)
+
+    mesh = TexturedPhotogrammetryMesh(mesh_file, downsample_target=mesh_downsample)
+    faces = mesh.pyvista_mesh.faces.reshape(-1, 4)
+    if not np.all(faces[:, 0] == 3):
+        raise ValueError(f"Only triangular meshes can be cached: {mesh_file}")
+    np.save(Path(tmp_folder, "vertices.npy"), np.asarray(mesh.pyvista_mesh.points))
+    np.save(Path(tmp_folder, "faces.npy"), faces[:, 1:].astype(np.int32))
+    write_transform_file(cameras_file, Path(tmp_folder, "transform.xml"))
+    # Written last, since it marks the cache as complete
+    with open(Path(tmp_folder, "metadata.json"), "w") as outfile:
+        json.dump({"mesh_file": str(mesh_file), "n_faces": len(faces)}, outfile)
+
+    shutil.rmtree(cache_folder, ignore_errors=True)
+    os.replace(tmp_folder, cache_folder)
+
+
+def load_cached_mesh(
+    cache_root, mission_id, mesh_file, cameras_file, mesh_downsample=1, **mesh_kwargs
+):
+    """
+    Load a mesh georeferenced by `cameras_file`, from the cache if it is current. Otherwise, the
+    mesh file is parsed and downsampled and the transform is read from the cameras file once, and
+    the result is cached. Caches for outdated inputs are removed.
+
+    Args:
+        cache_root (PathLike): Folder containing the caches of all missions
+        mission_id (str): Mission the mesh belongs to
+        mesh_file (PathLike): Mesh from photogrammetry
+        cameras_file (PathLike): Metashape cameras file used to georeference the mesh
+        mesh_downsample (float, optional): Fraction of the mesh faces to keep. Defaults to 1.
+        **mesh_kwargs: Passed to TexturedPhotogrammetryMesh, such as `texture`
+
+    Returns:
+        TexturedPhotogrammetryMesh: The georeferenced mesh
+    """
+    cache_folder = Path(
+        cache_root, mission_id, get_mesh_key(mesh_file, cameras_file, mesh_downsample)
+    )
+    if not Path(cache_folder, "metadata.json").is_file():
+        if cache_folder.parent.is_dir():
+            for outdated in cache_folder.parent.iterdir():
+                shutil.rmtree(outdated)
+        print(f"Building the mesh cache for {mission_id}")
+        build_mesh_cache(cache_folder, mesh_file, cameras_file, mesh_downsample)
+
+    vertices = np.load(Path(cache_folder, "vertices.npy"), mmap_mode="r")
+    faces = np.load(Path(cache_folder, "faces.npy"), mmap_mode="r")
+    # Pyvista stores each face prefixed by the number of vertices in it
+    pyvista_faces = np.empty((len(faces), 4), dtype=np.int64)
+    pyvista_faces[:, 0] = 3
+    pyvista_faces[:, 1:] = faces
+    pyvista_mesh = pv.PolyData(np.array(vertices), pyvista_faces.ravel())
+
+    # The mesh was already downsampled when it was cached, and the cached transform file is much
+    # smaller than the cameras file
+    return TexturedPhotogrammetryMesh(
+        pyvista_mesh,
+        transform_filename=Path(cache_folder, "transform.xml"),
+        downsample_target=1,
+        **mesh_kwargs,
+    )
@@ -0,0 +1,114 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+# The columns which identify a class
+CLASS_COLUMNS = ["class_ID", "class_names"]
+
+
+def get_class_priorities(class_areas):
+    """
+    The priority of each class, where classes with less area take precedence. Ties are broken by
+    the order of the classes.
+
+    Returns:
+        np.ndarray: The rank of each class, where 0 is the highest priority
+    """
+    ranks = np.empty(len(class_areas), dtype=np.int64)
+    ranks[np.argsort(class_areas, kind="stable")] = np.arange(len(class_areas))
+    return ranks
+
+
+def dissolve_parts(parts, single_source):
+    """
+    Merge polygons into a single geometry. If they all came from a single geometry they cannot
+    overlap, so they are combined without a union.
+    """
+    if single_source:
+        return shapely.multipolygons(parts)
+    return shapely.union_all(parts)
+
+
+def resolve_class_overlaps(data, n_threads=None):
+    """
+    Remove the overlaps between classes, giving the overlapping region to the class with less area
+    in the whole map, measured as the total area of its polygons, and merge the polygons of each
+    class into a single geometry. Only polygons which intersect a polygon of a higher priority
+    class are modified, and these are found with a spatial index. The classes are dissolved in
+    parallel.
+
+    Args:
+        data (gpd.GeoDataFrame): Geometries with the CLASS_COLUMNS, with any number of rows for
+            each class
+        n_threads (int, optional): Number of threads for dissolving. Defaults to one per class.
+
+    Returns:
+        gpd.GeoDataFrame: One (multi)polygon per class, with only polygons
+    """
+    classes = data[CLASS_COLUMNS].drop_duplicates().reset_index(drop=True)
+    row_classes = (
+        data[CLASS_COLUMNS]
+        .merge(classes.reset_index(), on=CLASS_COLUMNS, how="left")["index"]
+        .to_numpy()
+    )
+
+    # Split into polygons, so only the parts which actually conflict are modified
+    parts, part_rows = shapely.get_parts(
+        np.asarray(data.geometry.values), return_index=True
+    )
+    is_polygon = shapely.get_type_id(parts) == shapely.GeometryType.POLYGON
+    parts, part_rows = parts[is_polygon], part_rows[is_polygon]
+    part_classes = row_classes[part_rows]
+
+    class_areas = np.bincount(
+        part_classes, weights=shapely.area(parts), minlength=len(classes)
+    )
+    part_ranks = get_class_priorities(class_areas)[part_classes]
+
+    # Pairs of intersecting parts where the second has a higher priority than the first
+    tree = shapely.STRtree(parts)
+    lower, higher = tree.query(parts, predicate="intersects")
+    conflicting = part_ranks[higher] < part_ranks[lower]
+    lower, higher = lower[conflicting], higher[conflicting]
+
+    if len(lower) > 0:
+        order = np.argsort(lower, kind="stable")
+        lower, higher = lower[order], higher[order]
+        conflicted_parts = np.unique(lower)
+        # The union of the higher priority parts which overlap each part
+        group_starts = np.searchsorted(lower, conflicted_parts)
+        masks = np.array(
+            [
+                shapely.union_all(group)
+                for group in np.split(parts[higher], group_starts[1:])
+            ],
+            dtype=object,
+        )
+        parts = parts.copy()
+        parts[conflicted_parts] = shapely.difference(parts[conflicted_parts], masks)
+
+    # Remove anything which is no longer a polygon, such as lines along shared edges
+    parts, part_inds = shapely.get_parts(parts, return_index=True)
+    is_polygon = shapely.get_type_id(parts) == shapely.GeometryType.POLYGON
+    parts, part_classes = parts[is_polygon], part_classes[part_inds[is_polygon]]
+
+    # The number of rows of each class, to decide whether its polygons can overlap
+    rows_per_class = np.bincount(row_classes, minlength=len(classes))
+    class_ids = np.unique(part_classes)
+    with ThreadPoolExecutor(max_workers=n_threads or max(len(class_ids), 1)) as pool:
+        geometries = list(
+            pool.map(
+                lambda class_id: dissolve_parts(
+                    parts[part_classes == class_id], rows_per_class[class_id] == 1
+                ),
+                class_ids,
+            )
+        )
+
+    return gpd.GeoDataFrame(
+        classes.iloc[class_ids].reset_index(drop=True),
+        geometry=geometries,
+        crs=data.crs,
+    )
@@ -0,0 +1,281 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from file_fingerprints import get_file_fingerprint
+from spatial_utils.geospatial import ensure_projected_CRS
+
+from post_processing import (
+    dilate_and_erode,
+    erode,
+    footprint_from_wkb,
+    resolve_and_clip,
+    simplify_normalized,
+)
+
+
+def get_combination_name(simplify_tol, opening_amount, closing_amount):
+    """The name of the folder for the outputs of one combination of parameters"""
+    return f"simplify_{simplify_tol:g}_open_{opening_amount:g}_close_{closing_amount:g}"
+
+
+def get_summary_file(sweep_folder, mission_id):
+    """Where the summary of the sweep of one mission is written"""
+    return Path(sweep_folder, "summaries", f"{mission_id}.csv")
+
+
+def get_mission_cache(sweep_folder, input_file, mission_id):
+    """
+    The cache folder for a mission, which is keyed by the fingerprint of the input map. Caches of
+    earlier versions of the map are removed.
+    """
+    mission_folder = Path(sweep_folder, "cache", mission_id)
+    cache_folder = Path(mission_folder, get_file_fingerprint(input_file))
+    if mission_folder.is_dir():
+        for folder in mission_folder.iterdir():
+            if folder != cache_folder:
+                shutil.rmtree(folder)
+    return cache_folder
+
+
+def write_atomic(data, output_file):
+    """Write a GeoDataFrame so that an interrupted write never leaves a partial file"""
+    tmp_file = output_file.with_name(f"{output_file.stem}.tmp{output_file.suffix}")
+    data.to_file(tmp_file)
+    os.replace(tmp_file, output_file)
+
+
+def get_footprint_key(footprint_wkb):
+    """Identifier for a footprint, so information measured within it is redone if it changes"""
+    return hashlib.sha1(footprint_wkb).hexdigest()
+
+
+def read_map_info(cache_folder, footprint_wkb):
+    """The cached information from `load_projected_map`, or None if it is missing or outdated"""
+    info_file = Path(cache_folder, "info.json")
+    if not info_file.is_file():
+        return None
+    with open(info_file, "r") as infile:
+        info = json.load(infile)
+    if info.get("footprint_key") != get_footprint_key(footprint_wkb):
+        return None
+    return info
+
+
+def load_projected_map(input_file, cache_folder, footprint_wkb, footprint_crs):
+    """
+    Read a map in the projected CRS used for post processing, with the information about the
+    original map which the sweep needs. The projected map is cached.
+
+    Returns:
+        gpd.GeoDataFrame: The projected map
+        dict: The "original_crs" as WKT, and the "input_area" in square meters and the
+            "input_n_vertices" of the map after clipping it to the footprint, so they can be
+            compared with the clipped outputs
+    """
+    projected_file = Path(cache_folder, "projected.gpkg")
+    info = read_map_info(cache_folder, footprint_wkb)
+    if projected_file.is_file() and info is not None:
+        return gpd.read_file(projected_file), info
+
+    input_data = gpd.read_file(input_file)
+    projected = ensure_projected_CRS(input_data)
+    projected_footprint = (
+        footprint_from_wkb(footprint_wkb, footprint_crs)
+        .to_crs(projected.crs)
+        .geometry.union_all()
+    )
+    clipped = shapely.intersection(
+        np.asarray(projected.geometry.values), projected_footprint
+    )
+    info = {
+        "original_crs": input_data.crs.to_wkt(),
+        "footprint_key": get_footprint_key(footprint_wkb),
+        "input_area": float(shapely.area(clipped).sum()),
+        "input_n_vertices": int(shapely.get_num_coordinates(clipped).sum()),
+    }
+    cache_folder.mkdir(parents=True, exist_ok=True)
+    write_atomic(projected, projected_file)
+    # The info is written last, so the cache is only used once it is complete
+    with open(Path(cache_folder, "info.json"), "w") as outfile:
+        json.dump(info, outfile, indent=4)
+    return projected, info
+
+
+def load_map_info(input_file, cache_folder, footprint_wkb, footprint_crs):
+    """The information from `load_projected_map`, without reading the map if it is cached"""
+    info = read_map_info(cache_folder, footprint_wkb)
+    if info is not None:
+        return info
+    return load_projected_map(input_file, cache_folder, footprint_wkb, footprint_crs)[1]
+
+
+def load_simplified_map(
+    input_file, cache_folder, simplify_tol, footprint_wkb, footprint_crs
+):
+    """
+    The projected map after the first simplification, which is cached for each tolerance. This
+    is the input to every other step, so the map is only read and projected if the simplification
+    is not cached.
+    """
+    simplified_file = Path(cache_folder, f"simplified_{simplify_tol:g}.gpkg")
+    if simplified_file.is_file():
+        return gpd.read_file(simplified_file)
+
+    projected, _ = load_projected_map(
+        input_file, cache_folder, footprint_wkb, footprint_crs
+    )
+    simplified = projected.set_geometry(
+        shapely.simplify(np.asarray(projected.geometry.values), simplify_tol),
+        crs=projected.crs,
+    )
+    write_atomic(simplified, simplified_file)
+    return simplified
+
+
+def sweep_mission(
+    mission_id,
+    input_file,
+    footprint_wkb,
+    footprint_crs,
+    simplify_tols,
+    opening_amounts,
+    closing_amounts,
+    sweep_folder,
+):
+    """
+    Post process a map with every combination of the parameters, as `fused_post_process` would.
+    The projected map and the first simplification for each tolerance are cached, and the
+    erosion of each opening is shared by all of the closing amounts. The outputs are written to
+    one folder per combination, and the vertex count, area and runtime of each combination are
+    written to the summary of the mission, along with the vertex count and area of the input
+    within the footprint.
+
+    Args:
+        mission_id (str): ID of the mission, used as the name of the outputs
+        input_file (PathLike): Predicted map
+        footprint_wkb (bytes): Footprint of the mission from `footprint_to_wkb`
+        footprint_crs (str): CRS of the footprint
+        simplify_tols (list[float]): Simplification tolerances in meters
+        opening_amounts (list[float]): Buffer distances of the opening in meters
+        closing_amounts (list[float] | None): Buffer distances of the closing in meters. If None,
+            each opening is followed by a closing of the same distance.
+        sweep_folder (PathLike): Folder for the outputs, the caches and the summaries
+    """
+    # Remove the summary of any earlier sweep, so it is not mistaken for this one if this fails
+    summary_file = get_summary_file(sweep_folder, mission_id)
+    summary_file.unlink(missing_ok=True)
+    cache_folder = get_mission_cache(sweep_folder, input_file, mission_id)
+
+    info = load_map_info(input_file, cache_folder, footprint_wkb, footprint_crs)
+    footprint = footprint_from_wkb(footprint_wkb, footprint_crs)
+
+    rows = []
+    for simplify_tol in simplify_tols:
+        start = time.time()
+        simplified = load_simplified_map(
+            input_file, cache_folder, simplify_tol, footprint_wkb, footprint_crs
+        )
+        simplify_runtime = time.time() - start
+        simplified_geometries = np.asarray(simplified.geometry.values)
+        projected_footprint = footprint.to_crs(simplified.crs).geometry.union_all()
+
+        for opening_amount in opening_amounts:
+            start = time.time()
+            eroded = erode(simplified_geometries, opening_amount)
+            erosion_runtime = time.time() - start
+
+            for closing_amount in (
+                [opening_amount] if closing_amounts is None else closing_amounts
+            ):
+                start = time.time()
+                geometries = dilate_and_erode(eroded, opening_amount, closing_amount)
+                geometries = simplify_normalized(geometries, simplify_tol)
+                processed = simplified.set_geometry(geometries, crs=simplified.crs)
+                processed = processed[~processed.geometry.is_empty]
+                processed = resolve_and_clip(processed, projected_footprint)
+                runtime = time.time() - start
+
+                # Measured in the projected CRS, so the areas are in square meters
+                output_geometries = np.asarray(processed.geometry.values)
+                area = float(shapely.area(output_geometries).sum())
+
+                combination = get_combination_name(
+                    simplify_tol, opening_amount, closing_amount
+                )
+                output_file = Path(sweep_folder, combination, f"{mission_id}.gpkg")
+                output_file.parent.mkdir(parents=True, exist_ok=True)
+                processed.to_crs(info["original_crs"]).to_file(output_file)
+
+                rows.append(
+                    {
+                        "mission_id": mission_id,
+                        "combination": combination,
+                        "simplify_tol": simplify_tol,
+                        "opening_amount": opening_amount,
+                        "closing_amount": closing_amount,
+                        "n_vertices": int(
+                            shapely.get_num_coordinates(output_geometries).sum()
+                        ),
+                        # The input is clipped to the footprint like the output, so the
+                        # differences only come from the parameters
+                        "input_n_vertices": info["input_n_vertices"],
+                        "area": area,
+                        "input_area": info["input_area"],
+                        "area_delta": area - info["input_area"],
+                        "runtime_s": runtime,
+                        # The steps shared with other combinations, which are only run once.
+                        # Loading the simplification is much faster once it is cached.
+                        "simplify_runtime_s": simplify_runtime,
+                        "erosion_runtime_s": erosion_runtime,
+                    }
+                )
+                print(f"Finished {combination} for {mission_id} in {runtime:.1f}s")
+
+    summary_file.parent.mkdir(parents=True, exist_ok=True)
+    pd.DataFrame(rows).to_csv(summary_file, index=False)
+
+
+def combine_summaries(sweep_folder, mission_ids):
+    """
+    Combine the summaries of the missions into one table in the sweep folder, along with the
+    totals for each combination over all the missions. Missions which failed are left out.
+
+    Returns:
+        pd.DataFrame | None: The totals for each combination, or None if no mission succeeded
+    """
+    summary_files = [
+        get_summary_file(sweep_folder, mission_id) for mission_id in mission_ids
+    ]
+    summaries = [
+        pd.read_csv(summary_file)
+        for summary_file in summary_files
+        if summary_file.is_file()
+    ]
+    if len(summaries) == 0:
+        return None
+    summary = pd.concat(summaries)
+    summary.to_csv(Path(sweep_folder, "summary.csv"), index=False)
+
+    totals = summary.groupby(
+        ["combination", "simplify_tol", "opening_amount", "closing_amount"],
+        as_index=False,
+    )[
+        [
+            "n_vertices",
+            "input_n_vertices",
+            "area",
+            "input_area",
+            "area_delta",
+            "runtime_s",
+        ]
+    ].sum()
+    totals.to_csv(Path(sweep_folder, "summary_totals.csv"), index=False)
+    return totals
@@ -0,0 +1,251 @@
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from spatial_utils.geospatial import ensure_projected_CRS
+
+from overlap_resolution import CLASS_COLUMNS, resolve_class_overlaps
+
+# The number of segments used to approximate a quarter circle when buffering, which is the same as
+# the geofileops default
+BUFFER_QUAD_SEGS = 5
+# Memory used by post processing any map, in bytes
+BASE_POST_PROCESSING_MEMORY = 5e8
+# Memory per byte of the input map file, for the geometry and the copies made while processing it
+POST_PROCESSING_MEMORY_PER_INPUT_BYTE = 20
+
+
+def estimate_post_processing_memory(input_file):
+    """Estimate the peak memory in bytes of post processing a map, from the size of its file"""
+    return (
+        BASE_POST_PROCESSING_MEMORY
+        + Path(input_file).stat().st_size * POST_PROCESSING_MEMORY_PER_INPUT_BYTE
+    )
+
+
+def footprint_to_wkb(metadata, mission_id):
+    """
+    The footprint of a mission as WKB and the CRS as WKT, which are much cheaper to send to a
+    worker process than the metadata of all of the missions. None if the mission is not in the
+    metadata.
+    """
+    geometries = metadata.geometry[metadata.mission_id == mission_id]
+    if len(geometries) == 0:
+        return None
+    return shapely.to_wkb(geometries.union_all()), metadata.crs.to_wkt()
+
+
+def footprint_from_wkb(footprint_wkb, crs):
+    """The footprint from `footprint_to_wkb` as a GeoDataFrame"""
+    return gpd.GeoDataFrame(geometry=[shapely.from_wkb(footprint_wkb)], crs=crs)
+
+
+def combine_polygons(geometries, group_inds):
+    """
+    Combine the polygons in `geometries` into one (multi)polygon per group, dropping everything
+    which is not a polygon and any empty polygons. The polygons of a group must not overlap, which is the case for the
+    parts of a single geometry, so no union is needed.
+
+    Args:
+        geometries (np.ndarray): Geometries, which may be multipart or collections
+        group_inds (np.ndarray): Group of each geometry
+
+    Returns:
+        np.ndarray: The groups which have any polygons, sorted
+        np.ndarray: The (multi)polygon of each of these groups
+    """
+    parts, part_inds = shapely.get_parts(geometries, return_index=True)
+    # Empty geometries, such as the result of clipping a class disjoint from the footprint, are
+    # returned as a single empty polygon part
+    is_polygon = (
+        shapely.get_type_id(parts) == shapely.GeometryType.POLYGON
+    ) & ~shapely.is_empty(parts)
+    parts, part_groups = parts[is_polygon], group_inds[part_inds[is_polygon]]
+
+    order = np.argsort(part_groups, kind="stable")
+    parts, part_groups = parts[order], part_groups[order]
+    groups = np.unique(part_groups)
+    return groups, shapely.multipolygons(
+        parts, indices=np.searchsorted(groups, part_groups)
+    )
+
+
+def keep_polygons(data):
+    """
+    Drop everything which is not a polygon, such as lines from clipping or buffering, and combine
+    the remaining polygons of each row into a (multi)polygon. Rows which become empty are removed.
+    """
+    rows, geometries = combine_polygons(
+        np.asarray(data.geometry.values), np.arange(len(data))
+    )
+    data = data.iloc[rows].copy()
+    data.geometry = geometries
+    return data
+
+
+def erode(geometries, opening_amount):
+    """The first half of an opening, which removes everything narrower than `opening_amount`"""
+    return shapely.buffer(geometries, -opening_amount, quad_segs=BUFFER_QUAD_SEGS)
+
+
+def dilate_and_erode(eroded, opening_amount, closing_amount, on_step=None):
+    """
+    Complete the opening of eroded geometries and close them, which fills holes narrower than
+    `closing_amount`. The dilation of the opening and of the closing are combined into a single
+    buffer.
+    """
+    geometries = shapely.buffer(
+        eroded, opening_amount + closing_amount, quad_segs=BUFFER_QUAD_SEGS
+    )
+    if on_step is not None:
+        on_step("buffered2", geometries)
+    geometries = shapely.buffer(geometries, -closing_amount, quad_segs=BUFFER_QUAD_SEGS)
+    if on_step is not None:
+        on_step("buffered3", geometries)
+    return geometries
+
+
+def open_and_close(geometries, buffer_amount, on_step=None, closing_amount=None):
+    """
+    Remove islands and fill holes smaller than `buffer_amount` by an opening and closing.
+
+    Args:
+        geometries (np.ndarray): Geometries in a projected CRS
+        buffer_amount (float): Buffer distance in the units of the CRS
+        on_step (callable, optional): Called with the name of each step and its result.
+            Defaults to None.
+        closing_amount (float, optional): Buffer distance of the closing, if it is different
+            from the opening. Defaults to None.
+
+    Returns:
+        np.ndarray: The processed geometries
+    """
+    if closing_amount is None:
+        closing_amount = buffer_amount
+    geometries = erode(geometries, buffer_amount)
+    if on_step is not None:
+        on_step("buffered1", geometries)
+    return dilate_and_erode(geometries, buffer_amount, closing_amount, on_step=on_step)
+
+
+def simplify_normalized(geometries, simplify_tol):
+    """
+    Simplify geometries which may have been assembled in different ways. The simplification
+    depends on where each ring starts, so the rings are put in a canonical form first.
+    """
+    return shapely.simplify(shapely.normalize(geometries), simplify_tol)
+
+
+def smooth_geometries(geometries, simplify_tol, buffer_amount, on_step=None):
+    """
+    Simplify the geometries, then open and close them. Every step is a vectorized operation on
+    all the geometries.
+
+    Args:
+        geometries (np.ndarray): Geometries in a projected CRS
+        simplify_tol (float): Simplification tolerance in the units of the CRS
+        buffer_amount (float): Buffer distance in the units of the CRS
+        on_step (callable, optional): Called with the name of each step and its result.
+            Defaults to None.
+
+    Returns:
+        np.ndarray: The smoothed geometries
+    """
+    geometries = shapely.simplify(geometries, simplify_tol)
+    if on_step is not None:
+        on_step("simplified1", geometries)
+    return open_and_close(geometries, buffer_amount, on_step=on_step)
+
+
+def write_debug_file(data, geometries, debug_folder, step):
+    """Write the geometries after a step, if a debug folder is provided"""
+    if debug_folder is None:
+        return
+    Path(debug_folder).mkdir(parents=True, exist_ok=True)
+    data.set_geometry(geometries, crs=data.crs).to_file(
+        Path(debug_folder, f"{step}.gpkg")
+    )
+
+
+def morphological_post_process(data, simplify_tol, buffer_amount, debug_folder=None):
+    """
+    Simplify the geometry, then remove islands and fill holes smaller than `buffer_amount` by an
+    opening and closing, and simplify again. This is the same sequence of operations as the
+    geofileops based post processing, but every step is a vectorized operation on all the
+    geometries in memory.
+
+    Args:
+        data (gpd.GeoDataFrame): Geometries in a projected CRS
+        simplify_tol (float): Simplification tolerance in the units of the CRS
+        buffer_amount (float): Buffer distance in the units of the CRS
+        debug_folder (PathLike, optional): If provided, the result of each step is written here.
+            Defaults to None.
+
+    Returns:
+        gpd.GeoDataFrame: The processed geometries, without the ones which became empty
+    """
+
+    def on_step(step, geometries):
+        write_debug_file(data, geometries, debug_folder, step)
+
+    geometries = smooth_geometries(
+        np.asarray(data.geometry.values), simplify_tol, buffer_amount, on_step=on_step
+    )
+    # This makes the result the same as stitching together processed tiles
+    geometries = simplify_normalized(geometries, simplify_tol)
+    on_step("simplified2", geometries)
+
+    data = data.set_geometry(geometries, crs=data.crs)
+    return data[~data.geometry.is_empty]
+
+
+def resolve_and_clip(data, footprint):
+    """
+    Ensure that no classes overlap, merge the geometries of each class, and clip to the footprint
+
+    Args:
+        data (gpd.GeoDataFrame): Geometries with the CLASS_COLUMNS
+        footprint (shapely.Geometry): Region to clip to, in the CRS of `data`
+
+    Returns:
+        gpd.GeoDataFrame: One (multi)polygon per class
+    """
+    # Prioritize the classes with less area in the dataset
+    nonoverlapping = resolve_class_overlaps(data)
+
+    # Each class is clipped as a single geometry, so this is only a few intersections
+    clipped = nonoverlapping.set_geometry(
+        shapely.intersection(np.asarray(nonoverlapping.geometry.values), footprint),
+        crs=nonoverlapping.crs,
+    )
+    return keep_polygons(clipped)
+
+
+def fused_post_process(
+    input_data, footprint, simplify_tol, buffer_amount, debug_folder=None
+):
+    """
+    Post process a predicted map in memory. The map is projected once, processed in the projected
+    CRS, and converted back to its original CRS at the end.
+
+    Args:
+        input_data (gpd.GeoDataFrame): Predicted map with the CLASS_COLUMNS
+        footprint (gpd.GeoDataFrame): Region of the mission to clip to
+        simplify_tol (float): Simplification tolerance in meters
+        buffer_amount (float): Buffer distance in meters
+        debug_folder (PathLike, optional): If provided, the result of each step is written here.
+            Defaults to None.
+
+    Returns:
+        gpd.GeoDataFrame: The post processed map, in the CRS of `input_data`
+    """
+    original_crs = input_data.crs
+    projected = ensure_projected_CRS(input_data)
+    projected_footprint = footprint.to_crs(projected.crs).geometry.union_all()
+
+    processed = morphological_post_process(
+        projected, simplify_tol, buffer_amount, debug_folder=debug_folder
+    )
+    processed = resolve_and_clip(processed, projected_footprint)
+    return processed.to_crs(original_crs)
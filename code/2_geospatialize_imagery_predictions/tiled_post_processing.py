@@ -0,0 +1,278 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from spatial_utils.geospatial import ensure_projected_CRS
+
+from post_processing import (
+    combine_polygons,
+    open_and_close,
+    resolve_and_clip,
+    simplify_normalized,
+)
+
+
+def get_tile_margin(simplify_tol, buffer_amount):
+    """
+    How far outside of a tile the input is needed to process the tile the same as the whole map.
+    The opening and closing only depend on the input within the sum of the buffer distances,
+    which is four times `buffer_amount`. Both simplifications are applied to the whole map rather
+    than to the tiles, since which vertices they keep depends on the entire ring, but
+    `simplify_tol` is added so that the cut edges stay clear of the vertices the simplification
+    moved.
+    """
+    return 4 * buffer_amount + simplify_tol
+
+
+def split_into_tiles(geometries, tile_size, margin):
+    """
+    Split the polygons of a map into square tiles. Each tile gets the polygons which are within
+    `margin` of it, so it can be processed independently.
+
+    Args:
+        geometries (np.ndarray): Geometry of each row of the map, in a projected CRS
+        tile_size (float): Size of the tiles in the units of the CRS
+        margin (float): Distance outside of each tile to include polygons from
+
+    Returns:
+        list[tuple]: For each tile with any polygons, the (xmin, ymin, xmax, ymax) bounds of the
+            tile, the polygons and the row of each polygon
+    """
+    parts, row_inds = shapely.get_parts(geometries, return_index=True)
+    if len(parts) == 0:
+        return []
+    tree = shapely.STRtree(parts)
+    x_min, y_min, x_max, y_max = shapely.total_bounds(parts)
+
+    # The tiles extend past the input by the margin, since buffering can grow the geometry. The
+    # edges are shared by neighboring tiles, so the tiles meet exactly when they are stitched.
+    x_edges = np.arange(x_min - margin, x_max + margin + tile_size, tile_size)
+    y_edges = np.arange(y_min - margin, y_max + margin + tile_size, tile_size)
+
+    tiles = []
+    for i in range(len(x_edges) - 1):
+        for j in range(len(y_edges) - 1):
+            bounds = (x_edges[i], y_edges[j], x_edges[i + 1], y_edges[j + 1])
+            inds = tree.query(shapely.box(*bounds).buffer(margin, join_style="mitre"))
+            if len(inds) > 0:
+                tiles.append((bounds, parts[inds], row_inds[inds]))
+    return tiles
+
+
+def post_process_tile(tile_bounds, parts, row_inds, simplify_tol, buffer_amount):
+    """
+    Open and close the simplified polygons around a tile and clip the result to the tile
+
+    Returns:
+        np.ndarray: The rows which have any polygons in the tile
+        np.ndarray: The smoothed (multi)polygon of each row, within the tile
+    """
+    margin = get_tile_margin(simplify_tol, buffer_amount)
+    tile = shapely.box(*tile_bounds)
+    # Cut the polygons to the region which affects the tile
+    clipped = shapely.intersection(parts, tile.buffer(margin, join_style="mitre"))
+    rows, geometries = combine_polygons(clipped, row_inds)
+    geometries = open_and_close(geometries, buffer_amount)
+    return combine_polygons(shapely.intersection(geometries, tile), rows)
+
+
+def prepare_tiled_mission(input_path, footprint, tile_size, simplify_tol, margin):
+    """
+    Read and project a map, run the first simplification and split it into tiles
+
+    Returns:
+        gpd.GeoDataFrame: The attributes of each row, without the geometry which is in the tiles
+        shapely.Geometry: The footprint in the projected CRS
+        pyproj.CRS: The CRS of the map
+        list[tuple]: The tiles from `split_into_tiles`
+    """
+    input_data = gpd.read_file(input_path)
+    projected = ensure_projected_CRS(input_data)
+    projected_footprint = footprint.to_crs(projected.crs).geometry.union_all()
+    # The first simplification is cheap and needs whole rings to match the untiled result
+    simplified = shapely.simplify(np.asarray(projected.geometry.values), simplify_tol)
+    tiles = split_into_tiles(simplified, tile_size, margin)
+    attributes = projected.set_geometry(
+        np.full(len(projected), None, dtype=object), crs=projected.crs
+    )
+    return attributes, projected_footprint, input_data.crs, tiles
+
+
+def finish_tiled_mission(
+    data, tile_results, footprint, original_crs, simplify_tol, output_path
+):
+    """
+    Stitch the processed tiles of a mission back together and complete the post processing. The
+    pieces of each row only touch along the tile edges, so their union merges them into the same
+    geometry as processing the map as a whole.
+    """
+    pieces = [[] for _ in range(len(data))]
+    for rows, geometries in tile_results:
+        for row, geometry in zip(rows, geometries):
+            pieces[row].append(geometry)
+    geometries = np.array(
+        [shapely.union_all(row_pieces) for row_pieces in pieces], dtype=object
+    )
+    geometries = simplify_normalized(geometries, simplify_tol)
+
+    processed = data.set_geometry(geometries, crs=data.crs)
+    processed = processed[~processed.geometry.is_empty]
+    processed = resolve_and_clip(processed, footprint)
+    processed.to_crs(original_crs).to_file(output_path)
+
+
+def run_tiled_post_processing(
+    missions,
+    tile_size,
+    simplify_tol,
+    buffer_amount,
+    n_processes,
+    max_open_missions=None,
+):
+    """
+    Post process several maps by splitting each of them into overlapping tiles, processing all of
+    the tiles in a shared pool of workers, and stitching the tiles of each map back together. The
+    tiles with the most vertices of each map are started first, so a single large map is spread
+    across all the workers instead of being processed by one of them.
+
+    The missions are streamed through the pool, largest file first. Reading and splitting a map
+    also runs in the pool, and only `max_open_missions` maps are split and not yet stitched at
+    once, so the tiles of every map are never in memory together.
+
+    Args:
+        missions (list[tuple]): For each map, the ID, the predicted map file, the footprint to
+            clip it to, and the output file
+        tile_size (float): Size of the tiles in meters
+        simplify_tol (float): Simplification tolerance in meters
+        buffer_amount (float): Buffer distance in meters
+        n_processes (int): Number of worker processes
+        max_open_missions (int, optional): How many maps can be in progress at once. If None, this
+            is `n_processes`.
+
+    Returns:
+        list[str]: The IDs of the missions which failed
+    """
+    margin = get_tile_margin(simplify_tol, buffer_amount)
+    if max_open_missions is None:
+        max_open_missions = n_processes
+    # Largest first
+    pending = sorted(
+        range(len(missions)),
+        key=lambda mission_index: Path(missions[mission_index][1]).stat().st_size,
+    )
+    # Maps from each running task to its kind and the index of its mission
+    futures = {}
+    # Maps from the index of each mission in progress to its state
+    open_missions = {}
+    failed = []
+    executor = ProcessPoolExecutor(max_workers=n_processes)
+
+    def submit(kind, mission_index, function, args):
+        nonlocal executor
+        try:
+            future = executor.submit(function, *args)
+        except BrokenProcessPool:
+            # A worker died, such as from running out of memory. Every task which was running
+            # fails, and a new pool is started for the rest.
+            executor.shutdown(wait=False, cancel_futures=True)
+            executor = ProcessPoolExecutor(max_workers=n_processes)
+            future = executor.submit(function, *args)
+        futures[future] = (kind, mission_index)
+
+    def start_next_mission():
+        mission_index = pending.pop()
+        _, input_path, footprint, _ = missions[mission_index]
+        open_missions[mission_index] = {"failed": False}
+        submit(
+            "prepared",
+            mission_index,
+            prepare_tiled_mission,
+            (input_path, footprint, tile_size, simplify_tol, margin),
+        )
+
+    try:
+        while len(pending) > 0 and len(open_missions) < max_open_missions:
+            start_next_mission()
+
+        while len(open_missions) > 0:
+            # If a worker dies, its task and every other running task fail with
+            # BrokenProcessPool, so this never waits on a task which was lost
+            finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+                kind, mission_index = futures.pop(future)
+                error = future.exception()
+                result = None if error is not None else future.result()
+                dataset_id, _, _, output_path = missions[mission_index]
+                mission = open_missions[mission_index]
+                done = False
+
+                if error is not None:
+                    print(f"Post processing {dataset_id} failed: {error!r}")
+                    if not mission["failed"]:
+                        failed.append(dataset_id)
+                    mission["failed"] = True
+                if kind == "prepared":
+                    if error is not None:
+                        done = True
+                    elif len(result[3]) == 0:
+                        print(f"Skipping {dataset_id} because it has no polygons")
+                        done = True
+                    else:
+                        data, footprint, original_crs, tiles = result
+                        print(f"Split {dataset_id} into {len(tiles)} tiles")
+                        mission.update(
+                            data=data,
+                            footprint=footprint,
+                            original_crs=original_crs,
+                            n_remaining=len(tiles),
+                            tile_results=[],
+                        )
+                        costs = [
+                            shapely.get_num_coordinates(parts).sum()
+                            for _, parts, _ in tiles
+                        ]
+                        for tile_index in np.argsort(costs)[::-1]:
+                            submit(
+                                "tile",
+                                mission_index,
+                                post_process_tile,
+                                (*tiles[tile_index], simplify_tol, buffer_amount),
+                            )
+                elif kind == "tile":
+                    mission["n_remaining"] -= 1
+                    if not mission["failed"]:
+                        mission["tile_results"].append(result)
+                    if mission["n_remaining"] == 0:
+                        if mission["failed"]:
+                            done = True
+                        else:
+                            print(f"Stitching {dataset_id}")
+                            submit(
+                                "stitched",
+                                mission_index,
+                                finish_tiled_mission,
+                                (
+                                    mission["data"],
+                                    mission["tile_results"],
+                                    mission["footprint"],
+                                    mission["original_crs"],
+                                    simplify_tol,
+                                    Path(output_path),
+                                ),
+                            )
+                            # The tiles are no longer needed once they are sent to the worker
+                            del mission["tile_results"]
+                elif kind == "stitched":
+                    done = True
+
+                if done:
+                    del open_missions[mission_index]
+                    if len(pending) > 0:
+                        start_next_mission()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+    return failed
@@ -0,0 +1,182 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+from file_fingerprints import get_file_fingerprint
+from geograypher.cameras import MetashapeCameraSet
+
+from mesh_cache import load_cached_mesh
+
+# Incremented if the format of the cache changes, so old caches are not used
+CACHE_VERSION = 1
+# The face index of pixels which do not land on the mesh
+NO_FACE = -1
+
+
+def get_visibility_key(mesh_file, cameras_file, mesh_downsample, image_scale):
+    """
+    Identifier for everything the pixel-to-face correspondence depends on. The predictions are not
+    included, so the same cache is used for every model.
+    """
+    description = json.dumps(
+        {
+            "version": CACHE_VERSION,
+            "mesh": get_file_fingerprint(mesh_file),
+            "cameras": get_file_fingerprint(cameras_file),
+            "mesh_downsample": mesh_downsample,
+            "image_scale": image_scale,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha1(description.encode()).hexdigest()[:16]
+
+
+class VisibilityIndex:
+    """
+    The face of the mesh that each pixel of each camera lands on, read from a cache folder. The
+    face indices are memory mapped, so only the cameras which are used are read from disk.
+    """
+
+    def __init__(self, cache_folder):
+        with open(Path(cache_folder, "metadata.json"), "r") as infile:
+            metadata = json.load(infile)
+        self.n_faces = metadata["n_faces"]
+        self.image_names = metadata["image_names"]
+        self.shapes = [tuple(shape) for shape in metadata["shapes"]]
+        self.offsets = np.array(metadata["offsets"], dtype=np.int64)
+        # Memory mapping an empty file is not supported
+        self.pix2face = (
+            np.memmap(Path(cache_folder, "pix2face.bin"), dtype=np.int32, mode="r")
+            if self.offsets[-1] > 0
+            else np.zeros(0, dtype=np.int32)
+        )
+
+    def __len__(self):
+        return len(self.image_names)
+
+    def get_pix2face(self, index):
+        """The (height, width) face index of each pixel for a camera, NO_FACE if none"""
+        return self.pix2face[self.offsets[index] : self.offsets[index + 1]].reshape(
+            self.shapes[index]
+        )
+
+
+def build_visibility_cache(
+    cache_folder,
+    mesh_cache_root,
+    mission_id,
+    mesh_file,
+    cameras_file,
+    images_folder,
+    original_image_folder,
+    image_scale,
+    mesh_downsample=1,
+):
+    """
+    Render the mesh from every camera at `image_scale` and write the face that each pixel lands on
+    to `cache_folder`. The faces are streamed to disk as each camera is rendered, and the cache is
+    only moved into place once it is complete. The mesh is loaded through the mesh cache in
+    `mesh_cache_root`.
+    """
+    cache_folder = Path(cache_folder)
+    tmp_folder = cache_folder.with_name(cache_folder.name + ".tmp")
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    tmp_folder.mkdir(parents=True)
+
+    camera_set = MetashapeCameraSet(
+        cameras_file, images_folder, original_image_folder=original_image_folder
+    )
+    mesh = load_cached_mesh(
+        mesh_cache_root, mission_id, mesh_file, cameras_file, mesh_downsample
+    )
+
+    image_names = []
+    shapes = []
+    offsets = [0]
+    with open(Path(tmp_folder, "pix2face.bin"), "wb") as outfile:
+        for i in range(camera_set.n_cameras()):
+            pix2face = mesh.pix2face(
+                camera_set.get_camera_by_index(i), render_img_scale=image_scale
+            )
+            pix2face = np.where(pix2face >= 0, pix2face, NO_FACE).astype(np.int32)
+            outfile.write(pix2face.tobytes())
+
+            image_names.append(
+                Path(camera_set.get_image_filename(i))
+                .relative_to(images_folder)
+                .as_posix()
+            )
+            shapes.append(list(pix2face.shape))
+            offsets.append(offsets[-1] + pix2face.size)
+
+    with open(Path(tmp_folder, "metadata.json"), "w") as outfile:
+        json.dump(
+            {
+                "n_faces": int(mesh.pyvista_mesh.n_cells),
+                "image_names": image_names,
+                "shapes": shapes,
+                "offsets": offsets,
+            },
+            outfile,
+        )
+
+    shutil.rmtree(cache_folder, ignore_errors=True)
+    os.replace(tmp_folder, cache_folder)
+
+
+def get_visibility_cache_folder(
+    cache_root, mission_id, mesh_file, cameras_file, image_scale, mesh_downsample=1
+):
+    key = get_visibility_key(mesh_file, cameras_file, mesh_downsample, image_scale)
+    return Path(cache_root, mission_id, key)
+
+
+def has_visibility_cache(
+    cache_root, mission_id, mesh_file, cameras_file, image_scale, mesh_downsample=1
+):
+    """Whether there is a complete cache for the current mesh, cameras and settings"""
+    cache_folder = get_visibility_cache_folder(
+        cache_root, mission_id, mesh_file, cameras_file, image_scale, mesh_downsample
+    )
+    return Path(cache_folder, "metadata.json").is_file()
+
+
+def get_visibility_index(
+    cache_root,
+    mesh_cache_root,
+    mission_id,
+    mesh_file,
+    cameras_file,
+    images_folder,
+    original_image_folder,
+    image_scale,
+    mesh_downsample=1,
+):
+    """
+    Load the pixel-to-face index for a mission, building it first if there is no cache for the
+    current mesh, cameras and settings. Caches for outdated inputs are removed.
+    """
+    cache_folder = get_visibility_cache_folder(
+        cache_root, mission_id, mesh_file, cameras_file, image_scale, mesh_downsample
+    )
+    if not Path(cache_folder, "metadata.json").is_file():
+        # Only keep the cache for the current inputs, since each one is large
+        if cache_folder.parent.is_dir():
+            for outdated in cache_folder.parent.iterdir():
+                shutil.rmtree(outdated)
+        print(f"Building the visibility cache for {mission_id}")
+        build_visibility_cache(
+            cache_folder,
+            mesh_cache_root,
+            mission_id,
+            mesh_file,
+            cameras_file,
+            images_folder,
+            original_image_folder,
+            image_scale,
+            mesh_downsample=mesh_downsample,
+        )
+    return VisibilityIndex(cache_folder)
@@ -56,14 +56,44 @@ PER_IMAGE_PREDICTIONS_FOLDER = Path(
     DATA_FOLDER, "intermediate", "per_image_predictions"
 )
 PROJECTIONS_TO_FACES_FOLDER = Path(DATA_FOLDER, "intermediate", "projections_to_faces")
+PROJECTION_LOGS_FOLDER = Path(DATA_FOLDER, "intermediate", "projection_logs")
+VISIBILITY_CACHE_FOLDER = Path(DATA_FOLDER, "intermediate", "visibility_cache")
+MESH_CACHE_FOLDER = Path(DATA_FOLDER, "intermediate", "mesh_cache")
+PROJECTION_ENGINE_COMPARISON_FOLDER = Path(
+    DATA_FOLDER, "intermediate", "projection_engine_comparison"
+)
 PROJECTIONS_TO_GEOSPATIAL_FOLDER = Path(
     DATA_FOLDER, "intermediate", "projections_to_geospatial"
 )
+PROJECTIONS_TO_GEOSPATIAL_RASTERS_FOLDER = Path(
+    DATA_FOLDER, "intermediate", "projections_to_geospatial_rasters"
+)
+CONFIDENCE_THRESHOLD_SWEEP_FOLDER = Path(
+    DATA_FOLDER, "intermediate", "confidence_threshold_sweep"
+)
 SHIFTS_PER_DATASET = Path(DATA_FOLDER, "intermediate", "shift_per_dataset.json")
 POST_PROCESSED_MAPS_FOLDER = Path(DATA_FOLDER, "intermediate", "post_processed_maps")
+POST_PROCESSING_LOGS_FOLDER = Path(DATA_FOLDER, "intermediate", "post_processing_logs")
+POST_PROCESSING_DEBUG_FOLDER = Path(
+    DATA_FOLDER, "intermediate", "post_processing_debug"
+)
+POST_PROCESSING_SWEEP_FOLDER = Path(
+    DATA_FOLDER, "intermediate", "post_processing_sweep"
+)
 SHIFTED_MAPS_FOLDER = Path(DATA_FOLDER, "intermediate", "shifted_maps")
+SHIFTED_MAPS_RECORDS_FOLDER = Path(DATA_FOLDER, "intermediate", "shifted_maps_records")
 PAIRWISE_SHIFTS_FILE = Path(DATA_FOLDER, "intermediate", "pairwise_registration.gpkg")
+PAIRWISE_REGISTRATION_CACHE_FOLDER = Path(
+    DATA_FOLDER, "intermediate", "pairwise_registration_cache"
+)
+CHM_CHIPS_FOLDER = Path(DATA_FOLDER, "intermediate", "chm_chips")
 ABSOLUTE_SHIFTS_FILE = Path(DATA_FOLDER, "intermediate", "shift_per_dataset.json")
+ABSOLUTE_SHIFTS_DIAGNOSTICS_FILE = Path(
+    DATA_FOLDER, "intermediate", "shift_per_dataset_diagnostics.csv"
+)
+ABSOLUTE_SHIFTS_SOLVER_STATE_FILE = Path(
+    DATA_FOLDER, "intermediate", "shift_per_dataset_solver.npz"
+)
 
 ## outputs
 SHIFTED_MAPS_FOLDER = Path(DATA_FOLDER, "outputs", "shifted_maps")
@@ -0,0 +1,12 @@
+from pathlib import Path
+
+
+def get_file_fingerprint(filename):
+    """
+    Cheap fingerprint of a file based on the size and modification time, used to tell whether an
+    output made from the file is outdated without reading it. None if the file does not exist.
+    """
+    if not Path(filename).is_file():
+        return None
+    stat = Path(filename).stat()
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
@@ -0,0 +1,220 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+# Written to the root of the predictions folder to describe how the predictions were produced
+PREDICTION_MANIFEST_FILENAME = "prediction_manifest.json"
+
+
+def get_manifest_file(predictions_folder):
+    return Path(predictions_folder, PREDICTION_MANIFEST_FILENAME)
+
+
+def write_prediction_manifest(predictions_folder, **manifest):
+    """Record how the predictions in `predictions_folder` were produced, such as the output scale"""
+    manifest_file = get_manifest_file(predictions_folder)
+    manifest_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = manifest_file.with_suffix(".json.tmp")
+    with open(tmp_file, "w") as outfile:
+        json.dump(manifest, outfile, indent=4)
+    os.replace(tmp_file, manifest_file)
+
+
+def read_prediction_manifest(predictions_folder):
+    """
+    Read the manifest of a predictions folder. Folders written before manifests were introduced
+    contain full resolution predictions, so that is what is assumed if there is no manifest.
+    "complete" is False while inference is still writing the predictions.
+    """
+    manifest_file = get_manifest_file(predictions_folder)
+    if not manifest_file.is_file():
+        return {"output_scale": 1.0}
+    with open(manifest_file, "r") as infile:
+        return json.load(infile)
+
+
+def get_store_file(predictions_folder, mission_id):
+    """The container holding all the predictions for one mission"""
+    return Path(predictions_folder, f"{mission_id}.h5")
+
+
+def quantize_probabilities(probabilities):
+    return np.round(np.clip(probabilities, 0, 1) * 255).astype(np.uint8)
+
+
+def dequantize_probabilities(quantized):
+    return quantized.astype(np.float32) / 255
+
+
+def read_store_index(h5_file):
+    """Maps from image name to the (dataset name, row) where its predictions are stored"""
+    if "image_names" not in h5_file:
+        return {}
+    return {
+        name: (dataset_name, int(row))
+        for name, dataset_name, row in zip(
+            h5_file["image_names"].asstr()[:],
+            h5_file["label_datasets"].asstr()[:],
+            h5_file["rows"][:],
+        )
+    }
+
+
+class PredictionStoreWriter:
+    """
+    Pack the per-image predictions of one mission into a single HDF5 file. Labels are stored as
+    uint8 in one dataset per image shape, with one chunk per image, and the class probabilities
+    can optionally be stored alongside them quantized to uint8. An index maps from the image name
+    to where its predictions are stored. Writing a name which is already present replaces it,
+    in place if the image shape has not changed, so rewriting the predictions does not grow the
+    file.
+    """
+
+    def __init__(self, store_file, compression="gzip"):
+        """
+        Args:
+            store_file (PathLike): The HDF5 file, which is appended to if it exists
+            compression (str, optional): HDF5 compression filter. If None, the labels can be read
+                with memory mapping. Defaults to "gzip".
+        """
+        # h5py is only required for "hdf5" storage
+        import h5py
+
+        Path(store_file).parent.mkdir(parents=True, exist_ok=True)
+        self.file = h5py.File(store_file, "a")
+        self.compression = compression
+        self.index = read_store_index(self.file)
+        if "image_names" not in self.file:
+            self.file.create_dataset(
+                "image_names", (0,), maxshape=(None,), dtype=h5py.string_dtype()
+            )
+            self.file.create_dataset(
+                "label_datasets", (0,), maxshape=(None,), dtype=h5py.string_dtype()
+            )
+            self.file.create_dataset("rows", (0,), maxshape=(None,), dtype=np.int64)
+        # Position of each name in the index datasets
+        self.index_positions = {name: i for i, name in enumerate(self.index)}
+
+    def _get_dataset(self, dataset_name, item_shape):
+        if dataset_name not in self.file:
+            self.file.create_dataset(
+                dataset_name,
+                (0, *item_shape),
+                maxshape=(None, *item_shape),
+                chunks=(1, *item_shape),
+                dtype=np.uint8,
+                compression=self.compression,
+            )
+        return self.file[dataset_name]
+
+    def _append(self, dataset, row, data):
+        if dataset.shape[0] <= row:
+            dataset.resize(row + 1, axis=0)
+        dataset[row] = data
+
+    def write(self, name, labels, probabilities=None):
+        """
+        Args:
+            name (str): Identifier of the image, such as its path within the mission folder
+            labels (np.ndarray): (height, width) class IDs
+            probabilities (np.ndarray, optional): (n_classes, height, width) class probabilities
+        """
+        shape_key = f"{labels.shape[0]}x{labels.shape[1]}"
+        labels_dataset = self._get_dataset(f"labels/{shape_key}", labels.shape)
+        dataset_name = labels_dataset.name.lstrip("/")
+        previous_dataset_name, previous_row = self.index.get(name, (None, None))
+        # Reuse the existing row if the shape is the same, otherwise the old row is abandoned
+        row = (
+            previous_row
+            if previous_dataset_name == dataset_name
+            else labels_dataset.shape[0]
+        )
+        self._append(labels_dataset, row, labels)
+        probabilities_name = f"probabilities/{shape_key}"
+        if probabilities is not None:
+            # Rows for images written without probabilities are left as zeros
+            self._append(
+                self._get_dataset(probabilities_name, probabilities.shape),
+                row,
+                quantize_probabilities(probabilities),
+            )
+        elif (
+            probabilities_name in self.file
+            and self.file[probabilities_name].shape[0] > row
+        ):
+            # Clear the probabilities of the predictions which are being replaced
+            self.file[probabilities_name][row] = 0
+
+        # Update the index, replacing the entry if this image was already written
+        position = self.index_positions.get(name)
+        if position is None:
+            position = len(self.index_positions)
+            self.index_positions[name] = position
+            for index_name in ("image_names", "label_datasets", "rows"):
+                self.file[index_name].resize(position + 1, axis=0)
+        self.file["image_names"][position] = name
+        self.file["label_datasets"][position] = dataset_name
+        self.file["rows"][position] = row
+        self.index[name] = (dataset_name, row)
+        # Make sure the image is on disk before the caller records it as complete
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class PredictionStoreReader:
+    """Random access to the predictions of one mission written by `PredictionStoreWriter`"""
+
+    def __init__(self, store_file):
+        # h5py is only required for "hdf5" storage
+        import h5py
+
+        self.store_file = Path(store_file)
+        self.file = h5py.File(self.store_file, "r")
+        self.index = read_store_index(self.file)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    @property
+    def image_names(self):
+        return list(self.index)
+
+    def read_labels(self, name):
+        """
+        The (height, width) labels for `name`. If the labels are stored uncompressed, they are
+        memory mapped from the file rather than read.
+        """
+        dataset_name, row = self.index[name]
+        dataset = self.file[dataset_name]
+        if dataset.compression is None and not dataset.shuffle:
+            # Each image is a single chunk, which is stored contiguously
+            chunk_info = dataset.id.get_chunk_info_by_coord((row, 0, 0))
+            return np.memmap(
+                self.store_file,
+                dtype=dataset.dtype,
+                mode="r",
+                offset=chunk_info.byte_offset,
+                shape=dataset.shape[1:],
+            )
+        return dataset[row]
+
+    def read_probabilities(self, name):
+        """The (n_classes, height, width) probabilities for `name`, or None if not stored"""
+        dataset_name, row = self.index[name]
+        dataset_name = dataset_name.replace("labels/", "probabilities/", 1)
+        if dataset_name not in self.file or self.file[dataset_name].shape[0] <= row:
+            return None
+        return dequantize_probabilities(self.file[dataset_name][row])
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()